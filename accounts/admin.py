@@ -1,5 +1,6 @@
 from django.contrib import admin
 from .models import Student, Teacher, CompanyRepresentative,FavoriteCompany,StudentTag #StudentTag追加
+from core.matching import student_tags_changed
 
 # 学生タグのインライン設定（学生画面の中に埋め込む設定）
 class StudentTagInline(admin.TabularInline):
@@ -13,6 +14,11 @@ class StudentAdmin(admin.ModelAdmin):
     search_fields = ('full_name', 'school__name')
     #タグ設定欄追加
     inlines = [StudentTagInline]
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # 管理画面でタグを編集した場合もマッチ度を更新する
+        student_tags_changed(form.instance)
 @admin.register(Teacher)
 class TeacherAdmin(admin.ModelAdmin):
     list_display = ('full_name', 'school', 'subject')
@@ -1,28 +1,12 @@
-from .models import Student, Teacher, CompanyRepresentative
+from .roles import ROLE_GUEST
+
 
 def add_user_role(request):
     """
-    すべてのテンプレートに 'user_type' という変数を自動で追加する
+    すべてのテンプレートに 'user_type' (ロール) と 'user_profile' を自動で追加する
+    判定は RoleMiddleware で済んでいるので、ここでは SQL は発行しない
     """
-    user = request.user
-    
-    # ログインしていない場合は 'guest'
-    if not user.is_authenticated:
-        return {'user_type': 'guest'}
-    
-    # ログイン中のユーザーの種類を判別
-    try:
-        if hasattr(user, 'student'):
-            return {'user_type': 'student'}
-        elif hasattr(user, 'teacher'):
-            return {'user_type': 'teacher'}
-        elif hasattr(user, 'companyrepresentative'):
-            return {'user_type': 'company'}
-        elif user.is_superuser:
-            return {'user_type': 'admin'}
-        else:
-            return {'user_type': 'authenticated'} # (プロフィール未設定)
-            
-    except Exception:
-        # (エラーが発生した場合)
-        return {'user_type': 'guest'}
\ No newline at end of file
+    return {
+        'user_type': getattr(request, 'role', ROLE_GUEST),
+        'user_profile': getattr(request, 'profile', None),
+    }
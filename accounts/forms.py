@@ -7,6 +7,7 @@ from django.db import transaction
 from core.models import Tag
 from .models import Student, Teacher, CompanyRepresentative, FavoriteCompany, StudentTag
 from companies.models import CompanyTag
+from core.matching import student_tags_changed, company_tags_changed
 
 #学生用タグ設定フォーム
 class StudentTagUpdateForm(forms.Form):
@@ -37,6 +38,7 @@ class StudentTagUpdateForm(forms.Form):
                 widget=forms.Select(attrs={'class': 'form-control'})
             )
 
+    @transaction.atomic
     def save(self):
         student = self.user.student
         # 既存のタグを一度クリア
@@ -55,6 +57,9 @@ class StudentTagUpdateForm(forms.Form):
                     rank=rank
                 )
 
+        # この学生の行だけマッチ度を再計算 (転置インデックスも更新)
+        student_tags_changed(student)
+
 # 企業用タグ設定フォーム
 class CompanyTagUpdateForm(forms.Form):
     def __init__(self, *args, user=None, **kwargs):
@@ -84,6 +89,7 @@ class CompanyTagUpdateForm(forms.Form):
                 widget=forms.Select(attrs={'class': 'form-control'})
             )
 
+    @transaction.atomic
     def save(self):
         company = self.user.companyrepresentative.company
         CompanyTag.objects.filter(company=company).delete()
@@ -100,6 +106,9 @@ class CompanyTagUpdateForm(forms.Form):
                     rank=rank
                 )
 
+        # この企業の列だけマッチ度を再計算 (転置インデックスも更新)
+        company_tags_changed(company)
+
 # Django標準のUserCreationFormを拡張して、学生プロフィールも同時作成する
 class StudentSignUpForm(UserCreationForm):
     # Studentモデルの項目（models.pyで定義したもの）
@@ -0,0 +1,15 @@
+from .roles import get_request_role
+
+
+class RoleMiddleware:
+    """
+    request.role (ロール名) と request.profile (Student / Teacher / CompanyRepresentative) を付ける
+    AuthenticationMiddleware より後ろに置くこと
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.role, request.profile = get_request_role(request)
+        return self.get_response(request)
@@ -0,0 +1,126 @@
+"""
+ログインユーザーの種類 (ロール) とプロフィールの判定
+
+hasattr(user, 'student') などで1種類ずつ調べると、外れるたびに SQL が1本走る。
+ここでは JOIN した1本の SQL でまとめて判定し、ロールはセッションに覚えておく。
+2回目以降はそのロールのプロフィールだけを取得し、無くなっていれば判定し直す。
+(ビューからは RoleMiddleware が付けた request.role / request.profile を使う)
+"""
+from django.contrib.auth.models import User
+
+from .models import Student, Teacher, CompanyRepresentative
+
+ROLE_GUEST = 'guest'
+ROLE_STUDENT = 'student'
+ROLE_TEACHER = 'teacher'
+ROLE_COMPANY = 'company'
+ROLE_ADMIN = 'admin'
+ROLE_UNASSIGNED = 'authenticated'  # ログイン済みだがプロフィール未設定
+
+ROLE_LABELS = {
+    ROLE_STUDENT: '学生',
+    ROLE_TEACHER: '教員',
+    ROLE_COMPANY: '企業担当者',
+}
+
+# ロール → (User からの逆参照名, プロフィールのモデル, 一緒に取る関連)
+PROFILE_RELATIONS = {
+    ROLE_STUDENT: ('student', Student, ['school']),
+    ROLE_TEACHER: ('teacher', Teacher, ['school']),
+    ROLE_COMPANY: ('companyrepresentative', CompanyRepresentative, ['company']),
+}
+
+# User から全種類のプロフィール (と表示に使う学校・企業) を JOIN で取るときの指定
+PROFILE_SELECT_RELATED = ['student__school', 'teacher__school', 'companyrepresentative__company']
+
+SESSION_KEY = '_user_role'
+
+
+def _cache_profiles(user, profiles):
+    """
+    user.student などの逆参照にキャッシュを入れる
+    (無いものは None を入れておくと、hasattr しても SQL が走らない)
+    """
+    for accessor, value in profiles.items():
+        getattr(User, accessor).related.set_cached_value(user, value)
+
+
+def resolve_role(user):
+    """
+    1本の SQL でロールとプロフィールを判定する。戻り値: (role, profile)
+    """
+    if not user.is_authenticated:
+        return ROLE_GUEST, None
+
+    fetched = User.objects.select_related(*PROFILE_SELECT_RELATED).get(pk=user.pk)
+
+    role, profile = None, None
+    profiles = {}
+    for candidate, (accessor, _model, _related) in PROFILE_RELATIONS.items():
+        value = getattr(fetched, accessor, None)
+        profiles[accessor] = value
+        if value is not None and role is None:
+            role, profile = candidate, value
+    _cache_profiles(user, profiles)
+    if profile is not None:
+        profile.user = user
+
+    if role is None:
+        role = ROLE_ADMIN if user.is_superuser else ROLE_UNASSIGNED
+    return role, profile
+
+
+def load_profile(user, role):
+    """ ロールが分かっている場合に、そのプロフィールだけを取得する """
+    if role not in PROFILE_RELATIONS:
+        return None
+    accessor, model, related = PROFILE_RELATIONS[role]
+    profile = model.objects.select_related(*related).filter(user=user).first()
+    if profile is not None:
+        profile.user = user
+        _cache_profiles(user, {accessor: profile})
+    return profile
+
+
+def load_cached_role(session, user):
+    """
+    セッションに覚えたロールを確認する。戻り値: (role, profile)。使えなければ None
+    プロフィールが削除されていたら (管理画面で消した・別のロールに作り直したなど)、覚えたロールを消す
+    """
+    cached = session.get(SESSION_KEY)
+    if not cached or cached.get('user_id') != user.pk:
+        return None
+    role = cached['role']
+    if role in PROFILE_RELATIONS:
+        profile = load_profile(user, role)
+        if profile is not None:
+            return role, profile
+    elif role != ROLE_ADMIN or user.is_superuser:
+        return role, None
+    session.pop(SESSION_KEY, None)
+    return None
+
+
+def get_request_role(request):
+    """
+    リクエストのロールとプロフィールを返す。戻り値: (role, profile)
+    セッションに覚えたロールがあれば、そのプロフィールを取る1本の SQL だけで済ませる
+    """
+    user = request.user
+    if not user.is_authenticated:
+        return ROLE_GUEST, None
+
+    cached = load_cached_role(request.session, user)
+    if cached is not None:
+        return cached
+
+    role, profile = resolve_role(user)
+    # プロフィール未設定のユーザーは後から設定されるので覚えない
+    if role != ROLE_UNASSIGNED:
+        request.session[SESSION_KEY] = {'user_id': user.pk, 'role': role}
+    return role, profile
+
+
+def forget_role(request):
+    """ プロフィールを作り直したときなどに、セッションのロールを消す """
+    request.session.pop(SESSION_KEY, None)
@@ -1,3 +1,141 @@
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
+from django.urls import reverse
+
+from companies.models import Company, CompanyTag
+from core.models import Tag
+from core.tag_index import reset_tag_index
+from schools.models import School
+from .models import CompanyRepresentative, Student, StudentTag, Teacher
+from .roles import (
+    ROLE_ADMIN, ROLE_COMPANY, ROLE_STUDENT, ROLE_TEACHER, ROLE_UNASSIGNED, SESSION_KEY,
+)
+
+
+class RoleMiddlewareTests(TestCase):
+    def setUp(self):
+        self.school = School.objects.create(name='第一高校', address='東京都')
+        self.user = User.objects.create_user(username='teacher', password='pass')
+        self.teacher = Teacher.objects.create(user=self.user, school=self.school, full_name='先生', subject='数学')
+        self.client.force_login(self.user)
+
+    def request(self, url=None):
+        """ 任意のページを開き、RoleMiddleware が付けた request を返す """
+        response = self.client.get(url or reverse('accounts:teacher_student_list'))
+        return response, response.wsgi_request
+
+    def session_role(self):
+        return self.client.session.get(SESSION_KEY)
+
+    def test_role_is_resolved_and_remembered(self):
+        response, request = self.request()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.role, ROLE_TEACHER)
+        self.assertEqual(request.profile, self.teacher)
+        self.assertEqual(self.session_role(), {'user_id': self.user.pk, 'role': ROLE_TEACHER})
+
+    def test_remembered_role_skips_resolve(self):
+        self.request()
+        with mock.patch('accounts.roles.resolve_role') as resolve_role:
+            response, request = self.request()
+        resolve_role.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.role, ROLE_TEACHER)
+        self.assertEqual(request.profile, self.teacher)
+        self.assertEqual(request.profile.school, self.school)
+
+    def test_deleted_profile_drops_remembered_role(self):
+        self.request()
+        self.teacher.delete()
+
+        # 覚えていた教員のロールのままだと profile が None になり 500 になっていた
+        response, request = self.request()
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(request.role, ROLE_UNASSIGNED)
+        self.assertIsNone(request.profile)
+        self.assertIsNone(self.session_role())
+
+    def test_recreated_profile_switches_role(self):
+        self.request()
+        self.teacher.delete()
+        student = Student.objects.create(user=self.user, school=self.school, full_name='学生', grade=1)
+
+        response, request = self.request()
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(request.role, ROLE_STUDENT)
+        self.assertEqual(request.profile, student)
+        self.assertEqual(self.session_role(), {'user_id': self.user.pk, 'role': ROLE_STUDENT})
+
+    def test_deleted_company_representative(self):
+        user = User.objects.create_user(username='company', password='pass')
+        company = Company.objects.create(name='株式会社テスト', industry='IT', description='説明')
+        representative = CompanyRepresentative.objects.create(user=user, company=company, full_name='担当者')
+        self.client.force_login(user)
+        url = reverse('companies:scout_list')
+
+        response, request = self.request(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.role, ROLE_COMPANY)
+
+        representative.delete()
+        response, request = self.request(url)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(request.role, ROLE_UNASSIGNED)
+
+    def test_demoted_superuser_drops_admin_role(self):
+        admin = User.objects.create_superuser(username='admin', password='pass')
+        self.client.force_login(admin)
+        _response, request = self.request(reverse('accounts:dashboard'))
+        self.assertEqual(request.role, ROLE_ADMIN)
+
+        User.objects.filter(pk=admin.pk).update(is_superuser=False)
+        _response, request = self.request(reverse('accounts:dashboard'))
+        self.assertEqual(request.role, ROLE_UNASSIGNED)
+        self.assertIsNone(self.session_role())
+
+    def test_session_of_other_user_is_ignored(self):
+        self.request()
+        other = User.objects.create_user(username='student', password='pass')
+        student = Student.objects.create(user=other, school=self.school, full_name='学生', grade=1)
+        session = self.client.session
+        session[SESSION_KEY] = {'user_id': other.pk, 'role': ROLE_STUDENT}
+        session.save()
+
+        _response, request = self.request()
+        self.assertEqual(request.role, ROLE_TEACHER)
+        self.assertNotEqual(request.profile, student)
+
+
+class MyPageRecommendationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_tag_index()
+        self.addCleanup(reset_tag_index)
+        tag, other = Tag.objects.create(name='Python'), Tag.objects.create(name='英語')
+        self.student = Student.objects.create(
+            user=User.objects.create_user(username='student', password='pass'), full_name='学生', grade=1,
+        )
+        StudentTag.objects.create(student=self.student, tag=tag, tag_type='strength', rank=1)
+        StudentTag.objects.create(student=self.student, tag=other, tag_type='strength', rank=2)
+        self.best = Company.objects.create(name='一致企業', industry='IT', description='説明')
+        self.second = Company.objects.create(name='少し一致企業', industry='IT', description='説明')
+        Company.objects.create(name='不一致企業', industry='IT', description='説明')
+        CompanyTag.objects.create(company=self.best, tag=tag, tag_type='strength', rank=1)
+        CompanyTag.objects.create(company=self.second, tag=other, tag_type='strength', rank=1)
+        self.representative = CompanyRepresentative.objects.create(
+            user=User.objects.create_user(username='company', password='pass'), company=self.best, full_name='担当者',
+        )
+
+    def test_student_sees_matching_companies(self):
+        self.client.force_login(self.student.user)
+        response = self.client.get(reverse('accounts:my_page'))
+        # 5*5 / 110, 4*5 / 110。タグの一致しない企業は出ない
+        self.assertEqual(response.context['recommended_companies'], [(self.best, 22), (self.second, 18)])
 
-# Create your tests here.
+    def test_company_sees_matching_students(self):
+        self.client.force_login(self.representative.user)
+        response = self.client.get(reverse('accounts:my_page'))
+        self.assertEqual(response.context['recommended_students'], [(self.student, 22)])
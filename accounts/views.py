@@ -3,7 +3,7 @@ from django.urls import reverse_lazy
 from django.views.generic import CreateView, ListView, DetailView, UpdateView, FormView
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from .models import Student, Teacher, CompanyRepresentative, FavoriteCompany
+from .models import Student, Teacher, FavoriteCompany
 from .forms import (
     StudentSignUpForm, TeacherSignUpForm, CompanyRepresentativeSignUpForm,
     TeacherCommentForm,
@@ -13,11 +13,14 @@ from .forms import (
 )
 from companies.models import Company, Scout
 from chat.models import ChatRoom
-from django.db.models import Q, Count
+from django.db.models import Q, FilteredRelation
+from django.db.models.functions import Coalesce
 from portfolios.models import Portfolio
 from core.models import Announcement
 from django.core.paginator import Paginator
-from core.utils import calculate_match_percentage
+from core.matching import get_match_score
+from core.tag_index import get_tag_index, with_objects
+from .roles import ROLE_STUDENT, ROLE_TEACHER, ROLE_COMPANY, ROLE_LABELS
 
 # ==================================
 # 1. 新規登録（サインアップ）関連
@@ -64,47 +67,30 @@ class CompanyRepresentativeSignUpView(CreateView):
 # 2. 権限チェック用 Mixin (クラス)
 # ==================================
 
-class StudentOnlyMixin(UserPassesTestMixin):
-    def test_func(self):
-        try:
-            return hasattr(self.request.user, 'student')
-        except:
-            return False
+# ロールの判定は RoleMiddleware が request.role に入れたものを使う (SQL は発行しない)
+class RoleRequiredMixin(UserPassesTestMixin):
+    allowed_roles = ()
 
-class TeacherOnlyMixin(UserPassesTestMixin):
     def test_func(self):
-        try:
-            return hasattr(self.request.user, 'teacher')
-        except:
-            return False
+        return getattr(self.request, 'role', None) in self.allowed_roles
 
-class TeacherOrCompanyOnlyMixin(UserPassesTestMixin):
-    def test_func(self):
-        try:
-            return (
-                hasattr(self.request.user, 'teacher') or 
-                hasattr(self.request.user, 'companyrepresentative') or
-                self.request.user.is_superuser
-            )
-        except:
-            return False
-
-class CompanyOnlyMixin(UserPassesTestMixin):
-    def test_func(self):
-        try:
-            return hasattr(self.request.user, 'companyrepresentative')
-        except:
-            return False
+class StudentOnlyMixin(RoleRequiredMixin):
+    allowed_roles = (ROLE_STUDENT,)
+
+class TeacherOnlyMixin(RoleRequiredMixin):
+    allowed_roles = (ROLE_TEACHER,)
+
+class TeacherOrCompanyOnlyMixin(RoleRequiredMixin):
+    allowed_roles = (ROLE_TEACHER, ROLE_COMPANY)
 
-class StudentOrTeacherOnlyMixin(UserPassesTestMixin):
     def test_func(self):
-        try:
-            return (
-                hasattr(self.request.user, 'student') or
-                hasattr(self.request.user, 'teacher')
-            )
-        except:
-            return False
+        return super().test_func() or self.request.user.is_superuser
+
+class CompanyOnlyMixin(RoleRequiredMixin):
+    allowed_roles = (ROLE_COMPANY,)
+
+class StudentOrTeacherOnlyMixin(RoleRequiredMixin):
+    allowed_roles = (ROLE_STUDENT, ROLE_TEACHER)
 
 # ==================================
 # 3. 共通ビュー (ダッシュボード・マイページ)
@@ -112,25 +98,6 @@ class StudentOrTeacherOnlyMixin(UserPassesTestMixin):
 @login_required
 def dashboard(request):
     user = request.user
-    user_type = None
-    profile = None
-    
-    try:
-        profile = user.student
-        user_type = 'student'
-    except Student.DoesNotExist:
-        try:
-            profile = user.teacher
-            user_type = 'teacher'
-        except Teacher.DoesNotExist:
-            try:
-                profile = user.companyrepresentative
-                user_type = 'company'
-            except CompanyRepresentative.DoesNotExist:
-                if user.is_superuser:
-                    user_type = 'admin'
-                else:
-                    user_type = 'unassigned' 
     
     announcement_list = Announcement.objects.all().order_by('-created_at')
     paginator = Paginator(announcement_list, 5)
@@ -139,47 +106,36 @@ def dashboard(request):
 
     context = {
         'username': user.username,
-        'user_type': user_type,
-        'profile': profile,
+        'user_type': request.role,
+        'profile': request.profile,
         'announcements': page_obj, 
     }
     return render(request, 'accounts/dashboard.html', context)
 
+# マイページに出すおすすめの件数
+RECOMMEND_COUNT = 5
+
 @login_required
 def my_page(request):
-    user = request.user
-    user_type = None
-    profile = None
+    user_type = request.role
+    profile = request.profile
     template_name = 'accounts/my_page.html'
-    portfolios = None
-    
-    try:
-        profile = user.student
-        user_type = 'student'
-        portfolios = profile.portfolio_set.all().order_by('-id')
-    except Student.DoesNotExist:
-        try:
-            profile = user.teacher
-            user_type = 'teacher'
-        except Teacher.DoesNotExist:
-            try:
-                profile = user.companyrepresentative
-                user_type = 'company'
-            except CompanyRepresentative.DoesNotExist:
-                if user.is_superuser:
-                    return redirect('admin:index')
-                else:
-                    user_type = 'unassigned'
                     
-    if user.is_superuser and not profile:
+    if request.user.is_superuser and not profile:
          return redirect('admin:index')
          
     context = {
         'user_type': user_type,
         'profile': profile,
     }
-    if user_type == 'student':
-        context['portfolios'] = portfolios
+    if user_type == ROLE_STUDENT:
+        context['portfolios'] = profile.portfolio_set.all().order_by('-id')
+        # マッチ度の高い企業 (タグの転置インデックスから上位だけを取り出す)
+        top = get_tag_index().top_companies_for_student(profile.pk, k=RECOMMEND_COUNT)
+        context['recommended_companies'] = with_objects(top, Company.objects.all())
+    elif user_type == ROLE_COMPANY:
+        top = get_tag_index().top_students_for_company(profile.company_id, k=RECOMMEND_COUNT)
+        context['recommended_students'] = with_objects(top, Student.objects.all())
     return render(request, template_name, context)
 
 # ==================================
@@ -193,13 +149,13 @@ class TeacherStudentListView(LoginRequiredMixin, TeacherOnlyMixin, ListView):
     context_object_name = 'students'
 
     def get_queryset(self):
-        teacher = self.request.user.teacher
+        teacher = self.request.profile
         queryset = Student.objects.filter(school=teacher.school)
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['school_name'] = self.request.user.teacher.school.name
+        context['school_name'] = self.request.profile.school.name
         return context
 
 # 学生詳細ビュー (教員・企業用)
@@ -215,11 +171,11 @@ class StudentDetailView(LoginRequiredMixin, TeacherOrCompanyOnlyMixin, DetailVie
         
         context['portfolios'] = student.portfolio_set.all()
         
-        if hasattr(user, 'companyrepresentative'):
-            company = user.companyrepresentative.company
+        if self.request.role == ROLE_COMPANY:
+            company = self.request.profile.company
             
-            # マッチ度とタグ情報の計算
-            match_data = calculate_match_percentage(student, company)
+            # マッチ度とタグ情報 (計算済みの MatchScore から取得)
+            match_data = get_match_score(student, company)
             
             context['match_rate'] = match_data['percentage']
             context['matched_strengths'] = match_data['matched_strengths']   # マッチした強み
@@ -232,14 +188,7 @@ class StudentDetailView(LoginRequiredMixin, TeacherOrCompanyOnlyMixin, DetailVie
                 teachers = Teacher.objects.filter(school=student.school)
                 context['school_teachers'] = teachers
             
-            existing_room = ChatRoom.objects.annotate(
-                num_participants=Count('participants')
-            ).filter(
-                num_participants=2,
-                participants=user
-            ).filter(
-                participants=student.user
-            ).first()
+            existing_room = ChatRoom.objects.find_direct(user, student.user_id)
             
             if existing_room:
                 context['student_chat_room_id'] = existing_room.id
@@ -264,12 +213,26 @@ class CompanyStudentListView(LoginRequiredMixin, CompanyOnlyMixin, ListView):
                 Q(portfolio__title__icontains=query) |
                 Q(portfolio__description__icontains=query)
             ).distinct()
+
+        # マッチ度順: 計算済みの MatchScore を LEFT JOIN して並べ替える (行が無ければ 0%)
+        if self.request.GET.get('sort') == 'match':
+            company = self.request.profile.company
+            queryset = queryset.annotate(
+                company_score=FilteredRelation(
+                    'match_scores',
+                    condition=Q(match_scores__company=company),
+                ),
+                match_rate=Coalesce('company_score__percentage', 0),
+            ).order_by('-match_rate', 'pk')
+        else:
+            queryset = queryset.order_by('pk')
             
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['query'] = self.request.GET.get('query', '') 
+        context['sort_by'] = self.request.GET.get('sort', '')
         return context
 
 # お気に入り企業一覧ビュー (学生用)
@@ -280,28 +243,28 @@ class FavoriteCompanyListView(LoginRequiredMixin, StudentOnlyMixin, ListView):
     paginate_by = 10
 
     def get_queryset(self):
-        student = self.request.user.student
+        student = self.request.profile
         return FavoriteCompany.objects.filter(student=student).order_by('-created_at')
 
 # スカウト追加ビュー
 @login_required
 def add_scout(request, student_pk):
-    if not hasattr(request.user, 'companyrepresentative'):
+    if request.role != ROLE_COMPANY:
         return redirect('accounts:student_detail', pk=student_pk)
         
     student = get_object_or_404(Student, pk=student_pk)
-    company = request.user.companyrepresentative.company
+    company = request.profile.company
     Scout.objects.get_or_create(company=company, student=student)
     return redirect('accounts:student_detail', pk=student_pk)
 
 # スカウト削除ビュー
 @login_required
 def remove_scout(request, student_pk):
-    if not hasattr(request.user, 'companyrepresentative'):
+    if request.role != ROLE_COMPANY:
         return redirect('accounts:student_detail', pk=student_pk)
         
     student = get_object_or_404(Student, pk=student_pk)
-    company = request.user.companyrepresentative.company
+    company = request.profile.company
     Scout.objects.filter(company=company, student=student).delete()
     
     next_url = request.POST.get('next')
@@ -318,11 +281,11 @@ class StudentCommentUpdateView(LoginRequiredMixin, TeacherOnlyMixin, UpdateView)
     context_object_name = 'student'
     
     def get_queryset(self):
-        teacher = self.request.user.teacher
+        teacher = self.request.profile
         return Student.objects.filter(school=teacher.school)
 
     def form_valid(self, form):
-        form.instance.comment_teacher = self.request.user.teacher
+        form.instance.comment_teacher = self.request.profile
         return super().form_valid(form)
 
     def get_success_url(self):
@@ -336,34 +299,19 @@ class ProfileUpdateView(LoginRequiredMixin, UpdateView):
     success_url = reverse_lazy('accounts:my_page')
 
     def get_object(self, queryset=None):
-        user = self.request.user
-        if hasattr(user, 'student'):
-            return user.student
-        elif hasattr(user, 'teacher'):
-            return user.teacher
-        elif hasattr(user, 'companyrepresentative'):
-            return user.companyrepresentative
-        return None 
+        return self.request.profile
 
     def get_form_class(self):
-        user = self.request.user
-        if hasattr(user, 'student'):
-            return StudentProfileForm
-        elif hasattr(user, 'teacher'):
-            return TeacherProfileForm
-        elif hasattr(user, 'companyrepresentative'):
-            return CompanyRepresentativeProfileForm
-        return None 
+        return {
+            ROLE_STUDENT: StudentProfileForm,
+            ROLE_TEACHER: TeacherProfileForm,
+            ROLE_COMPANY: CompanyRepresentativeProfileForm,
+        }.get(self.request.role)
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        user = self.request.user
-        if hasattr(user, 'student'):
-            context['user_type_jp'] = '学生'
-        elif hasattr(user, 'teacher'):
-            context['user_type_jp'] = '教員'
-        elif hasattr(user, 'companyrepresentative'):
-            context['user_type_jp'] = '企業担当者'
+        if self.request.role in ROLE_LABELS:
+            context['user_type_jp'] = ROLE_LABELS[self.request.role]
         return context
 # ★★★ ↑↑↑ ここまで修正 ↑↑↑ ★★★
 
@@ -381,7 +329,7 @@ class StudentTagUpdateView(LoginRequiredMixin, StudentOnlyMixin, FormView):
 
     def get_initial(self):
         initial = {}
-        student = self.request.user.student
+        student = self.request.profile
         for st_tag in student.tags.all():
             key = f"{st_tag.tag_type}_{st_tag.rank}"
             initial[key] = st_tag.tag
@@ -404,7 +352,7 @@ class CompanyTagUpdateView(LoginRequiredMixin, CompanyOnlyMixin, FormView):
 
     def get_initial(self):
         initial = {}
-        company = self.request.user.companyrepresentative.company
+        company = self.request.profile.company
         for co_tag in company.tags.all():
             key = f"{co_tag.tag_type}_{co_tag.rank}"
             initial[key] = co_tag.tag
@@ -1,30 +1,83 @@
+from django import forms
 from django.contrib import admin
-from .models import ChatRoom, ChatMessage
+from .models import ChatRoom, ChatMessage, ChatArchiveBlock, make_pair_key
 
 class ChatMessageInline(admin.TabularInline):
     """
     ChatRoom の詳細ページで、関連する ChatMessage を
     一覧表示・編集できるようにする
+    (追加はしない。通し番号・受信箱・未読数を更新しないので、メッセージはチャット画面から送る)
     """
     model = ChatMessage
-    extra = 1 # 新規追加用の空欄を1つ表示
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+class ChatRoomAdminForm(forms.ModelForm):
+
+    class Meta:
+        model = ChatRoom
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        participants = cleaned_data.get('participants')
+        if participants is None or cleaned_data.get('is_group'):
+            return cleaned_data
+        # 1対1ルームは2人だけ。同じ2人のルームは1つだけ (ChatRoom.pair_key)
+        if len(participants) != 2:
+            raise forms.ValidationError('1対1のルームの参加者は2人にしてください (3人以上はグループにする)。')
+        duplicate = ChatRoom.objects.filter(pair_key=make_pair_key(*participants)).exclude(pk=self.instance.pk)
+        if duplicate.exists():
+            raise forms.ValidationError('この2人のルームはすでにあります。')
+        return cleaned_data
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ('id', 'get_participants', 'created_at')
+    form = ChatRoomAdminForm
+    list_display = ('id', 'name', 'is_group', 'get_participants', 'created_at')
+    list_filter = ('is_group',)
     inlines = [ChatMessageInline] # ↑のインライン設定を適用
 
+    def get_queryset(self, request):
+        # 参加者は一覧の全行分をまとめて取得する
+        return super().get_queryset(request).prefetch_related('participants')
+
     def get_participants(self, obj):
         # 参加者一覧をカンマ区切りで表示
         return ", ".join([user.username for user in obj.participants.all()])
     get_participants.short_description = 'Participants'
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # get_or_create_direct / create_group と同じく pair_key と既読状態を用意する
+        ChatRoom.objects.sync_members(form.instance)
+
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
     list_display = ('author', 'room', 'content_preview', 'timestamp')
     list_filter = ('room', 'timestamp')
     search_fields = ('author__username', 'content')
 
+    def has_add_permission(self, request):
+        # ChatMessageInline と同じく、追加はチャット画面から
+        return False
+
     def content_preview(self, obj):
         return obj.content[:30] # 内容を30文字だけプレビュー
     content_preview.short_description = 'Content'
+
+@admin.register(ChatArchiveBlock)
+class ChatArchiveBlockAdmin(admin.ModelAdmin):
+    """
+    保管済みのメッセージ (中身は圧縮されているので一覧だけ)
+    """
+    list_display = ('room', 'day', 'message_count', 'raw_size', 'compressed_size')
+    list_filter = ('day',)
+    exclude = ('data',)
+    readonly_fields = ('room', 'day', 'first_timestamp', 'last_timestamp', 'message_count', 'raw_size', 'created_at')
+
+    def compressed_size(self, obj):
+        return len(obj.data)
+    compressed_size.short_description = 'Compressed size'
@@ -5,3 +5,7 @@ class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
     verbose_name = 'チャット機能'
+
+    def ready(self):
+        # 表示名キャッシュの削除 (chat.signals) を登録する
+        from . import signals  # noqa: F401
@@ -0,0 +1,158 @@
+"""
+古いチャットメッセージの保管 (compact_chat_messages コマンドから使う)
+
+AFTER_DAYS 日より前のメッセージを、ルーム・日ごとに1つの ChatArchiveBlock
+(JSON を zlib で圧縮したもの) にまとめ、ChatMessage からは削除する。
+
+- 日の区切りは settings.TIME_ZONE の0時。その日の分がすべて揃ってからまとめる
+- 履歴のページ送り (chat.services.get_history) は、ChatMessage を読み切ったら
+  続けてここから読むので、画面からは保管済みかどうかは分からない
+- 保管したメッセージの ID・通し番号・日時はそのまま残す (カーソルもそのまま使える)
+- 全文検索 (chat.search) の対象は ChatMessage に残っているメッセージだけ
+"""
+import json
+import zlib
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ChatMessage, ChatArchiveBlock
+
+DEFAULT_ARCHIVE_SETTINGS = {
+    # この日数より前のメッセージを保管する
+    'AFTER_DAYS': 180,
+    # zlib の圧縮レベル (1〜9)
+    'COMPRESSION_LEVEL': 6,
+}
+
+# SQLite の1つの SQL に渡せる値の数を超えないように分けて削除する
+DELETE_BATCH_SIZE = 500
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def get_archive_settings():
+    return {**DEFAULT_ARCHIVE_SETTINGS, **getattr(settings, 'CHAT_ARCHIVE', {})}
+
+
+def _to_micros(value):
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def pack_messages(messages, level=6):
+    """ メッセージ → (圧縮したデータ, 圧縮前のバイト数) """
+    rows = [
+        [msg.id, msg.author_id, msg.seq, _to_micros(msg.timestamp), msg.content]
+        for msg in messages
+    ]
+    raw = json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return zlib.compress(raw, level), len(raw)
+
+
+def unpack_block(block):
+    """ ChatArchiveBlock → 保存されていない ChatMessage のリスト (古い順) """
+    rows = json.loads(zlib.decompress(bytes(block.data)).decode('utf-8'))
+    return [
+        ChatMessage(
+            id=message_id, room_id=block.room_id, author_id=author_id, seq=seq,
+            timestamp=_EPOCH + timedelta(microseconds=micros), content=content,
+        )
+        for message_id, author_id, seq, micros, content in rows
+    ]
+
+
+def get_cutoff(days, now=None):
+    """ days 日前の0時 (これより前のメッセージを保管する) """
+    today = timezone.localdate(now)
+    return timezone.make_aware(datetime.combine(today - timedelta(days=days), time.min))
+
+
+def get_archived_messages(room, before=None, limit=50):
+    """
+    保管済みのメッセージを新しい方から limit 件返す
+    before: (timestamp, id)。これより前のものだけを返す
+    """
+    blocks = ChatArchiveBlock.objects.filter(room=room)
+    if before is not None:
+        blocks = blocks.filter(first_timestamp__lte=before[0])
+    messages = []
+    # 1日分ずつ読み、足りた時点でやめる
+    for block in blocks.order_by('-day').iterator(chunk_size=4):
+        day_messages = unpack_block(block)
+        if before is not None:
+            day_messages = [msg for msg in day_messages if (msg.timestamp, msg.id) < before]
+        day_messages.sort(key=lambda msg: (msg.timestamp, msg.id), reverse=True)
+        messages.extend(day_messages)
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
+
+
+def _group_by_day(messages):
+    days = {}
+    for msg in messages:
+        days.setdefault(timezone.localdate(msg.timestamp), []).append(msg)
+    return days
+
+
+def compact_room(room_id, cutoff, level=6):
+    """
+    1つのルームの cutoff より前のメッセージを保管する
+    戻り値: {'messages': 件数, 'blocks': ブロック数, 'raw_bytes': ..., 'compressed_bytes': ...}
+    """
+    result = {'messages': 0, 'blocks': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+    with transaction.atomic():
+        messages = list(
+            ChatMessage.objects.filter(room_id=room_id, timestamp__lt=cutoff).order_by('timestamp', 'id')
+        )
+        if not messages:
+            return result
+        existing = {
+            block.day: block
+            for block in ChatArchiveBlock.objects.filter(room_id=room_id, day__in=_group_by_day(messages))
+        }
+        for day, day_messages in _group_by_day(messages).items():
+            block = existing.get(day)
+            if block is not None:
+                # 同じ日のブロックが既にあれば (遅れて届いた分など)、まとめ直す
+                day_messages = sorted(unpack_block(block) + day_messages, key=lambda msg: (msg.timestamp, msg.id))
+            else:
+                block = ChatArchiveBlock(room_id=room_id, day=day)
+            block.data, block.raw_size = pack_messages(day_messages, level)
+            block.message_count = len(day_messages)
+            block.first_timestamp = day_messages[0].timestamp
+            block.last_timestamp = day_messages[-1].timestamp
+            block.save()
+            result['blocks'] += 1
+            result['raw_bytes'] += block.raw_size
+            result['compressed_bytes'] += len(block.data)
+
+        ids = [msg.id for msg in messages]
+        for start in range(0, len(ids), DELETE_BATCH_SIZE):
+            ChatMessage.objects.filter(pk__in=ids[start:start + DELETE_BATCH_SIZE]).delete()
+        result['messages'] = len(ids)
+    return result
+
+
+def compact(days=None, now=None):
+    """
+    days 日より前のメッセージをすべて保管する (ルームごとに1トランザクション)
+    戻り値: compact_room の合計 + 'rooms'
+    """
+    config = get_archive_settings()
+    if days is None:
+        days = config['AFTER_DAYS']
+    cutoff = get_cutoff(days, now)
+    room_ids = list(
+        ChatMessage.objects.filter(timestamp__lt=cutoff).order_by().values_list('room_id', flat=True).distinct()
+    )
+    total = {'rooms': 0, 'messages': 0, 'blocks': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+    for room_id in room_ids:
+        result = compact_room(room_id, cutoff, config['COMPRESSION_LEVEL'])
+        for name, value in result.items():
+            total[name] += value
+        total['rooms'] += 1
+    return total
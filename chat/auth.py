@@ -0,0 +1,105 @@
+"""
+WebSocket 接続時の認証 (channels の AuthMiddlewareStack の代わり)
+
+AuthMiddlewareStack は接続のたびにセッションテーブルとユーザーを読む。
+スマートフォンなどで再接続が続くとそれだけで DB の負荷になるので、
+セッションキー → (ユーザーID, ユーザー名, ロール, 表示名) をキャッシュに TTL 秒だけ覚えておく。
+
+- scope['user'] はキャッシュから作った User (id と username だけ入っている。保存はしないこと)
+- scope['role'] / scope['display_name'] も付ける (ChatConsumer はこれを使う)
+- ログアウトしたら user_logged_out でキャッシュを消す (chat.signals)
+- パスワード変更などで他の端末のセッションが無効になった場合は、TTL が切れるまで接続できる
+  (TTL を短くしているのはそのため)
+- キャッシュのキーにはセッションキーそのものではなくハッシュを使う
+"""
+import hashlib
+from types import SimpleNamespace
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from channels.sessions import CookieMiddleware
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from accounts.roles import ROLE_GUEST, load_cached_role, resolve_role
+from .display_names import resolve_display_name
+
+DEFAULT_WS_AUTH_SETTINGS = {
+    # セッションの確認結果を覚えておく秒数
+    'TTL': 60,
+}
+
+CACHE_KEY = 'chat:ws_auth:{}'
+
+
+def get_ws_auth_settings():
+    return {**DEFAULT_WS_AUTH_SETTINGS, **getattr(settings, 'CHAT_WS_AUTH', {})}
+
+
+def _cache_key(session_key):
+    return CACHE_KEY.format(hashlib.sha256(session_key.encode()).hexdigest())
+
+
+def _load_session(session_key):
+    """ キャッシュに無いときに、セッションとユーザーを DB から読む (AuthMiddleware と同じ確認をする) """
+    engine = import_string(settings.SESSION_ENGINE)
+    session = engine.SessionStore(session_key)
+    user = auth.get_user(SimpleNamespace(session=session))
+    if not user.is_authenticated:
+        return None, None
+
+    # セッションのロールは RoleMiddleware と同じく、プロフィールが残っているか確認してから使う
+    role, _profile = load_cached_role(session, user) or resolve_role(user)
+    entry = {
+        'user_id': user.pk,
+        'username': user.get_username(),
+        'role': role,
+        'display_name': resolve_display_name(user.pk, default=user.get_username()),
+    }
+    return user, entry
+
+
+def resolve_session(session_key):
+    """ セッションキー → (user, role, display_name)。ログインしていなければ (AnonymousUser, ROLE_GUEST, '') """
+    if not session_key:
+        return AnonymousUser(), ROLE_GUEST, ''
+    key = _cache_key(session_key)
+    entry = cache.get(key)
+    if entry is not None:
+        user = User(pk=entry['user_id'], username=entry['username'])
+        return user, entry['role'], entry['display_name']
+
+    user, entry = _load_session(session_key)
+    if entry is None:
+        # ログインしていないセッションは覚えない (ログインするとセッションキーが変わる)
+        return AnonymousUser(), ROLE_GUEST, ''
+    cache.set(key, entry, get_ws_auth_settings()['TTL'])
+    return user, entry['role'], entry['display_name']
+
+
+def forget_session(session_key):
+    if session_key:
+        cache.delete(_cache_key(session_key))
+
+
+class CachedAuthMiddleware(BaseMiddleware):
+    """
+    Cookie のセッションキーから scope['user'] / scope['role'] / scope['display_name'] を設定する
+    CookieMiddleware の内側で使うこと (CachedAuthMiddlewareStack)
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        # 外側で user が設定済み (テストなど) ならそのまま使う
+        if 'user' not in scope:
+            session_key = scope.get('cookies', {}).get(settings.SESSION_COOKIE_NAME)
+            user, role, display_name = await database_sync_to_async(resolve_session)(session_key)
+            scope.update(user=user, role=role, display_name=display_name)
+        return await super().__call__(scope, receive, send)
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(CachedAuthMiddleware(inner))
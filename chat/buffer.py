@@ -0,0 +1,307 @@
+"""
+ChatMessage の書き込みをまとめて行うバッファ (write-behind)
+
+settings.CHAT_WRITE_BEHIND['ENABLED'] が True のとき、ChatConsumer は
+メッセージをすぐにグループへ配信し、保存はこのバッファに任せる。
+バッファは FLUSH_INTERVAL_MS ごと、または MAX_BATCH 件たまったときに
+bulk_create でまとめて書き込む。
+
+- 切断時 (ChatConsumer.disconnect) とプロセス終了時 (atexit) にも書き込む
+- バッチの書き込みに失敗したら1件ずつ書き直す。制約違反 (ルームが削除された等) で書けない行は
+  ログに出して捨て (dead_letters に残す)、それ以外の失敗は RETRY_INTERVAL_MS 後から
+  間隔を倍にしながら MAX_RETRIES 回まで再試行する。1件の不良な行で後のメッセージが止まらないようにするため
+- stats() でバッファの深さや書き込みにかかった時間を確認できる
+- 通し番号 (ChatMessage.seq) は配信前に必要なので、ルームごとに SEQ_BLOCK 個ずつ
+  まとめて払い出しておき、その中から順に使う
+  (チャンネルレイヤーが InMemoryChannelLayer = 1プロセス前提の作り)
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+
+from .models import ChatMessage
+from .services import allocate_seq, update_room_summaries
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WRITE_BEHIND_SETTINGS = {
+    'ENABLED': False,
+    # この間隔 (ミリ秒) でたまった分を書き込む
+    'FLUSH_INTERVAL_MS': 50,
+    # この件数たまったら間隔を待たずに書き込む
+    'MAX_BATCH': 200,
+    # 通し番号をまとめて払い出す個数 (再起動すると使わなかった分は欠番になる)
+    'SEQ_BLOCK': 100,
+    # 書き込みに失敗したメッセージを再試行する回数と、最初の再試行までの間隔 (ミリ秒)
+    'MAX_RETRIES': 5,
+    'RETRY_INTERVAL_MS': 1000,
+}
+
+# 書けずに捨てたメッセージを手元に残しておく件数
+DEAD_LETTER_LIMIT = 1000
+# 再試行の間隔の上限 (秒)
+MAX_RETRY_DELAY = 30.0
+
+
+def get_write_behind_settings():
+    return {**DEFAULT_WRITE_BEHIND_SETTINGS, **getattr(settings, 'CHAT_WRITE_BEHIND', {})}
+
+
+def write_behind_enabled():
+    return get_write_behind_settings()['ENABLED']
+
+
+class MessageBuffer:
+
+    def __init__(self, flush_interval=0.05, max_batch=200, seq_block=100, max_retries=5, retry_interval=1.0):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.seq_block = seq_block
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self._pending = []
+        # id(メッセージ) → 書き込みに失敗した回数
+        self._attempts = {}
+        # 書けずに捨てたメッセージ (新しいものを DEAD_LETTER_LIMIT 件まで)
+        self.dead_letters = deque(maxlen=DEAD_LETTER_LIMIT)
+        # 書き込み中 (まだコミットされていない) のバッチ
+        self._inflight = []
+        self._lock = threading.Lock()
+        # ルームID → [次に使う番号, 払い出し済みの最後の番号]
+        self._seq_ranges = {}
+        self._seq_lock = None
+        self._seq_lock_loop = None
+        self._timer = None
+        self._tasks = set()
+        self._stats = {
+            'max_depth': 0,
+            'flushes': 0,
+            'failed_flushes': 0,
+            'flushed_messages': 0,
+            'retried_messages': 0,
+            'dropped_messages': 0,
+            'total_flush_time': 0.0,
+            'max_flush_time': 0.0,
+            'last_flush_time': 0.0,
+        }
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def _get_seq_lock(self):
+        # asyncio.Lock はイベントループごとに作る
+        loop = asyncio.get_running_loop()
+        if self._seq_lock is None or self._seq_lock_loop is not loop:
+            self._seq_lock = asyncio.Lock()
+            self._seq_lock_loop = loop
+        return self._seq_lock
+
+    async def next_seq(self, room_id):
+        """ ルームの次の通し番号 (手元の番号を使い切ったときだけ DB から払い出す) """
+        async with self._get_seq_lock():
+            current = self._seq_ranges.get(room_id)
+            if current is None or current[0] > current[1]:
+                first = await database_sync_to_async(allocate_seq)(room_id, self.seq_block)
+                current = [first, first + self.seq_block - 1]
+                self._seq_ranges[room_id] = current
+            seq = current[0]
+            current[0] += 1
+        return seq
+
+    def pending_for_room(self, room_id):
+        """ まだ書き込んでいない、あるルームのメッセージ """
+        with self._lock:
+            messages = [msg for batch in self._inflight for msg in batch]
+            messages += self._pending
+        return [msg for msg in messages if msg.room_id == room_id]
+
+    async def add(self, message):
+        """ 保存前の ChatMessage をバッファに入れる """
+        with self._lock:
+            self._pending.append(message)
+            depth = len(self._pending)
+            self._stats['max_depth'] = max(self._stats['max_depth'], depth)
+        if depth >= self.max_batch:
+            await self.flush()
+        else:
+            self._schedule()
+
+    def _schedule(self, delay=None):
+        if self._timer is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(self.flush_interval if delay is None else delay, self._on_timer)
+
+    def _retry_delay(self):
+        attempts = max(self._attempts.values(), default=1)
+        return min(self.retry_interval * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+    def _on_timer(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        # 実行中のタスクが GC されないように持っておく
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _take(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+            if batch:
+                self._inflight.append(batch)
+        return batch
+
+    def _done(self, batch):
+        with self._lock:
+            self._inflight.remove(batch)
+
+    def _requeue(self, batch, retry):
+        """ retry (書けなかった分) をバッファの先頭に戻す。batch は書き込み中から外す """
+        with self._lock:
+            self._inflight.remove(batch)
+            self._pending[:0] = retry
+            self._stats['retried_messages'] += len(retry)
+
+    @staticmethod
+    def _write(batch):
+        with transaction.atomic():
+            ChatMessage.objects.bulk_create(batch)
+            update_room_summaries(batch)
+
+    def _drop(self, message, error):
+        logger.error(
+            'チャットメッセージを保存できないため破棄しました (room=%s author=%s seq=%s): %r',
+            message.room_id, message.author_id, message.seq, error,
+        )
+        self._attempts.pop(id(message), None)
+        with self._lock:
+            self.dead_letters.append(message)
+            self._stats['dropped_messages'] += 1
+
+    def _write_each(self, batch):
+        """
+        バッチで書けなかったときに1件ずつ書き直す
+        戻り値: (書けた件数, 再試行するメッセージのリスト)
+        """
+        written = 0
+        retry = []
+        for index, message in enumerate(batch):
+            try:
+                self._write([message])
+            except (IntegrityError, DataError, ValueError) as e:
+                # 何度書いても同じ結果になる (ValueError は保存前のチェックで弾かれたもの)
+                self._drop(message, e)
+                continue
+            except Exception as e:
+                # DB がロックされているなど。残りもまとめて後で再試行する
+                for pending in batch[index:]:
+                    attempts = self._attempts.get(id(pending), 0) + 1
+                    if attempts > self.max_retries:
+                        self._drop(pending, e)
+                    else:
+                        self._attempts[id(pending)] = attempts
+                        retry.append(pending)
+                break
+            self._attempts.pop(id(message), None)
+            written += 1
+        return written, retry
+
+    def _write_batch(self, batch):
+        """ 戻り値: (書けた件数, 再試行するメッセージのリスト) """
+        try:
+            self._write(batch)
+        except Exception:
+            logger.exception('チャットメッセージ %d 件の書き込みに失敗しました (1件ずつ書き直します)', len(batch))
+            with self._lock:
+                self._stats['failed_flushes'] += 1
+            return self._write_each(batch)
+        for message in batch:
+            self._attempts.pop(id(message), None)
+        return len(batch), []
+
+    def _record(self, count, elapsed):
+        with self._lock:
+            stats = self._stats
+            stats['flushes'] += 1
+            stats['flushed_messages'] += count
+            stats['total_flush_time'] += elapsed
+            stats['max_flush_time'] = max(stats['max_flush_time'], elapsed)
+            stats['last_flush_time'] = elapsed
+
+    async def flush(self):
+        """ たまっている分を書き込む (ChatConsumer から呼ぶ)。戻り値: 書けた件数 """
+        batch = self._take()
+        if not batch:
+            return 0
+        started = time.perf_counter()
+        written, retry = await database_sync_to_async(self._write_batch)(batch)
+        if retry:
+            self._requeue(batch, retry)
+            # 次のメッセージが来なくても再試行する
+            self._schedule(self._retry_delay())
+        else:
+            self._done(batch)
+        self._record(written, time.perf_counter() - started)
+        return written
+
+    def flush_sync(self):
+        """ イベントループの外 (プロセス終了時など) から書き込む。戻り値: 書けた件数 """
+        batch = self._take()
+        if not batch:
+            return 0
+        started = time.perf_counter()
+        written, retry = self._write_batch(batch)
+        if retry:
+            self._requeue(batch, retry)
+        else:
+            self._done(batch)
+        self._record(written, time.perf_counter() - started)
+        return written
+
+    def stats(self):
+        """ バッファの状態 (時間はミリ秒) """
+        with self._lock:
+            stats = dict(self._stats)
+            depth = len(self._pending)
+        flushes = stats['flushes']
+        return {
+            'depth': depth,
+            'max_depth': stats['max_depth'],
+            'flushes': flushes,
+            'failed_flushes': stats['failed_flushes'],
+            'flushed_messages': stats['flushed_messages'],
+            'retried_messages': stats['retried_messages'],
+            'dropped_messages': stats['dropped_messages'],
+            'avg_flush_ms': round(stats['total_flush_time'] / flushes * 1000, 3) if flushes else 0.0,
+            'max_flush_ms': round(stats['max_flush_time'] * 1000, 3),
+            'last_flush_ms': round(stats['last_flush_time'] * 1000, 3),
+        }
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """ プロセスに1つのバッファを返す (初回に作成し、終了時の書き込みを登録する) """
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                config = get_write_behind_settings()
+                _buffer = MessageBuffer(
+                    flush_interval=config['FLUSH_INTERVAL_MS'] / 1000,
+                    max_batch=config['MAX_BATCH'],
+                    seq_block=config['SEQ_BLOCK'],
+                    max_retries=config['MAX_RETRIES'],
+                    retry_interval=config['RETRY_INTERVAL_MS'] / 1000,
+                )
+                atexit.register(_buffer.flush_sync)
+    return _buffer
@@ -1,124 +1,272 @@
 # chat/consumers.py
 
+import asyncio
 import json
-from channels.generic.websocket import WebsocketConsumer
-from asgiref.sync import async_to_sync
-from django.contrib.auth.models import User
-from .models import ChatRoom, ChatMessage
-from accounts.models import Student, Teacher, CompanyRepresentative
-from django.utils import timezone # ★ 1. timezone をインポート
-
-class ChatConsumer(WebsocketConsumer):
-    
- 
-    def get_display_name(self, user):
-        """ ユーザーオブジェクトから、チャット用の表示名を取得する """
-        try:
-            if hasattr(user, 'student'):
-                profile = user.student
-                school_name = profile.school.name if profile.school else "所属未設定"
-                return f"{profile.full_name}（{school_name}）"
-                
-            elif hasattr(user, 'teacher'):
-                profile = user.teacher
-                school_name = profile.school.name if profile.school else "所属未設定"
-                return f"{profile.full_name} 先生（{school_name}）"
-                
-            elif hasattr(user, 'companyrepresentative'):
-                profile = user.companyrepresentative
-                company_name = profile.company.name if profile.company else "所属未設定"
-                return f"{profile.full_name} 様（{company_name}）"
-                
-            elif user.is_superuser:
-                return f"{user.username} (管理者)"
-                
-        except Exception:
-            # (もし school や company が None でエラーになっても)
-            pass 
-            
-        # 例外が発生した場合や、どのプロフィールにも当てはまらない場合は
-        # ユーザーIDをそのまま返す
-        return user.username
-
-
-    def connect(self):
-        # (connect メソッドは変更なし)
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from . import presence, ratelimit, services
+from .buffer import get_buffer, write_behind_enabled
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    非同期版のチャット Consumer
+
+    - 接続時に1回だけ参加者チェックを行い、ルームと送信者の表示名を接続中ずっと使い回す
+    - DB への書き込みは database_sync_to_async 経由 (スレッドを接続ごとに占有しない)
+    - 1つの接続からの受信は1件ずつ順番に処理されるので、
+      同じ人のメッセージは送った順に保存・配信される
+    - メッセージにはルーム内の通し番号 (seq) が付く。再接続したクライアントは
+      {"command": "resume", "after_seq": N} を送ると、N より後の分だけ受け取れる
+    - オンライン状態は接続時にスナップショットを送り、その後は出入りがあったときだけ配信する
+    - 入力中の通知 ({"command": "typing", "is_typing": true}) は何回送られても、
+      同じユーザーの接続 (複数タブ) 全体で TYPING_INTERVAL_MS に1回までにまとめて配信する
+      (間隔はキャッシュで共有する: chat.presence.claim_typing。各接続の最後の状態は必ず届く)
+    - 受信は接続ごと・ユーザーごとのトークンバケットで制限する (chat.ratelimit)。
+      超えたフレームには {"error": ..., "retry_after": 秒} を返す
+    """
+
+    async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
         self.room_group_name = f'chat_{self.room_id}'
-        
-        user = self.scope['user']
-        
-        try:
-            room = ChatRoom.objects.get(id=self.room_id)
-            if user not in room.participants.all():
-                self.close()
-                return
-        except ChatRoom.DoesNotExist:
-            self.close()
+        self.user = self.scope['user']
+
+        self.room = await database_sync_to_async(services.get_member_room)(self.room_id, self.user)
+        if self.room is None:
+            await self.close()
             return
-            
-        async_to_sync(self.channel_layer.group_add)(
+        # CachedAuthMiddleware が表示名も付けてくれる (無ければ取得する)
+        self.display_name = self.scope.get('display_name') or await database_sync_to_async(
+            services.get_sender_display_name
+        )(self.user)
+        self.presence_settings = presence.get_presence_settings()
+        self._typing_state = False
+        self._typing_sent = False
+        self._typing_handle = None
+        self.rate_limit_settings = ratelimit.get_rate_limit_settings()
+        self.connection_bucket = ratelimit.TokenBucket(
+            self.rate_limit_settings['CONNECTION_BURST'], self.rate_limit_settings['CONNECTION_RATE']
+        )
+        # バケットごとの連続超過回数 (接続のバケットが通っても、ユーザーのバケットの超過は数え続ける)
+        self.violations = {}
+        self.rate_limit_closed = False
+
+        await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        self.accept()
+        await self.accept()
+
+        if await sync_to_async(presence.join)(self.room.pk, self.user.pk, self.channel_name):
+            await self.broadcast_presence(True)
+        online = await database_sync_to_async(presence.get_online_users)(self.room)
+        await self.send(text_data=json.dumps({
+            'type': 'presence_snapshot',
+            'users': online,
+            'heartbeat_interval': self.presence_settings['HEARTBEAT_INTERVAL'],
+            'typing_interval_ms': self.presence_settings['TYPING_INTERVAL_MS'],
+        }))
 
-    def disconnect(self, close_code):
-        # (disconnect メソッドは変更なし)
-        async_to_sync(self.channel_layer.group_discard)(
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        if getattr(self, 'room', None) is None:
+            return
+        if self._typing_handle is not None:
+            self._typing_handle.cancel()
+            self._typing_handle = None
+        if self._typing_sent:
+            await self.broadcast_typing(False)
+        if await sync_to_async(presence.leave)(self.room.pk, self.user.pk, self.channel_name):
+            await self.broadcast_presence(False)
+        # write-behind の場合、切断前にたまっている分を書き込んでおく
+        if write_behind_enabled():
+            await get_buffer().flush()
+        # 画面を見ていた間のメッセージは既読にする
+        await database_sync_to_async(services.mark_read)(self.room, self.user)
 
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message_content = text_data_json['message']
-        
-        user = self.scope['user']
-        display_name = self.get_display_name(user)
-        
-        print(f"Room {self.room_id} | User {display_name} | Message: {message_content}")
-
+    async def receive(self, text_data=None, bytes_data=None):
+        if await self.rate_limited(self.connection_bucket, 'rejected_connection'):
+            return
         try:
-            room = ChatRoom.objects.get(id=self.room_id)
-            new_message = ChatMessage.objects.create(
-                room=room,
-                author=user,
-                content=message_content
-            )
-        except:
-            self.send(text_data=json.dumps({'error': 'Message could not be saved.'}))
+            data = json.loads(text_data)
+            if data.get('command') == 'load_older':
+                await self.load_older(data.get('before'), data.get('limit'))
+                return
+            if data.get('command') == 'resume':
+                await self.resume(int(data['after_seq']))
+                return
+            if data.get('command') == 'typing':
+                await self.typing(bool(data.get('is_typing')))
+                return
+            if data.get('command') == 'heartbeat':
+                await self.heartbeat()
+                return
+            message_content = data['message']
+        except (TypeError, ValueError, KeyError, AttributeError):
+            await self.send_error('Invalid message.')
+            return
+        if not isinstance(message_content, str) or not message_content.strip():
+            return
+        user_bucket = ratelimit.get_user_bucket(self.user.pk, self.rate_limit_settings)
+        if await self.rate_limited(user_bucket, 'rejected_user'):
             return
-        
-        # ★ 2. タイムスタンプをローカルタイム（日本時間）に変換
-        local_timestamp = timezone.localtime(new_message.timestamp)
+
+        if write_behind_enabled():
+            # 配信を先に行い、保存はバッファにまとめて任せる
+            buffer = get_buffer()
+            seq = await buffer.next_seq(self.room.pk)
+            new_message = services.build_message(self.room, self.user, message_content, seq)
+            await buffer.add(new_message)
+        else:
+            try:
+                new_message = await database_sync_to_async(services.save_message)(
+                    self.room, self.user, message_content
+                )
+            except Exception:
+                await self.send_error('Message could not be saved.')
+                return
+
         # グループ（同じ部屋にいる全員）にメッセージをブロードキャスト
-        async_to_sync(self.channel_layer.group_send)(
+        await self.channel_layer.group_send(
             self.room_group_name,
-            {
-                'type': 'chat_message', 
-                'message': new_message.content,
-                'author_username': display_name,
-                
-                # ↓↓ この行を追記 ↓↓
-                'author_id': user.id, # ★ JSが「自分」か「相手」か判定するためにIDを送る
-                
-                'timestamp': local_timestamp.strftime('%H:%M')
-            }
+            services.message_event(new_message, self.display_name)
+        )
+        # メッセージが届けば入力中の表示は相手側で消えるので、通知はしない
+        self._typing_state = False
+        self._typing_sent = False
+
+    async def load_older(self, before, limit=None):
+        """ 過去のメッセージを返す (before: 画面上で一番古いメッセージのカーソル) """
+        limit = int(limit or services.HISTORY_PAGE_SIZE)
+        try:
+            messages, next_cursor = await database_sync_to_async(services.get_history)(
+                self.room, before=before, limit=limit
+            )
+        except (TypeError, ValueError, AttributeError):
+            await self.send_error('Invalid cursor.')
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'history',
+            'messages': [services.serialize_message(msg) for msg in messages],
+            'next_cursor': next_cursor,
+        }))
+
+    async def resume(self, after_seq):
+        """ 再接続時に、取りこぼしたメッセージ (通し番号が after_seq より後) だけを送る """
+        pending = get_buffer().pending_for_room(self.room.pk) if write_behind_enabled() else ()
+        messages = await database_sync_to_async(services.get_missed_messages)(
+            self.room, after_seq, pending
         )
+        if messages is None:
+            # 取りこぼしが多すぎる場合は、画面を読み込み直してもらう
+            await self.send(text_data=json.dumps({'type': 'resume', 'reload': True}))
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'resume',
+            'messages': [services.serialize_message(msg) for msg in messages],
+        }))
+
+    # ==================================
+    # オンライン状態・入力中
+    # ==================================
+
+    async def heartbeat(self):
+        """ オンライン状態の期限を延ばす (期限切れで消えていたら、改めてオンラインを配信する) """
+        if await sync_to_async(presence.join)(self.room.pk, self.user.pk, self.channel_name):
+            await self.broadcast_presence(True)
+
+    async def typing(self, is_typing):
+        """ 入力中の状態を受け取る。このユーザーの前回の配信から間隔が空いていなければ、間隔が空いた時点で最後の状態を配信する """
+        self._typing_state = is_typing
+        if self._typing_handle is not None:
+            return
+        await self.flush_typing()
+
+    def _on_typing_timer(self):
+        self._typing_handle = None
+        # 実行中のタスクが GC されないように持っておく
+        self._typing_task = asyncio.ensure_future(self.flush_typing())
+
+    async def flush_typing(self):
+        # 入力をやめた状態は、入力中を配信していたときだけ送る
+        if not self._typing_state and not self._typing_sent:
+            return
+        wait = await sync_to_async(presence.claim_typing)(self.room.pk, self.user.pk)
+        if wait > 0:
+            self._typing_handle = asyncio.get_running_loop().call_later(wait, self._on_typing_timer)
+            return
+        await self.broadcast_typing(self._typing_state)
+
+    async def broadcast_typing(self, is_typing):
+        self._typing_sent = is_typing
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'chat_typing',
+            'user_id': self.user.pk,
+            'display_name': self.display_name,
+            'is_typing': is_typing,
+        })
+
+    async def broadcast_presence(self, online):
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'chat_presence',
+            'user_id': self.user.pk,
+            'display_name': self.display_name,
+            'online': online,
+        })
+
+    async def chat_typing(self, event):
+        if event['user_id'] == self.user.pk:
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'typing',
+            'user_id': event['user_id'],
+            'display_name': event['display_name'],
+            'is_typing': event['is_typing'],
+        }))
+
+    async def chat_presence(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'presence',
+            'user_id': event['user_id'],
+            'display_name': event['display_name'],
+            'online': event['online'],
+        }))
+
+    async def rate_limited(self, bucket, reason):
+        """
+        バケットのトークンが足りなければエラーを返して True (超過が続く接続は切断する)
+        reason: ratelimit.record に渡す名前。連続超過の回数もこの名前ごとに数える
+        """
+        config = self.rate_limit_settings
+        if self.rate_limit_closed:
+            # 切断済み (届いてしまった残りのフレームは捨てる)
+            return True
+        if not config['ENABLED'] or bucket.consume():
+            self.violations[reason] = 0
+            return False
+        ratelimit.record(reason)
+        self.violations[reason] = violations = self.violations.get(reason, 0) + 1
+        if config['MAX_VIOLATIONS'] and violations >= config['MAX_VIOLATIONS']:
+            ratelimit.record('disconnected')
+            self.rate_limit_closed = True
+            await self.close(code=4008)
+            return True
+        await self.send_error('Rate limit exceeded.', retry_after=round(bucket.retry_after(), 2))
+        return True
+
+    async def send_error(self, error, **extra):
+        await self.send(text_data=json.dumps({'error': error, **extra}))
 
     # ブロードキャストされたメッセージを個々のWebSocketに送信する処理
-    def chat_message(self, event):
-        message = event['message']
-        author_username = event['author_username']
-        timestamp = event['timestamp']
-        
-        # ↓↓ この行を追記 ↓↓
-        author_id = event['author_id'] # ★ author_id もJSに渡す
-
-        self.send(text_data=json.dumps({
-            'message': message,
-            'author_username': author_username,
-            'author_id': author_id, # ★ 追記
-            'timestamp': timestamp,
-        }))
\ No newline at end of file
+    async def chat_message(self, event):
+        await self.send(text_data=json.dumps({
+            'message': event['message'],
+            'author_username': event['author_username'],
+            'author_id': event['author_id'], # ★ JSが「自分」か「相手」か判定するためにIDを送る
+            'timestamp': event['timestamp'],
+            'seq': event['seq'],
+        }))
@@ -0,0 +1,74 @@
+"""
+チャットで使う表示名 (「氏名（学校名）」など) の取得
+
+- resolve_display_names(ユーザーIDの集合) で、何人分でも SQL 1本で計算する
+- 計算結果は Django のキャッシュに入れ、プロフィール・学校・企業が変わったら
+  chat.signals から invalidate_display_names で消す
+  (キャッシュはプロセスごとの LocMemCache なので、複数プロセスで動かす場合は
+   settings.CACHES に共有のキャッシュを設定すること)
+"""
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from accounts.roles import PROFILE_SELECT_RELATED
+
+CACHE_KEY = 'chat:display_name:{}'
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def format_display_name(user):
+    """
+    ユーザーオブジェクトから、チャット用の表示名を作る
+    (プロフィールは PROFILE_SELECT_RELATED で取得済みであること。そうでないと SQL が走る)
+    """
+    try:
+        if hasattr(user, 'student'):
+            profile = user.student
+            school_name = profile.school.name if profile.school else "所属未設定"
+            return f"{profile.full_name}（{school_name}）"
+
+        elif hasattr(user, 'teacher'):
+            profile = user.teacher
+            school_name = profile.school.name if profile.school else "所属未設定"
+            return f"{profile.full_name} 先生（{school_name}）"
+
+        elif hasattr(user, 'companyrepresentative'):
+            profile = user.companyrepresentative
+            company_name = profile.company.name if profile.company else "所属未設定"
+            return f"{profile.full_name} 様（{company_name}）"
+
+        elif user.is_superuser:
+            return f"{user.username} (管理者)"
+
+    except Exception:
+        # (もし school や company が None でエラーになっても)
+        pass
+
+    # 例外が発生した場合や、どのプロフィールにも当てはまらない場合は
+    # ユーザー名をそのまま返す
+    return user.username
+
+
+def resolve_display_names(user_ids):
+    """ {ユーザーID: 表示名} を返す (存在しないユーザーは含まれない) """
+    keys = {user_id: CACHE_KEY.format(user_id) for user_id in set(user_ids) if user_id is not None}
+    if not keys:
+        return {}
+    cached = cache.get_many(keys.values())
+    names = {user_id: cached[key] for user_id, key in keys.items() if key in cached}
+
+    missing = [user_id for user_id in keys if user_id not in names]
+    if missing:
+        users = User.objects.filter(pk__in=missing).select_related(*PROFILE_SELECT_RELATED)
+        fresh = {user.pk: format_display_name(user) for user in users}
+        cache.set_many({keys[user_id]: name for user_id, name in fresh.items()}, CACHE_TIMEOUT)
+        names.update(fresh)
+    return names
+
+
+def resolve_display_name(user_id, default=''):
+    return resolve_display_names([user_id]).get(user_id, default)
+
+
+def invalidate_display_names(user_ids):
+    cache.delete_many([CACHE_KEY.format(user_id) for user_id in set(user_ids)])
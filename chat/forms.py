@@ -0,0 +1,54 @@
+from django import forms
+from django.contrib.auth.models import User
+
+from accounts.models import Student
+from accounts.roles import ROLE_TEACHER
+from .display_names import resolve_display_names
+
+
+def get_group_candidates(user, role, profile):
+    """
+    グループに招待できるユーザー
+    - これまでにチャットしたことのある相手
+    - 教員の場合は、同じ学校の学生 (クラス全体のグループ用)
+    """
+    candidate_ids = set(
+        User.objects.filter(chat_rooms__participants=user).exclude(pk=user.pk).values_list('pk', flat=True)
+    )
+    if role == ROLE_TEACHER and profile is not None and profile.school_id:
+        candidate_ids.update(Student.objects.filter(school_id=profile.school_id).values_list('user_id', flat=True))
+    return User.objects.filter(pk__in=candidate_ids).order_by('pk')
+
+
+class MemberChoiceField(forms.ModelMultipleChoiceField):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.display_names = {}
+
+    def label_from_instance(self, obj):
+        return self.display_names.get(obj.pk, obj.username)
+
+
+# グループチャット作成フォーム
+class GroupRoomForm(forms.Form):
+    name = forms.CharField(max_length=100, label="グループ名")
+    members = MemberChoiceField(
+        queryset=User.objects.none(),
+        label="参加者",
+        widget=forms.CheckboxSelectMultiple,
+    )
+
+    def __init__(self, *args, candidates=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if candidates is not None:
+            field = self.fields['members']
+            field.queryset = candidates
+            # ★ 候補者の表示名はまとめて1回で取得
+            field.display_names = resolve_display_names(candidates.values_list('pk', flat=True))
+
+    def clean_members(self):
+        members = self.cleaned_data['members']
+        if len(members) < 2:
+            raise forms.ValidationError("グループには自分以外に2人以上を選んでください。")
+        return members
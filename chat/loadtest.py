@@ -0,0 +1,164 @@
+"""
+チャットの負荷試験 (chat_loadtest コマンドから使う)
+
+channels の WebsocketCommunicator で ChatConsumer に直接つなぐクライアントを
+ルーム数 × 1ルームの人数 だけ作り、全員が決まった間隔でメッセージを送る。
+メッセージ本文に送信時刻を入れておき、同じルームの全員 (送信者を含む) に
+届くまでの時間を配信の遅延として集計する。
+
+- 1つのイベントループの中で全クライアントと ChatConsumer が動くので、
+  daphne のワーカー1つが受け持てる量の目安になる (ネットワークと認証のコストは含まない)
+- DB はテスト用のものを使う (開発用の DB は変更しない)
+"""
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from core.benchmarks import percentile
+from .buffer import get_buffer, write_behind_enabled
+from .models import ChatRoom, ChatMessage, ChatReadState
+from .routing import websocket_urlpatterns
+
+MESSAGE_PREFIX = 'loadtest'
+
+
+def create_rooms(rooms, clients_per_room, prefix='loadtest'):
+    """ 負荷試験用のユーザーとルームを作る。戻り値: [(ルーム, [ユーザー, ...]), ...] """
+    users = User.objects.bulk_create([
+        User(username=f'{prefix}{i}') for i in range(rooms * clients_per_room)
+    ])
+    # SQLite では bulk_create で ID が返らないので取り直す
+    users = list(User.objects.filter(username__startswith=prefix).order_by('pk'))
+    now = timezone.now()
+    result = []
+    for i in range(rooms):
+        members = users[i * clients_per_room:(i + 1) * clients_per_room]
+        room = ChatRoom.objects.create()
+        room.participants.add(*members)
+        ChatReadState.objects.bulk_create([
+            ChatReadState(room=room, user=user, last_read_at=now) for user in members
+        ])
+        result.append((room, members))
+    return result
+
+
+class LoadTestClient:
+
+    def __init__(self, app, room, user, index):
+        self.room = room
+        self.user = user
+        self.index = index
+        self.communicator = WebsocketCommunicator(app, f'/ws/chat/room/{room.pk}/')
+        self.communicator.scope['user'] = user
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.latencies = []
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        return connected
+
+    async def send_loop(self, interval, deadline):
+        # 全員が同時に送らないように、開始をずらす
+        await asyncio.sleep(interval * (self.index % 10) / 10)
+        while time.perf_counter() < deadline:
+            content = f'{MESSAGE_PREFIX}:{self.index}:{time.perf_counter()!r}'
+            await self.communicator.send_to(text_data=json.dumps({'message': content}))
+            self.sent += 1
+            await asyncio.sleep(interval)
+
+    async def receive_loop(self):
+        while True:
+            output = await self.communicator.receive_output(timeout=3600)
+            if output['type'] != 'websocket.send':
+                # 切断された
+                self.errors += 1
+                return
+            data = json.loads(output['text'])
+            if 'error' in data:
+                self.errors += 1
+            elif 'message' in data and data['message'].startswith(MESSAGE_PREFIX):
+                sent_at = float(data['message'].rsplit(':', 1)[1])
+                self.latencies.append(time.perf_counter() - sent_at)
+                self.received += 1
+
+    async def disconnect(self):
+        await self.communicator.disconnect()
+
+
+async def run_load_test(rooms, duration=10.0, rate=1.0, drain_timeout=5.0):
+    """
+    負荷試験を実行する
+    rooms: create_rooms の戻り値 / rate: 1クライアントが1秒に送るメッセージ数
+    """
+    app = URLRouter(websocket_urlpatterns)
+    clients = [
+        LoadTestClient(app, room, user, index)
+        for room, members in rooms
+        for index, user in enumerate(members)
+    ]
+    count_messages = sync_to_async(ChatMessage.objects.count, thread_sensitive=True)
+    messages_before = await count_messages()
+
+    connect_started = time.perf_counter()
+    connected = await asyncio.gather(*(client.connect() for client in clients))
+    connect_time = time.perf_counter() - connect_started
+    active = [client for client, ok in zip(clients, connected) if ok]
+    receivers = [asyncio.ensure_future(client.receive_loop()) for client in active]
+
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(client.send_loop(1 / rate, deadline) for client in active))
+    send_time = time.perf_counter() - started
+
+    # 送った分が全員に届くまで待つ
+    members = {room.pk: len(users) for room, users in rooms}
+    expected = sum(client.sent * members[client.room.pk] for client in active)
+    drain_deadline = time.perf_counter() + drain_timeout
+    while sum(client.received for client in active) < expected and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+    # 切断時に write-behind の残りも書き込まれる
+    await asyncio.gather(*(client.disconnect() for client in active), return_exceptions=True)
+    if write_behind_enabled():
+        await get_buffer().flush()
+    write_time = time.perf_counter() - started
+    inserted = await count_messages() - messages_before
+
+    sent = sum(client.sent for client in active)
+    delivered = sum(client.received for client in active)
+    latencies = [value for client in active for value in client.latencies]
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'clients': len(clients),
+        'connect_failures': len(clients) - len(active),
+        'connect_ms': ms(connect_time),
+        'sent': sent,
+        'expected_deliveries': expected,
+        'delivered': delivered,
+        'lost': expected - delivered,
+        'errors': sum(client.errors for client in active),
+        'sent_per_sec': round(sent / send_time, 1),
+        'delivered_per_sec': round(delivered / elapsed, 1),
+        'inserted': inserted,
+        'inserts_per_sec': round(inserted / write_time, 1),
+        'latency_p50_ms': ms(percentile(latencies, 50)),
+        'latency_p90_ms': ms(percentile(latencies, 90)),
+        'latency_p99_ms': ms(percentile(latencies, 99)),
+        'latency_max_ms': ms(max(latencies) if latencies else None),
+        'write_behind': get_buffer().stats() if write_behind_enabled() else None,
+    }
@@ -0,0 +1,96 @@
+import asyncio
+import importlib.util
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from chat.loadtest import create_rooms, run_load_test
+
+
+class Command(BaseCommand):
+    help = (
+        'チャット (ChatConsumer) の負荷試験を実行します。'
+        'ルーム数 × 人数 のクライアントが決まった間隔でメッセージを送り、配信の遅延・件数・DB への書き込み件数を集計します。'
+        'テスト用の DB を使うので、開発用の DB は変更されません。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=50, help='ルーム数')
+        parser.add_argument('--clients-per-room', type=int, default=2, help='1ルームあたりの接続数')
+        parser.add_argument('--rate', type=float, default=1.0, help='1クライアントが1秒に送るメッセージ数')
+        parser.add_argument('--duration', type=float, default=10.0, help='送信を続ける秒数')
+        parser.add_argument('--write-behind', action='store_true', help='書き込みをまとめる (CHAT_WRITE_BEHIND) を有効にする')
+        parser.add_argument('--rate-limit', action='store_true', help='レート制限 (CHAT_RATE_LIMIT) を有効のままにする')
+        parser.add_argument(
+            '--redis', metavar='URL',
+            help=(
+                'settings の CHANNEL_LAYERS の代わりに、Redis 互換のサーバー (例: redis://127.0.0.1:6379) を '
+                'channels_redis (requirements.txt の channels-redis) で使う'
+            ),
+        )
+        parser.add_argument('--output', help='結果を JSON で書き出すファイル')
+
+    def handle(self, *args, **options):
+        if options['rooms'] < 1 or options['clients_per_room'] < 1 or options['rate'] <= 0:
+            raise CommandError('--rooms / --clients-per-room / --rate には正の値を指定してください。')
+
+        overrides = {
+            'QUERY_BUDGET': {'ENABLED': False},
+            'CHAT_WRITE_BEHIND': {'ENABLED': options['write_behind']},
+        }
+        if not options['rate_limit']:
+            overrides['CHAT_RATE_LIMIT'] = {'ENABLED': False}
+        if options['redis']:
+            if importlib.util.find_spec('channels_redis') is None:
+                raise CommandError(
+                    '--redis には channels_redis が必要です。pip install -r requirements.txt でインストールしてください。'
+                )
+            overrides['CHANNEL_LAYERS'] = {
+                'default': {
+                    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                    'CONFIG': {'hosts': [options['redis']]},
+                },
+            }
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(**overrides):
+                layer = settings.CHANNEL_LAYERS['default']['BACKEND'].rsplit('.', 1)[-1]
+                rooms = create_rooms(options['rooms'], options['clients_per_room'])
+                self.stdout.write(
+                    f"ルーム {options['rooms']} × {options['clients_per_room']} 人、"
+                    f"{options['rate']} 件/秒/人 を {options['duration']} 秒 (チャンネルレイヤー: {layer})"
+                )
+                result = asyncio.run(run_load_test(rooms, duration=options['duration'], rate=options['rate']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(
+            f"送信 {result['sent']} 件 ({result['sent_per_sec']}/秒)  "
+            f"配信 {result['delivered']}/{result['expected_deliveries']} 件 ({result['delivered_per_sec']}/秒)  "
+            f"DB 書き込み {result['inserted']} 件 ({result['inserts_per_sec']}/秒)"
+        )
+        self.stdout.write(
+            f"遅延 p50 {result['latency_p50_ms']}ms  p90 {result['latency_p90_ms']}ms  "
+            f"p99 {result['latency_p99_ms']}ms  max {result['latency_max_ms']}ms"
+        )
+        if result['write_behind']:
+            self.stdout.write(f"write-behind: {result['write_behind']}")
+        problems = result['connect_failures'] + result['lost'] + result['errors']
+        style = self.style.WARNING if problems else self.style.SUCCESS
+        self.stdout.write(style(
+            f"接続失敗 {result['connect_failures']}  未着 {result['lost']}  エラー {result['errors']}"
+        ))
+
+        if options['output']:
+            report = {'options': {name: options[name] for name in (
+                'rooms', 'clients_per_room', 'rate', 'duration', 'write_behind', 'rate_limit',
+            )}, 'channel_layer': layer, 'result': result}
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"結果を {options['output']} に書き出しました。")
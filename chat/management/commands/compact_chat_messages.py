@@ -0,0 +1,66 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chat.archive import compact, get_archive_settings, get_cutoff
+from chat.models import ChatMessage
+
+
+class Command(BaseCommand):
+    help = (
+        '古いチャットメッセージを、ルーム・日ごとに圧縮したブロック (ChatArchiveBlock) に移します。'
+        '移したメッセージも履歴のページ送りでこれまで通り読めます。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help='この日数より前のメッセージを移す (省略時は settings.CHAT_ARCHIVE の AFTER_DAYS)',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='移す件数を表示するだけで、変更しない')
+        parser.add_argument('--vacuum', action='store_true', help='移した後に VACUUM して DB ファイルを小さくする (SQLite)')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else get_archive_settings()['AFTER_DAYS']
+        if days < 1:
+            raise CommandError('--days には1以上を指定してください。')
+        cutoff = get_cutoff(days)
+
+        if options['dry_run']:
+            count = ChatMessage.objects.filter(timestamp__lt=cutoff).count()
+            self.stdout.write(f'{cutoff:%Y-%m-%d} より前のメッセージ {count} 件が対象です。')
+            return
+
+        size_before = self.database_size()
+        started = time.perf_counter()
+        result = compact(days)
+        elapsed = time.perf_counter() - started
+
+        ratio = result['compressed_bytes'] / result['raw_bytes'] * 100 if result['raw_bytes'] else 0
+        self.stdout.write(
+            f"{cutoff:%Y-%m-%d} より前のメッセージ {result['messages']} 件を "
+            f"{result['rooms']} ルーム・{result['blocks']} ブロックに移しました ({elapsed:.1f} 秒)。"
+        )
+        self.stdout.write(
+            f"本文など {result['raw_bytes']:,} バイト → 圧縮後 {result['compressed_bytes']:,} バイト ({ratio:.1f}%)"
+        )
+
+        if options['vacuum']:
+            if connection.vendor != 'sqlite':
+                raise CommandError('--vacuum は SQLite のときだけ使えます。')
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+        size_after = self.database_size()
+        if size_before is not None:
+            self.stdout.write(f'DB ファイル: {size_before:,} バイト → {size_after:,} バイト')
+
+    def database_size(self):
+        """ SQLite の DB ファイルのサイズ (それ以外の DB では None) """
+        if connection.vendor != 'sqlite':
+            return None
+        name = connection.settings_dict['NAME']
+        if not os.path.exists(str(name)):
+            return None
+        return os.path.getsize(name)
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:37
+
+from django.db import migrations, models
+
+
+def fill_pair_keys(apps, schema_editor):
+    # 参加者がちょうど2人のルームに pair_key を入れる
+    # 同じ組み合わせのルームが複数ある場合は、これまで使われていた一番古いルームに付ける
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Participant = ChatRoom.participants.through
+
+    members = {}
+    for room_id, user_id in Participant.objects.order_by('chatroom_id', 'user_id').values_list('chatroom_id', 'user_id'):
+        members.setdefault(room_id, []).append(user_id)
+
+    used_keys = set()
+    rooms = []
+    for room_id in sorted(members):
+        user_ids = members[room_id]
+        if len(user_ids) != 2:
+            continue
+        key = f"{user_ids[0]}:{user_ids[1]}"
+        if key in used_keys:
+            continue
+        used_keys.add(key)
+        rooms.append(ChatRoom(id=room_id, pair_key=key))
+    ChatRoom.objects.bulk_update(rooms, ['pair_key'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatmessage_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='pair_key',
+            field=models.CharField(blank=True, editable=False, max_length=41, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_pair_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatroom_pair_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chatmessage_room_history'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+from django.utils import timezone
+
+
+def fill_inbox_summary(apps, schema_editor):
+    # 最後のメッセージを ChatRoom に写す (UPDATE 1本)
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    ChatReadState = apps.get_model('chat', 'ChatReadState')
+
+    latest = ChatMessage.objects.filter(room=OuterRef('pk')).order_by('-timestamp', '-id')
+    ChatRoom.objects.update(
+        last_message_at=Subquery(latest.values('timestamp')[:1]),
+        last_message_preview=Coalesce(
+            Subquery(latest.annotate(preview=Substr('content', 1, 100)).values('preview')[:1]),
+            Value(''),
+        ),
+        last_author=Subquery(latest.values('author_id')[:1]),
+    )
+
+    # これまでの既読は記録していないので、既存のメッセージはすべて既読として扱う
+    now = timezone.now()
+    Participant = ChatRoom.participants.through
+    ChatReadState.objects.bulk_create(
+        [
+            ChatReadState(room_id=room_id, user_id=user_id, unread_count=0, last_read_at=now)
+            for room_id, user_id in Participant.objects.values_list('chatroom_id', 'user_id').iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0005_chatmessage_room_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_author',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.CreateModel(
+            name='ChatReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('last_read_at', models.DateTimeField(blank=True, null=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'チャット既読状態',
+                'verbose_name_plural': 'チャット既読状態',
+                'unique_together': {('room', 'user')},
+            },
+        ),
+        migrations.RunPython(fill_inbox_summary, migrations.RunPython.noop),
+    ]
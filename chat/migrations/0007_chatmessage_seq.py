@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:43
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_seq(apps, schema_editor):
+    # 既存のメッセージに、ルームごとに (timestamp, id) の順で 1, 2, 3... を振る
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+
+    batch = []
+    current_room, seq = None, 0
+    rows = list(ChatMessage.objects.order_by('room_id', 'timestamp', 'id').values_list('id', 'room_id'))
+    for message_id, room_id in rows:
+        if room_id != current_room:
+            current_room, seq = room_id, 0
+        seq += 1
+        batch.append(ChatMessage(id=message_id, seq=seq))
+        if len(batch) >= 2000:
+            ChatMessage.objects.bulk_update(batch, ['seq'])
+            batch = []
+    if batch:
+        ChatMessage.objects.bulk_update(batch, ['seq'])
+
+    max_seq = ChatMessage.objects.filter(room=OuterRef('pk')).values('room').annotate(m=Max('seq')).values('m')
+    ChatRoom.objects.update(last_seq=Coalesce(Subquery(max_seq), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chat_inbox_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chatmessage_room_seq'),
+        ),
+        migrations.RunPython(fill_seq, migrations.RunPython.noop),
+    ]
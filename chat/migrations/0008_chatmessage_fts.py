@@ -0,0 +1,91 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:02
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+FTS_TABLE = 'chat_chatmessage_fts'
+BATCH_SIZE = 2000
+
+# chat.tokenizer.bigram_text のこの時点の写し (後で chat.tokenizer を変えても、このマイグレーションは変わらない)
+_WORD_RE = re.compile(r'[0-9a-z_]+|[^\W0-9a-z_]+')
+
+
+def bigram_text(text):
+    tokens = []
+    for run in _WORD_RE.findall(unicodedata.normalize('NFKC', text or '').lower()):
+        if run.isascii():
+            tokens.append(run)
+            continue
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return ' '.join(tokens)
+
+
+def fill_search_text(apps, schema_editor):
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    batch = []
+    for message in ChatMessage.objects.only('id', 'content').iterator(chunk_size=BATCH_SIZE):
+        message.search_text = bigram_text(message.content)
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            ChatMessage.objects.bulk_update(batch, ['search_text'])
+            batch = []
+    ChatMessage.objects.bulk_update(batch, ['search_text'])
+
+
+def create_fts(apps, schema_editor):
+    # FTS5 は SQLite だけ (他の DB では LIKE で検索する)
+    # トリガーは search_text をそのまま入れるだけなので、SQLite の標準の機能しか使わない
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    statements = [
+        f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+            search_text, content='chat_chatmessage', content_rowid='id', tokenize='unicode61'
+        )""",
+        f"""CREATE TRIGGER chat_chatmessage_fts_insert AFTER INSERT ON chat_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, search_text) VALUES (new.id, new.search_text);
+        END""",
+        f"""CREATE TRIGGER chat_chatmessage_fts_delete AFTER DELETE ON chat_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_text) VALUES ('delete', old.id, old.search_text);
+        END""",
+        f"""CREATE TRIGGER chat_chatmessage_fts_update AFTER UPDATE OF search_text ON chat_chatmessage BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_text) VALUES ('delete', old.id, old.search_text);
+            INSERT INTO {FTS_TABLE}(rowid, search_text) VALUES (new.id, new.search_text);
+        END""",
+        # 既存のメッセージの分を search_text から作る
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+    ]
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def drop_fts(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for trigger in ('insert', 'delete', 'update'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS chat_chatmessage_fts_{trigger}')
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatmessage_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+        # 戻すときは索引を消すだけ (0007 の時点の検索は LIKE で行われる)
+        migrations.RunPython(create_fts, drop_fts),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_chatmessage_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatArchiveBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('raw_size', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_blocks', to='chat.chatroom')),
+            ],
+            options={
+                'verbose_name': 'チャット保管ブロック',
+                'verbose_name_plural': 'チャット保管ブロック',
+                'unique_together': {('room', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_chatarchiveblock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='is_group',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='name',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
@@ -1,27 +1,206 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .tokenizer import bigram_text
+
+
+def make_pair_key(user_a, user_b):
+    """ 1対1ルームの参加者の組み合わせを表すキー ("小さいID:大きいID") """
+    ids = sorted(getattr(u, 'pk', u) for u in (user_a, user_b))
+    return f"{ids[0]}:{ids[1]}"
+
+
+def prefetch_legacy_participants(rooms):
+    """ ルームのうち pair_key の無い1対1ルームだけ、参加者をまとめて読み込む (other_user_id 用、対象が無ければ SQL なし) """
+    models.prefetch_related_objects(
+        [room for room in rooms if not room.pair_key and not room.is_group], 'participants'
+    )
+
+
+class ChatRoomManager(models.Manager):
+
+    def find_direct(self, user, *others):
+        """
+        user と others の誰かとの1対1ルームを返す (無ければ None)
+        pair_key のユニークインデックスを引くだけなので、参加者テーブルは見ない
+        """
+        keys = [make_pair_key(user, other) for other in others]
+        if not keys:
+            return None
+        return self.filter(pair_key__in=keys).order_by('pk').first()
+
+    def get_or_create_direct(self, user, other):
+        """ 1対1ルームを取得、無ければ作成する。戻り値: (room, created) """
+        key = make_pair_key(user, other)
+        room = self.filter(pair_key=key).first()
+        if room is not None:
+            return room, False
+        try:
+            with transaction.atomic():
+                room = self.create(pair_key=key)
+                room.participants.add(user, other)
+                ChatReadState.objects.bulk_create([
+                    ChatReadState(room=room, user_id=getattr(u, 'pk', u)) for u in {user, other}
+                ])
+        except IntegrityError:
+            # 同時に作成された場合は、先に作られた方を使う
+            return self.get(pair_key=key), False
+        return room, True
+
+    def create_group(self, creator, name, members):
+        """ グループルームを作成する (作成者も参加者になる) """
+        user_ids = {getattr(u, 'pk', u) for u in members} | {creator.pk}
+        with transaction.atomic():
+            room = self.create(name=name, is_group=True)
+            room.participants.add(*user_ids)
+            ChatReadState.objects.bulk_create([
+                ChatReadState(room=room, user_id=user_id) for user_id in user_ids
+            ])
+        return room
+
+    def sync_members(self, room):
+        """
+        参加者を上の2つを通さずに変えたとき (管理画面) に、pair_key と ChatReadState を参加者に合わせる
+        (1対1ルームの参加者が2人であることや pair_key の重複は、呼ぶ前に確認しておくこと)
+        """
+        member_ids = set(room.participants.values_list('pk', flat=True))
+        pair_key = make_pair_key(*member_ids) if not room.is_group and len(member_ids) == 2 else None
+        with transaction.atomic():
+            if room.pair_key != pair_key:
+                room.pair_key = pair_key
+                room.save(update_fields=['pair_key'])
+            ChatReadState.objects.filter(room=room).exclude(user_id__in=member_ids).delete()
+            existing = set(ChatReadState.objects.filter(room=room).values_list('user_id', flat=True))
+            ChatReadState.objects.bulk_create([
+                ChatReadState(room=room, user_id=user_id) for user_id in member_ids - existing
+            ])
+
 
 class ChatRoom(models.Model):
     participants = models.ManyToManyField(User, related_name='chat_rooms')
     created_at = models.DateTimeField(auto_now_add=True)
+    # 1対1ルームの参加者の組み合わせ (make_pair_key)。同じ組み合わせのルームは1つだけ
+    pair_key = models.CharField(max_length=41, unique=True, null=True, blank=True, editable=False)
+    # グループルーム (3人以上・クラス全体など)。pair_key は持たない
+    is_group = models.BooleanField(default=False)
+    name = models.CharField(max_length=100, blank=True, default='')
+
+    # 受信箱用に最後のメッセージを持っておく (chat.services.update_room_summaries で更新)
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_message_preview = models.CharField(max_length=100, blank=True, default='')
+    last_author = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # 最後に払い出したメッセージの通し番号 (ChatMessage.seq)
+    last_seq = models.PositiveBigIntegerField(default=0, editable=False)
+
+    objects = ChatRoomManager()
+
+    def other_user_id(self, user_id):
+        """
+        1対1ルームの相手のユーザーID (pair_key から求めるので SQL は発行しない)
+        pair_key の無い古いルーム (0004 で重複していた組み合わせや、参加者が2人でないもの) は
+        参加者から求める (prefetch_legacy_participants で先に読み込んでおく)。相手が複数いれば ID の小さい人
+        グループルームは None
+        """
+        if self.is_group:
+            return None
+        if not self.pair_key:
+            others = sorted(u.pk for u in self.participants.all() if u.pk != user_id)
+            return others[0] if others else None
+        low, high = (int(v) for v in self.pair_key.split(':'))
+        return high if low == user_id else low
 
     def __str__(self):
-        users = self.participants.all()
-        return f"Room for {users[0].username} and {users[1].username}" if users.count() == 2 else f"Room {self.pk}"
+        if self.is_group:
+            return self.name or f"Group room {self.pk}"
+        users = list(self.participants.all()[:2])
+        return f"Room for {users[0].username} and {users[1].username}" if len(users) == 2 else f"Room {self.pk}"
 
     class Meta:
         verbose_name = "チャットルーム"
         verbose_name_plural = "チャットルーム"
 
+class ChatMessageQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create は save() を通らないので、ここで検索用の文字列を作る
+        objs = list(objs)
+        for obj in objs:
+            obj.fill_search_text()
+        return super().bulk_create(objs, *args, **kwargs)
+
+
 class ChatMessage(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages')
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # auto_now_add だと bulk_create で日時を指定できないため default にしている
+    timestamp = models.DateTimeField(default=timezone.now)
+    # ルーム内の通し番号 (再接続時に「どこまで受け取ったか」を伝えるのに使う)
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    # 全文検索の索引に入れる、本文を2文字ずつに区切った文字列 (chat.tokenizer.bigram_text)
+    search_text = models.TextField(blank=True, default='', editable=False)
+
+    objects = ChatMessageQuerySet.as_manager()
+
+    def fill_search_text(self):
+        self.search_text = bigram_text(self.content)
+
+    def save(self, *args, **kwargs):
+        self.fill_search_text()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'content' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'search_text'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.author.username}: {self.content[:20]}..."
 
     class Meta:
         verbose_name = "チャットメッセージ"
-        verbose_name_plural = "チャットメッセージ"
\ No newline at end of file
+        verbose_name_plural = "チャットメッセージ"
+        indexes = [
+            # 履歴のページ送り (ルーム内を timestamp, id の順にたどる) 用
+            models.Index(fields=['room', 'timestamp', 'id'], name='chatmessage_room_history'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='chatmessage_room_seq'),
+        ]
+
+
+# 参加者ごとの既読状態
+class ChatReadState(models.Model):
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chat_read_states')
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.user} - Room {self.room_id}: 未読 {self.unread_count}"
+
+    class Meta:
+        unique_together = ('room', 'user')
+        verbose_name = "チャット既読状態"
+        verbose_name_plural = "チャット既読状態"
+
+
+# 古いメッセージの保管庫 (chat.archive)
+# ルーム・日ごとに、メッセージを JSON にして zlib で圧縮したものを1行で持つ
+class ChatArchiveBlock(models.Model):
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archive_blocks')
+    day = models.DateField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    # 圧縮前のバイト数 (圧縮率の確認用)
+    raw_size = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Room {self.room_id} - {self.day} ({self.message_count}件)"
+
+    class Meta:
+        unique_together = ('room', 'day')
+        verbose_name = "チャット保管ブロック"
+        verbose_name_plural = "チャット保管ブロック"
@@ -0,0 +1,105 @@
+"""
+チャットルームのオンライン状態 (presence)
+
+- (ルーム, ユーザー) ごとにキャッシュのキーを1つ持ち、接続中のチャンネル名と期限を入れる
+  (同じユーザーが複数のタブで開いていても、全部閉じるまではオンラインのまま)
+- キーは TTL 秒で消えるので、切断処理が走らずに落ちた接続もいずれオフラインになる。
+  クライアントは HEARTBEAT_INTERVAL 秒ごとに heartbeat を送って期限を延ばす
+- 入力中の通知の間引きも (ルーム, ユーザー) ごとにキャッシュで持つ (複数のタブから送られても1人分にまとめる)
+- チャンネルレイヤー (InMemoryChannelLayer) には値を置いておく仕組みが無いので、
+  表示名と同じく Django のキャッシュを使う (複数プロセスで動かす場合は共有のキャッシュにすること)
+"""
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .display_names import resolve_display_names
+from .services import get_member_ids
+
+DEFAULT_PRESENCE_SETTINGS = {
+    # この秒数 heartbeat が無ければオフライン扱いにする
+    'TTL': 60,
+    # クライアントが heartbeat を送る間隔 (秒)
+    'HEARTBEAT_INTERVAL': 25,
+    # 入力中の通知は1つのルームの1人につきこの間隔 (ミリ秒) に1回までしか配信しない (接続が複数あっても)
+    'TYPING_INTERVAL_MS': 2000,
+}
+
+CACHE_KEY = 'chat:presence:{}:{}'
+# 入力中の通知を最後に配信した時刻
+TYPING_CACHE_KEY = 'chat:typing:{}:{}'
+
+
+def get_presence_settings():
+    return {**DEFAULT_PRESENCE_SETTINGS, **getattr(settings, 'CHAT_PRESENCE', {})}
+
+
+def _live_channels(key, now):
+    channels = cache.get(key) or {}
+    return {name: expires for name, expires in channels.items() if expires > now}
+
+
+def join(room_id, user_id, channel_name):
+    """
+    接続をオンラインとして記録する (heartbeat でも呼ぶ)
+    戻り値: このユーザーがこのルームで新しくオンラインになったら True
+    """
+    ttl = get_presence_settings()['TTL']
+    key = CACHE_KEY.format(room_id, user_id)
+    now = time.time()
+    channels = _live_channels(key, now)
+    was_online = bool(channels)
+    channels[channel_name] = now + ttl
+    cache.set(key, channels, ttl)
+    return not was_online
+
+
+def leave(room_id, user_id, channel_name):
+    """
+    接続を取り除く。戻り値: このユーザーがこのルームでオフラインになったら True
+    """
+    key = CACHE_KEY.format(room_id, user_id)
+    now = time.time()
+    channels = _live_channels(key, now)
+    channels.pop(channel_name, None)
+    if channels:
+        cache.set(key, channels, max(int(max(channels.values()) - now), 1))
+        return False
+    cache.delete(key)
+    return True
+
+
+def claim_typing(room_id, user_id):
+    """
+    入力中の通知を配信してよいか確かめ、よければ配信した時刻を記録する
+    戻り値: 配信してよければ 0。まだなら、配信できるようになるまでの秒数
+    """
+    interval = get_presence_settings()['TYPING_INTERVAL_MS'] / 1000
+    timeout = max(math.ceil(interval), 1)
+    key = TYPING_CACHE_KEY.format(room_id, user_id)
+    now = time.time()
+    if cache.add(key, now, timeout):
+        return 0
+    wait = (cache.get(key) or 0) + interval - now
+    if wait > 0:
+        return wait
+    # キーの期限 (秒単位に切り上げ) より先に間隔が過ぎた場合
+    cache.set(key, now, timeout)
+    return 0
+
+
+def get_online_users(room):
+    """ ルームでオンラインの参加者。戻り値: [{'user_id': ..., 'display_name': ...}, ...] """
+    keys = {CACHE_KEY.format(room.pk, user_id): user_id for user_id in get_member_ids(room.pk)}
+    now = time.time()
+    online = [
+        keys[key] for key, channels in cache.get_many(keys).items()
+        if any(expires > now for expires in channels.values())
+    ]
+    names = resolve_display_names(online)
+    return [
+        {'user_id': user_id, 'display_name': names.get(user_id, '')}
+        for user_id in sorted(online)
+    ]
@@ -0,0 +1,105 @@
+"""
+ChatConsumer の受信のレート制限 (トークンバケット)
+
+- 接続ごとのバケット: その接続から届くフレーム (メッセージ・入力中・heartbeat など) すべて
+- ユーザーごとのバケット: メッセージの送信だけ (DB への保存と配信が起きるもの)。
+  同じユーザーの接続 (複数タブ) で共有する
+- 超えた分は黙って捨てずにエラーのフレームを返す。超過が MAX_VIOLATIONS 回続いた接続は切断する
+- 件数は get_rate_limit_stats() で確認できる (chat:chat_stats から JSON で見られる)
+
+ユーザーごとのバケットはプロセス内に持つ (チャンネルレイヤーと同じく1プロセス前提)
+"""
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_RATE_LIMIT_SETTINGS = {
+    'ENABLED': True,
+    # 接続ごと: 一度に BURST 個まで、その後は 1秒に RATE 個ずつ回復
+    'CONNECTION_BURST': 20,
+    'CONNECTION_RATE': 5,
+    # ユーザーごと (メッセージの送信だけ)
+    'USER_BURST': 10,
+    'USER_RATE': 2,
+    # 超過がこの回数続いたら接続を切る (0 なら切らない)
+    'MAX_VIOLATIONS': 50,
+}
+
+
+def get_rate_limit_settings():
+    return {**DEFAULT_RATE_LIMIT_SETTINGS, **getattr(settings, 'CHAT_RATE_LIMIT', {})}
+
+
+class TokenBucket:
+
+    def __init__(self, burst, rate):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, count=1):
+        """ トークンを使う。足りなければ使わずに False """
+        self._refill(time.monotonic())
+        if self.tokens >= count:
+            self.tokens -= count
+            return True
+        return False
+
+    def retry_after(self, count=1):
+        """ count 個使えるようになるまでの秒数 """
+        missing = count - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate else float('inf')
+
+    @property
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+
+# ユーザーID → TokenBucket (プロセス内)
+_user_buckets = {}
+_lock = threading.Lock()
+_SWEEP_SIZE = 10000
+
+_stats = {
+    'rejected_connection': 0,
+    'rejected_user': 0,
+    'disconnected': 0,
+}
+
+
+def get_user_bucket(user_id, config):
+    with _lock:
+        bucket = _user_buckets.get(user_id)
+        if bucket is None:
+            if len(_user_buckets) >= _SWEEP_SIZE:
+                # 満タンに戻っているバケットは作り直しても同じなので捨てる
+                for key in [key for key, value in _user_buckets.items() if value.full]:
+                    del _user_buckets[key]
+            bucket = _user_buckets[user_id] = TokenBucket(config['USER_BURST'], config['USER_RATE'])
+        return bucket
+
+
+def record(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def get_rate_limit_stats():
+    with _lock:
+        return {**_stats, 'tracked_users': len(_user_buckets)}
+
+
+def reset_rate_limit_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
+        _user_buckets.clear()
@@ -0,0 +1,141 @@
+"""
+チャットメッセージの全文検索
+
+SQLite では FTS5 の仮想テーブル (chat_chatmessage_fts) を使う。
+FTS5 の標準のトークナイザーは日本語を単語に分けられないので、本文を
+「2文字ずつ (bigram)」に区切った文字列 (chat.tokenizer) を索引に入れる。
+
+- 区切った文字列は保存時に Python で作って ChatMessage.search_text に入れておき
+  (save / bulk_create。write-behind でも同じ)、chat_chatmessage のトリガーがそれを索引に入れる。
+  トリガーは SQLite の標準の機能しか使わないので、dbshell など Django 以外から書き込んでもエラーにならない
+  (ただし search_text を入れなければ、そのメッセージは検索に出てこない)
+- 索引は search_text を外部の内容として参照する (content='chat_chatmessage')。
+  表示用の本文とスニペットは ChatMessage から作る
+- 検索語も同じように区切り、語ごとにフレーズとして AND で検索する
+- 参加しているルームのメッセージが少ないユーザーは、索引を先に引くと他人のルームの一致を
+  大量に読み飛ばすことになるので、自分のメッセージを先に取って1件ずつ索引と照合する
+- SQLite 以外の DB では content の部分一致 (LIKE) で検索する
+"""
+import re
+
+from django.db import connection
+from django.db.models import Sum
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import ChatRoom, ChatMessage
+from .tokenizer import bigrams, normalize
+
+FTS_TABLE = 'chat_chatmessage_fts'
+SEARCH_PAGE_SIZE = 20
+SNIPPET_LENGTH = 60
+# 参加しているルームのメッセージがこれより少なければ、メッセージから先に絞り込む
+SMALL_INBOX_MESSAGES = 500
+
+
+def build_match_query(query):
+    """ 検索語 → FTS5 の MATCH 式 (語ごとのフレーズの AND)。検索できる語が無ければ None """
+    phrases = []
+    for term in query.split():
+        tokens = bigrams(term)
+        if not tokens:
+            continue
+        if len(tokens) > 1 and not tokens[-1].isascii() and len(tokens[-1]) == 1:
+            # 「日本語」→ 日本 本語 (最後の1文字は前の bigram に含まれている)
+            tokens = tokens[:-1]
+        # 1文字の語は、その文字で始まる bigram の前方一致
+        if len(tokens) == 1 and not tokens[0].isascii() and len(tokens[0]) == 1:
+            phrases.append(f'"{tokens[0]}"*')
+        else:
+            phrases.append('"{}"'.format(' '.join(tokens)))
+    return ' AND '.join(phrases) or None
+
+
+def fts_available():
+    return connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+
+
+def _search_ids_fts(user, query, before, limit):
+    match = build_match_query(query)
+    if match is None:
+        return []
+    # 件数の見積もりは通し番号の合計で十分 (write-behind の欠番の分だけ多めになる)
+    estimate = ChatRoom.objects.filter(participants=user).aggregate(n=Sum('last_seq'))['n'] or 0
+    # CROSS JOIN は SQLite では結合順の指定になる。並べ替えは先に読む側の ID で行う
+    # (そうしないと一時的な B-tree で全件を並べ替えることになる)
+    if estimate < SMALL_INBOX_MESSAGES:
+        join, order = f'chat_chatmessage m CROSS JOIN {FTS_TABLE} f', 'm.id'
+    else:
+        join, order = f'{FTS_TABLE} f CROSS JOIN chat_chatmessage m', 'f.rowid'
+    sql = f"""
+        SELECT m.id FROM {join}
+        WHERE f.rowid = m.id
+          AND {FTS_TABLE} MATCH %s
+          AND m.room_id IN (SELECT chatroom_id FROM chat_chatroom_participants WHERE user_id = %s)
+          {'AND m.id < %s' if before else ''}
+        ORDER BY {order} DESC
+        LIMIT %s
+    """
+    params = [match, user.pk] + ([before] if before else []) + [limit]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _search_ids_like(user, query, before, limit):
+    terms = query.split()
+    if not terms:
+        return []
+    queryset = ChatMessage.objects.filter(room__participants=user)
+    for term in terms:
+        queryset = queryset.filter(content__icontains=term)
+    if before:
+        queryset = queryset.filter(pk__lt=before)
+    return list(queryset.order_by('-pk').values_list('pk', flat=True)[:limit])
+
+
+def search_messages(user, query, before=None, limit=SEARCH_PAGE_SIZE):
+    """
+    user が参加しているルームのメッセージを新しい順に検索する
+    戻り値: (メッセージのリスト (.snippet 付き), 次のページの before)
+    """
+    search_ids = _search_ids_fts if fts_available() else _search_ids_like
+    ids = search_ids(user, query, before, limit + 1)
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+
+    by_id = ChatMessage.objects.select_related('room').in_bulk(ids)
+    messages = [by_id[pk] for pk in ids if pk in by_id]
+    for message in messages:
+        message.snippet = make_snippet(message.content, query)
+    next_before = ids[-1] if has_more else None
+    return messages, next_before
+
+
+def make_snippet(content, query, length=SNIPPET_LENGTH):
+    """ 最初に一致した箇所の前後を切り出し、一致した部分を <mark> で囲む """
+    terms = sorted({term for term in query.split() if term}, key=len, reverse=True)
+    if not terms:
+        return escape(content[:length])
+    # 検索は NFKC で正規化しているので、ここでも全角・半角や大文字・小文字の違いは無視する
+    normalized = normalize(content)
+    if len(normalized) != len(content):
+        normalized = content.lower()
+    pattern = re.compile('|'.join(re.escape(normalize(term)) for term in terms))
+
+    first = pattern.search(normalized)
+    start = 0
+    if first is not None:
+        start = max(0, first.start() - length // 3)
+    end = min(len(content), start + length)
+
+    parts = []
+    position = start
+    for match in pattern.finditer(normalized, start, end):
+        parts.append(escape(content[position:match.start()]))
+        parts.append('<mark>{}</mark>'.format(escape(content[match.start():match.end()])))
+        position = match.end()
+    parts.append(escape(content[position:end]))
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if end < len(content) else ''
+    return mark_safe(prefix + ''.join(parts) + suffix)
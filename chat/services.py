@@ -0,0 +1,245 @@
+"""
+チャットの DB 処理 (ビューと ChatConsumer で共通)
+
+ChatConsumer (非同期) からは database_sync_to_async 経由で呼ぶこと
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from .archive import get_archived_messages
+from .display_names import resolve_display_name, resolve_display_names
+from .models import ChatRoom, ChatMessage, ChatReadState
+
+
+def get_sender_display_name(user):
+    """ 送信者の表示名 (キャッシュ済みなら SQL は発行しない) """
+    return resolve_display_name(user.pk, default=user.username)
+
+
+def get_member_room(room_id, user):
+    """
+    user が参加しているルームを返す (参加していなければ None)
+    参加者テーブルは (chatroom_id, user_id) のユニークインデックスを EXISTS で1回引くだけ
+    """
+    if not user.is_authenticated:
+        return None
+    Participant = ChatRoom.participants.through
+    is_member = Participant.objects.filter(chatroom_id=OuterRef('pk'), user_id=user.pk)
+    return ChatRoom.objects.filter(Exists(is_member), pk=room_id).first()
+
+
+MEMBERS_CACHE_KEY = 'chat:members:{}'
+MEMBERS_CACHE_TIMEOUT = 60 * 60
+
+
+def get_member_ids(room_id):
+    """
+    ルームの参加者のユーザーIDの集合 (キャッシュする。参加者が変わったら chat.signals で消す)
+    """
+    key = MEMBERS_CACHE_KEY.format(room_id)
+    member_ids = cache.get(key)
+    if member_ids is None:
+        Participant = ChatRoom.participants.through
+        member_ids = frozenset(
+            Participant.objects.filter(chatroom_id=room_id).values_list('user_id', flat=True)
+        )
+        cache.set(key, member_ids, MEMBERS_CACHE_TIMEOUT)
+    return member_ids
+
+
+def invalidate_member_ids(room_ids):
+    cache.delete_many([MEMBERS_CACHE_KEY.format(room_id) for room_id in set(room_ids)])
+
+
+def allocate_seq(room_id, count=1):
+    """
+    ルームの通し番号を count 個払い出す。戻り値: 最初の番号
+    (ChatRoom.last_seq を増やすだけなので、複数の接続から同時に呼ばれても重ならない)
+    """
+    with transaction.atomic():
+        ChatRoom.objects.filter(pk=room_id).update(last_seq=F('last_seq') + count)
+        last_seq = ChatRoom.objects.filter(pk=room_id).values_list('last_seq', flat=True).get()
+    return last_seq - count + 1
+
+
+def save_message(room, user, content):
+    with transaction.atomic():
+        message = ChatMessage.objects.create(
+            room=room, author=user, content=content, seq=allocate_seq(room.pk)
+        )
+        update_room_summaries([message])
+    return message
+
+
+def build_message(room, user, content, seq):
+    """ 保存前の ChatMessage を作る (write-behind 用。保存は chat.buffer が行う) """
+    return ChatMessage(room=room, author=user, content=content, timestamp=timezone.now(), seq=seq)
+
+
+# ==================================
+# 受信箱 (最後のメッセージ・未読数)
+# ==================================
+
+def update_room_summaries(messages):
+    """
+    新しく保存したメッセージを、ChatRoom の最後のメッセージと参加者の未読数に反映する
+    メッセージを保存するのと同じトランザクションの中で呼ぶこと
+    """
+    latest = {}
+    counts = {}
+    for msg in messages:
+        current = latest.get(msg.room_id)
+        if current is None or msg.timestamp >= current.timestamp:
+            latest[msg.room_id] = msg
+        key = (msg.room_id, msg.author_id)
+        counts[key] = counts.get(key, 0) + 1
+
+    preview_length = ChatRoom._meta.get_field('last_message_preview').max_length
+    for room_id, msg in latest.items():
+        ChatRoom.objects.filter(pk=room_id).filter(
+            Q(last_message_at__isnull=True) | Q(last_message_at__lte=msg.timestamp)
+        ).update(
+            last_message_at=msg.timestamp,
+            last_message_preview=msg.content[:preview_length],
+            last_author_id=msg.author_id,
+        )
+    # 投稿者以外の参加者の未読数を増やす
+    for (room_id, author_id), count in counts.items():
+        ChatReadState.objects.filter(room_id=room_id).exclude(user_id=author_id).update(
+            unread_count=F('unread_count') + count
+        )
+
+
+def mark_read(room, user):
+    """ ルームを既読にする (未読数を 0 に戻す) """
+    now = timezone.now()
+    updated = ChatReadState.objects.filter(room=room, user=user).update(unread_count=0, last_read_at=now)
+    if not updated:
+        ChatReadState.objects.get_or_create(room=room, user=user, defaults={'last_read_at': now})
+
+
+def message_event(message, display_name):
+    """ グループに流すイベント (ChatConsumer.chat_message が受け取る) """
+    # タイムスタンプはローカルタイム（日本時間）に変換して送る
+    local_timestamp = timezone.localtime(message.timestamp)
+    return {
+        'type': 'chat_message',
+        'message': message.content,
+        'author_username': display_name,
+        'author_id': message.author_id,  # JSが「自分」か「相手」か判定するためにIDを送る
+        'timestamp': local_timestamp.strftime('%H:%M'),
+        'seq': message.seq,
+    }
+
+
+# ==================================
+# 履歴のページ送り
+# ==================================
+
+# 最初の表示・「さらに読み込む」1回あたりの件数
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+# SQLite の INTEGER (符号付き64ビット) の上限。これを超える値を SQL に渡すと OverflowError になる
+MAX_DB_INTEGER = 2 ** 63 - 1
+# カーソルに入れられる日時の上限 (datetime の範囲)
+_MAX_CURSOR_MICROS = (datetime.max.replace(tzinfo=dt_timezone.utc) - _EPOCH) // timedelta(microseconds=1)
+
+
+def encode_cursor(message):
+    """ メッセージの位置を表すカーソル ("マイクロ秒-ID") """
+    delta = message.timestamp - _EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return f"{micros}-{message.id}"
+
+
+def decode_cursor(cursor):
+    """ encode_cursor の逆。形式が不正・範囲外なら ValueError """
+    micros, message_id = cursor.split('-', 1)
+    micros, message_id = int(micros), int(message_id)
+    if not (0 <= micros <= _MAX_CURSOR_MICROS and 0 < message_id <= MAX_DB_INTEGER):
+        raise ValueError('Cursor out of range.')
+    return _EPOCH + timedelta(microseconds=micros), message_id
+
+
+def get_history(room, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    before (カーソル) より前のメッセージを新しい方から limit 件取得する
+    OFFSET は使わず (timestamp, id) で絞り込むので、どれだけ遡っても速度は変わらない
+    ChatMessage を読み切ったら、保管済みのメッセージ (chat.archive) から続きを読む
+
+    戻り値: (古い順のメッセージのリスト, さらに古いものを取るためのカーソル or None)
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    queryset = ChatMessage.objects.filter(room=room)
+    position = None
+    if before:
+        position = decode_cursor(before)
+        timestamp, message_id = position
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+    messages = list(queryset.order_by('-timestamp', '-id')[:limit + 1])
+    if len(messages) <= limit:
+        if messages:
+            position = (messages[-1].timestamp, messages[-1].id)
+        messages += get_archived_messages(room, before=position, limit=limit + 1 - len(messages))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    # 表示名は投稿者の人数分まとめて取得する
+    names = resolve_display_names(msg.author_id for msg in messages)
+    for msg in messages:
+        msg.author_display_name = names.get(msg.author_id, '')
+    next_cursor = encode_cursor(messages[0]) if has_more else None
+    return messages, next_cursor
+
+
+def serialize_message(message):
+    """ 履歴として返すメッセージ (chat_message イベントと同じ形 + id) """
+    return {
+        'id': message.id,
+        'message': message.content,
+        'author_username': message.author_display_name,
+        'author_id': message.author_id,
+        'timestamp': timezone.localtime(message.timestamp).strftime('%H:%M'),
+        'seq': message.seq,
+    }
+
+
+# ==================================
+# 再接続時の取りこぼし分
+# ==================================
+
+# これより多く取りこぼしていたら、差分ではなく画面の再読み込みをしてもらう
+RESUME_MAX_MESSAGES = 200
+
+
+def get_missed_messages(room, after_seq, pending=()):
+    """
+    通し番号が after_seq より後のメッセージを古い順に返す
+    pending: まだ保存されていない (write-behind のバッファにある) メッセージ
+
+    戻り値: メッセージのリスト (多すぎる場合は None)。after_seq が範囲外なら ValueError
+    """
+    if not 0 <= after_seq <= MAX_DB_INTEGER:
+        raise ValueError('after_seq out of range.')
+    saved = list(
+        ChatMessage.objects.filter(room=room, seq__gt=after_seq).order_by('seq')[:RESUME_MAX_MESSAGES + 1]
+    )
+    by_seq = {msg.seq: msg for msg in saved}
+    for msg in pending:
+        if msg.seq > after_seq:
+            by_seq.setdefault(msg.seq, msg)
+    if len(by_seq) > RESUME_MAX_MESSAGES:
+        return None
+    messages = [by_seq[seq] for seq in sorted(by_seq)]
+    names = resolve_display_names(msg.author_id for msg in messages)
+    for msg in messages:
+        msg.author_display_name = names.get(msg.author_id, '')
+    return messages
@@ -0,0 +1,92 @@
+"""
+- 表示名のキャッシュ (chat.display_names) を、元になるデータの変更時に消す
+- ルームの参加者が変わったら、参加者IDのキャッシュ (chat.services.get_member_ids) を消す
+- ログアウトしたら、WebSocket の認証のキャッシュ (chat.auth) を消す
+"""
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from accounts.models import Student, Teacher, CompanyRepresentative
+from companies.models import Company
+from schools.models import School
+from .auth import forget_session
+from .display_names import invalidate_display_names
+from .models import ChatRoom
+from .services import invalidate_member_ids
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+@receiver(post_save, sender=Teacher)
+@receiver(post_delete, sender=Teacher)
+@receiver(post_save, sender=CompanyRepresentative)
+@receiver(post_delete, sender=CompanyRepresentative)
+def profile_changed(sender, instance, **kwargs):
+    invalidate_display_names([instance.user_id])
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created, update_fields=None, **kwargs):
+    # プロフィールの無いユーザーはユーザー名がそのまま表示名になる
+    # (ログイン時の last_login だけの更新では消さない)
+    if created or (update_fields and 'username' not in update_fields):
+        return
+    invalidate_display_names([instance.pk])
+
+
+def _school_user_ids(school):
+    user_ids = list(Student.objects.filter(school=school).values_list('user_id', flat=True))
+    user_ids += Teacher.objects.filter(school=school).values_list('user_id', flat=True)
+    return user_ids
+
+
+@receiver(post_save, sender=School)
+def school_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    invalidate_display_names(_school_user_ids(instance))
+
+
+@receiver(pre_delete, sender=School)
+def school_deleting(sender, instance, **kwargs):
+    # 削除すると学生・教員の school は SET_NULL (update 1本で save() を通らない) になり、
+    # 誰がこの学校だったか分からなくなるので先に集めておく
+    instance._display_name_user_ids = _school_user_ids(instance)
+
+
+@receiver(post_delete, sender=School)
+def school_deleted(sender, instance, **kwargs):
+    invalidate_display_names(getattr(instance, '_display_name_user_ids', ()))
+
+
+@receiver(post_save, sender=Company)
+def company_changed(sender, instance, created, **kwargs):
+    # 企業の削除は担当者も CASCADE で消える (担当者の post_delete で消える) ので、ここでは変更だけ
+    if created:
+        return
+    invalidate_display_names(
+        CompanyRepresentative.objects.filter(company=instance).values_list('user_id', flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_member_ids([instance.pk])
+    elif pk_set:
+        # user.chat_rooms.add(...) の場合は pk_set がルームID
+        invalidate_member_ids(pk_set)
+    else:
+        invalidate_member_ids(instance.chat_rooms.values_list('pk', flat=True))
+
+
+@receiver(user_logged_out)
+def session_logged_out(sender, request, **kwargs):
+    # ログアウト処理でセッションが消される前に呼ばれる
+    session = getattr(request, 'session', None)
+    if session is not None:
+        forget_session(session.session_key)
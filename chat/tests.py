@@ -1,3 +1,988 @@
-from django.test import TestCase
+import asyncio
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import CompanyRepresentative, Student, Teacher
+from accounts.roles import ROLE_GUEST, ROLE_STUDENT
+from companies.models import Company
+from schools.models import School
+from .archive import compact, compact_room, get_archived_messages, get_cutoff, pack_messages, unpack_block
+from .buffer import MessageBuffer
+from .display_names import resolve_display_names
+from .models import ChatRoom, ChatMessage, ChatArchiveBlock, ChatReadState, make_pair_key
+from .routing import websocket_urlpatterns
+from . import presence, ratelimit, search
+from .auth import _cache_key, resolve_session
+from .services import (
+    RESUME_MAX_MESSAGES, allocate_seq, build_message, decode_cursor, encode_cursor, get_history,
+    get_missed_messages, mark_read, save_message, update_room_summaries,
+)
+
+
+def create_messages(room, author, count, start, step=timedelta(hours=3)):
+    """ 2件ずつ同じ日時のメッセージを作る (同じ日時は ID の順になる) """
+    ChatMessage.objects.bulk_create([
+        ChatMessage(room=room, author=author, content=f'message {i}', seq=i + 1, timestamp=start + step * (i // 2))
+        for i in range(count)
+    ])
+    ChatRoom.objects.filter(pk=room.pk).update(last_seq=count)
+    return list(ChatMessage.objects.filter(room=room).order_by('timestamp', 'id').values_list('id', flat=True))
+
+
+async def receive_reply(communicator):
+    """ オンライン状態・入力中の通知を読み飛ばして、次の応答を返す """
+    while True:
+        data = await communicator.receive_json_from()
+        if data.get('type') not in ('presence', 'presence_snapshot', 'typing'):
+            return data
+
+
+async def connect(room, user):
+    communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/room/{room.pk}/')
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+def walk_history(room, limit):
+    """ get_history のカーソルをたどって全件読む。戻り値: 古い順の ID """
+    ids, cursor = [], None
+    while True:
+        messages, cursor = get_history(room, before=cursor, limit=limit)
+        ids[:0] = [msg.id for msg in messages]
+        if cursor is None:
+            return ids
+
+
+class MessageBufferTests(TransactionTestCase):
+    # SQLite の外部キーはコミット時に確認されるので、TestCase (トランザクションの中) では再現できない
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+
+    def make_orphan(self):
+        """ 保存される前にルームが削除されたメッセージ """
+        other, _ = ChatRoom.objects.get_or_create_direct(self.alice, User.objects.create(username='carol'))
+        message = build_message(other, self.alice, 'orphan', seq=1)
+        ChatRoom.objects.filter(pk=other.pk).delete()
+        return message
+
+    def test_flush_writes_batch(self):
+        buffer = MessageBuffer()
+        for seq in range(1, 4):
+            buffer._pending.append(build_message(self.room, self.alice, f'm{seq}', seq))
+        self.assertEqual(buffer.flush_sync(), 3)
+        self.assertEqual(ChatMessage.objects.filter(room=self.room).count(), 3)
+        self.assertEqual(buffer.depth, 0)
+
+    def test_bad_row_is_dropped_and_later_rows_are_written(self):
+        buffer = MessageBuffer()
+        orphan = self.make_orphan()
+        buffer._pending += [orphan, build_message(self.room, self.alice, 'after orphan', 1)]
+
+        with self.assertLogs('chat.buffer', level='ERROR'):
+            self.assertEqual(buffer.flush_sync(), 1)
+
+        self.assertEqual(list(ChatMessage.objects.values_list('content', flat=True)), ['after orphan'])
+        self.assertEqual(buffer.depth, 0)
+        self.assertEqual(list(buffer.dead_letters), [orphan])
+        self.assertEqual(buffer.stats()['dropped_messages'], 1)
+
+        # 次のメッセージも止まらない
+        buffer._pending.append(build_message(self.room, self.alice, 'next', 2))
+        self.assertEqual(buffer.flush_sync(), 1)
+
+    def test_transient_failure_is_retried_up_to_limit(self):
+        buffer = MessageBuffer(max_retries=2)
+        message = build_message(self.room, self.alice, 'hello', 1)
+        buffer._pending.append(message)
+
+        with mock.patch.object(MessageBuffer, '_write', side_effect=OperationalError('database is locked')):
+            with self.assertLogs('chat.buffer', level='ERROR'):
+                for _ in range(2):
+                    self.assertEqual(buffer.flush_sync(), 0)
+                    self.assertEqual(buffer.depth, 1)
+                # 3回目で諦める
+                self.assertEqual(buffer.flush_sync(), 0)
+        self.assertEqual(buffer.depth, 0)
+        self.assertEqual(list(buffer.dead_letters), [message])
+
+    def test_transient_failure_recovers(self):
+        buffer = MessageBuffer()
+        buffer._pending.append(build_message(self.room, self.alice, 'hello', 1))
+        with mock.patch.object(MessageBuffer, '_write', side_effect=OperationalError('database is locked')):
+            with self.assertLogs('chat.buffer', level='ERROR'):
+                buffer.flush_sync()
+        self.assertEqual(buffer.flush_sync(), 1)
+        self.assertEqual(ChatMessage.objects.count(), 1)
+        self.assertEqual(buffer._attempts, {})
+
+    def test_failed_flush_schedules_retry(self):
+        buffer = MessageBuffer(flush_interval=0.01, retry_interval=0.01)
+
+        async def run():
+            with mock.patch.object(MessageBuffer, '_write', side_effect=[OperationalError('locked'), None, None]):
+                await buffer.add(build_message(self.room, self.alice, 'hello', 1))
+                # add の後のタイマーで失敗し、もう1回分のタイマーで書けるまで待つ
+                for _ in range(100):
+                    await asyncio.sleep(0.01)
+                    if buffer.stats()['flushed_messages']:
+                        break
+
+        with self.assertLogs('chat.buffer', level='ERROR'):
+            async_to_sync(run)()
+        self.assertEqual(buffer.depth, 0)
+        self.assertEqual(buffer.stats()['flushed_messages'], 1)
+
+
+class HistoryCursorTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+        self.start = timezone.now() - timedelta(days=30)
+        self.ids = create_messages(self.room, self.alice, 60, self.start)
+
+    def test_pages_cover_every_message_once(self):
+        for limit in (1, 7, 50, 200):
+            self.assertEqual(walk_history(self.room, limit), self.ids)
+
+    def test_pages_continue_into_archive(self):
+        # 古い方の半分ほどを保管する (日をまたぐので複数のブロックになる)
+        cutoff = self.start + timedelta(hours=3 * 15)
+        result = compact_room(self.room.pk, cutoff)
+        self.assertGreater(result['messages'], 0)
+        self.assertGreater(ChatArchiveBlock.objects.filter(room=self.room).count(), 1)
+        self.assertLess(ChatMessage.objects.filter(room=self.room).count(), len(self.ids))
+
+        for limit in (1, 7, 50):
+            self.assertEqual(walk_history(self.room, limit), self.ids)
+
+    def test_cursor_round_trip(self):
+        message = ChatMessage.objects.get(pk=self.ids[10])
+        self.assertEqual(decode_cursor(encode_cursor(message)), (message.timestamp, message.id))
+
+    def test_out_of_range_cursor_is_invalid(self):
+        for cursor in ('999999999999999999999999999999-1', '1-99999999999999999999', 'abc', '1-0'):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_history_view_rejects_bad_cursor(self):
+        self.client.force_login(self.alice)
+        url = reverse('chat:chat_history', args=[self.room.pk])
+        for cursor in ('999999999999999999999999999999-1', 'garbage'):
+            response = self.client.get(url, {'before': cursor})
+            self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'limit': 5})
+        self.assertEqual([msg['id'] for msg in response.json()['messages']], self.ids[-5:])
+
+    def test_search_ignores_out_of_range_before(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('chat:chat_search'), {'q': 'message', 'before': '9' * 30})
+        self.assertEqual(response.status_code, 200)
+
+
+class ChatConsumerCursorTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+        self.ids = create_messages(self.room, self.alice, 10, timezone.now() - timedelta(days=1))
+
+    def test_load_older_with_bad_cursor_sends_error(self):
+        async def run():
+            communicator = await connect(self.room, self.alice)
+            await communicator.send_json_to({'command': 'load_older', 'before': '999999999999999999999999999999-1'})
+            self.assertEqual(await receive_reply(communicator), {'error': 'Invalid cursor.'})
+            # 接続はそのまま使える
+            await communicator.send_json_to({'command': 'load_older', 'limit': 3})
+            data = await receive_reply(communicator)
+            self.assertEqual([msg['id'] for msg in data['messages']], self.ids[-3:])
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+
+class ResumeTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+
+    def test_allocate_seq_hands_out_consecutive_blocks(self):
+        self.assertEqual(allocate_seq(self.room.pk), 1)
+        self.assertEqual(allocate_seq(self.room.pk, 10), 2)
+        self.assertEqual(allocate_seq(self.room.pk), 12)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 12)
+
+    def test_missed_messages_after_seq(self):
+        create_messages(self.room, self.alice, 5, timezone.now())
+        missed = get_missed_messages(self.room, 2)
+        self.assertEqual([msg.seq for msg in missed], [3, 4, 5])
+        self.assertEqual(missed[0].author_display_name, 'alice')
+        self.assertEqual(get_missed_messages(self.room, 5), [])
+
+    def test_missed_messages_include_unsaved_pending(self):
+        create_messages(self.room, self.alice, 3, timezone.now())
+        pending = [
+            build_message(self.room, self.bob, 'pending 5', 5),
+            build_message(self.room, self.bob, 'pending 4', 4),
+            # 保存済みと同じ番号 (書き込み中) は1回だけ返す
+            build_message(self.room, self.alice, 'message 2', 3),
+        ]
+        missed = get_missed_messages(self.room, 1, pending)
+        self.assertEqual([msg.seq for msg in missed], [2, 3, 4, 5])
+        self.assertEqual(missed[-1].content, 'pending 5')
+
+    def test_too_many_missed_messages_asks_for_reload(self):
+        create_messages(self.room, self.alice, RESUME_MAX_MESSAGES + 1, timezone.now())
+        self.assertIsNone(get_missed_messages(self.room, 0))
+        self.assertEqual(len(get_missed_messages(self.room, 1)), RESUME_MAX_MESSAGES)
+
+    def test_out_of_range_seq_is_invalid(self):
+        with self.assertRaises(ValueError):
+            get_missed_messages(self.room, 2 ** 64)
+
+
+class ChatConsumerResumeTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+
+    def test_reconnect_receives_only_missed_messages(self):
+        async def run():
+            bob = await connect(self.room, self.bob)
+            alice = await connect(self.room, self.alice)
+            await alice.send_json_to({'message': 'first'})
+            self.assertEqual((await receive_reply(bob))['seq'], 1)
+            # bob が切断している間に2件届く
+            await bob.disconnect()
+            for text in ('second', 'third'):
+                await alice.send_json_to({'message': text})
+                await receive_reply(alice)
+
+            bob = await connect(self.room, self.bob)
+            await bob.send_json_to({'command': 'resume', 'after_seq': 1})
+            data = await receive_reply(bob)
+            self.assertEqual(data['type'], 'resume')
+            self.assertEqual([(msg['seq'], msg['message']) for msg in data['messages']], [(2, 'second'), (3, 'third')])
+
+            await bob.send_json_to({'command': 'resume', 'after_seq': 2 ** 64})
+            self.assertIn('error', await receive_reply(bob))
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(run)()
+
+    def test_too_many_missed_messages_asks_for_reload(self):
+        create_messages(self.room, self.alice, RESUME_MAX_MESSAGES + 5, timezone.now())
+
+        async def run():
+            bob = await connect(self.room, self.bob)
+            await bob.send_json_to({'command': 'resume', 'after_seq': 0})
+            self.assertEqual(await receive_reply(bob), {'type': 'resume', 'reload': True})
+            await bob.disconnect()
+
+        async_to_sync(run)()
+
+
+class DisplayNameTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.school = School.objects.create(name='第一高校', address='東京都')
+        self.company = Company.objects.create(name='株式会社テスト', industry='IT', description='説明')
+        self.student = Student.objects.create(
+            user=User.objects.create(username='student'), school=self.school, full_name='学生', grade=1,
+        )
+        self.teacher = Teacher.objects.create(
+            user=User.objects.create(username='teacher'), school=self.school, full_name='先生', subject='数学',
+        )
+        self.representative = CompanyRepresentative.objects.create(
+            user=User.objects.create(username='company'), company=self.company, full_name='担当者',
+        )
+        self.user = User.objects.create(username='plain')
+
+    def names(self):
+        return resolve_display_names([self.student.user_id, self.teacher.user_id, self.representative.user_id, self.user.pk])
+
+    def assertNames(self, student, teacher, representative, user):
+        self.assertEqual(self.names(), {
+            self.student.user_id: student,
+            self.teacher.user_id: teacher,
+            self.representative.user_id: representative,
+            self.user.pk: user,
+        })
+
+    def test_names_are_cached(self):
+        self.assertNames('学生（第一高校）', '先生 先生（第一高校）', '担当者 様（株式会社テスト）', 'plain')
+        with self.assertNumQueries(0):
+            self.names()
+
+    def test_renamed_sources_are_shown(self):
+        self.names()
+        self.school.name = '第二高校'
+        self.school.save()
+        self.company.name = '株式会社新社名'
+        self.company.save()
+        self.student.full_name = '新しい氏名'
+        self.student.save()
+        self.user.username = 'renamed'
+        self.user.save()
+        self.assertNames('新しい氏名（第二高校）', '先生 先生（第二高校）', '担当者 様（株式会社新社名）', 'renamed')
+
+    def test_deleted_school_and_company(self):
+        self.names()
+        # 学校は SET_NULL、企業は担当者ごと CASCADE で消える
+        self.school.delete()
+        self.company.delete()
+        self.assertNames('学生（所属未設定）', '先生 先生（所属未設定）', 'company', 'plain')
+
+    def test_last_login_does_not_invalidate(self):
+        self.names()
+        self.user.last_login = timezone.now()
+        self.user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            self.names()
+
+
+class PresenceTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+
+    def online(self):
+        return [user['user_id'] for user in presence.get_online_users(self.room)]
+
+    def test_join_and_leave_with_several_tabs(self):
+        self.assertTrue(presence.join(self.room.pk, self.alice.pk, 'tab1'))
+        self.assertFalse(presence.join(self.room.pk, self.alice.pk, 'tab2'))
+        self.assertEqual(self.online(), [self.alice.pk])
+        self.assertFalse(presence.leave(self.room.pk, self.alice.pk, 'tab1'))
+        self.assertEqual(self.online(), [self.alice.pk])
+        self.assertTrue(presence.leave(self.room.pk, self.alice.pk, 'tab2'))
+        self.assertEqual(self.online(), [])
+
+    def test_connection_without_heartbeat_expires(self):
+        with mock.patch('chat.presence.time.time', return_value=1000.0) as now:
+            presence.join(self.room.pk, self.alice.pk, 'tab1')
+            now.return_value = 1059.0
+            self.assertEqual(self.online(), [self.alice.pk])
+            now.return_value = 1061.0
+            self.assertEqual(self.online(), [])
+            # 期限切れの後の heartbeat は、新しくオンラインになった扱い
+            self.assertTrue(presence.join(self.room.pk, self.alice.pk, 'tab1'))
+
+    @override_settings(CHAT_PRESENCE={'TYPING_INTERVAL_MS': 2000})
+    def test_claim_typing_is_shared_per_user(self):
+        with mock.patch('chat.presence.time.time', return_value=1000.0) as now:
+            self.assertEqual(presence.claim_typing(self.room.pk, self.alice.pk), 0)
+            now.return_value = 1000.5
+            self.assertEqual(presence.claim_typing(self.room.pk, self.alice.pk), 1.5)
+            # 他の人・他のルームは別
+            self.assertEqual(presence.claim_typing(self.room.pk, self.bob.pk), 0)
+            self.assertEqual(presence.claim_typing(self.room.pk + 1, self.alice.pk), 0)
+            now.return_value = 1002.0
+            self.assertEqual(presence.claim_typing(self.room.pk, self.alice.pk), 0)
+
+
+@override_settings(CHAT_PRESENCE={'TYPING_INTERVAL_MS': 300})
+class ChatConsumerPresenceTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+
+    async def receive_all(self, communicator, timeout=0.1):
+        """ timeout 秒何も届かなくなるまでに届いたフレーム """
+        frames = []
+        while not await communicator.receive_nothing(timeout=timeout):
+            frames.append(await communicator.receive_json_from())
+        return frames
+
+    async def typing_frames(self, communicator, timeout=0.5):
+        """ timeout 秒の間に届いた入力中の通知の is_typing """
+        frames = await self.receive_all(communicator, timeout)
+        return [data['is_typing'] for data in frames if data.get('type') == 'typing']
+
+    def presence(self, user, online):
+        return {'type': 'presence', 'user_id': user.pk, 'display_name': user.username, 'online': online}
+
+    def test_presence_join_and_leave(self):
+        async def run():
+            alice = await connect(self.room, self.alice)
+            snapshot, own = await self.receive_all(alice)
+            self.assertEqual(snapshot['type'], 'presence_snapshot')
+            self.assertEqual([user['user_id'] for user in snapshot['users']], [self.alice.pk])
+            self.assertEqual(snapshot['typing_interval_ms'], 300)
+            self.assertEqual(own, self.presence(self.alice, True))
+
+            bob = await connect(self.room, self.bob)
+            self.assertEqual(await self.receive_all(alice), [self.presence(self.bob, True)])
+            snapshot, _own = await self.receive_all(bob)
+            self.assertEqual([user['user_id'] for user in snapshot['users']], [self.alice.pk, self.bob.pk])
+
+            # 2つ目のタブを開いても、1つ目を閉じても、相手には何も届かない
+            alice2 = await connect(self.room, self.alice)
+            await alice.disconnect()
+            self.assertEqual(await self.receive_all(bob), [])
+            await alice2.disconnect()
+            self.assertEqual(await self.receive_all(bob), [self.presence(self.alice, False)])
+            await bob.disconnect()
+
+        async_to_sync(run)()
+
+    def test_typing_is_coalesced(self):
+        async def run():
+            alice = await connect(self.room, self.alice)
+            bob = await connect(self.room, self.bob)
+            for is_typing in (True, False, True, True, False):
+                await alice.send_json_to({'command': 'typing', 'is_typing': is_typing})
+            # 最初の1回はすぐに、最後の状態は間隔が空いてから届く
+            self.assertEqual(await self.typing_frames(bob), [True, False])
+            await alice.disconnect()
+            await bob.disconnect()
+
+        async_to_sync(run)()
+
+    def test_typing_interval_is_shared_between_tabs(self):
+        async def run():
+            alice = await connect(self.room, self.alice)
+            alice2 = await connect(self.room, self.alice)
+            bob = await connect(self.room, self.bob)
+            await self.typing_frames(bob, timeout=0.1)
+            await alice.send_json_to({'command': 'typing', 'is_typing': True})
+            self.assertEqual(await self.typing_frames(bob, timeout=0.1), [True])
+
+            # もう1つのタブからの通知も、同じ人の間隔が空くまで待たされる
+            await alice2.send_json_to({'command': 'typing', 'is_typing': True})
+            self.assertTrue(await bob.receive_nothing(timeout=0.1))
+            self.assertEqual(await self.typing_frames(bob), [True])
+            for communicator in (alice, alice2, bob):
+                await communicator.disconnect()
+
+        async_to_sync(run)()
+
+
+class TokenBucketTests(TestCase):
+
+    def test_refill(self):
+        with mock.patch('chat.ratelimit.time.monotonic', return_value=100.0) as monotonic:
+            bucket = ratelimit.TokenBucket(3, 2)
+            self.assertTrue(all(bucket.consume() for _ in range(3)))
+            self.assertFalse(bucket.consume())
+            self.assertEqual(bucket.retry_after(), 0.5)
+
+            # 0.25秒で半分だけ回復 (まだ足りない)
+            monotonic.return_value = 100.25
+            self.assertFalse(bucket.consume())
+            self.assertEqual(bucket.retry_after(), 0.25)
+            monotonic.return_value = 100.5
+            self.assertTrue(bucket.consume())
+            self.assertFalse(bucket.full)
+
+            # 長く空いても BURST より多くはたまらない
+            monotonic.return_value = 200.0
+            self.assertTrue(bucket.full)
+            self.assertTrue(all(bucket.consume() for _ in range(3)))
+            self.assertFalse(bucket.consume())
+
+
+@override_settings(CHAT_RATE_LIMIT={'USER_BURST': 2, 'USER_RATE': 0.5, 'MAX_VIOLATIONS': 3})
+class ChatConsumerRateLimitTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        ratelimit.reset_rate_limit_stats()
+        self.addCleanup(ratelimit.reset_rate_limit_stats)
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+
+    def test_flood_is_rejected_then_disconnected(self):
+        async def run():
+            alice = await connect(self.room, self.alice)
+            for text in ('first', 'second'):
+                await alice.send_json_to({'message': text})
+                self.assertEqual((await receive_reply(alice))['message'], text)
+
+            # ユーザーのバケットが空になった。接続のバケットにはまだ余裕がある
+            for _ in range(2):
+                await alice.send_json_to({'message': 'flood'})
+                data = await receive_reply(alice)
+                self.assertEqual(data['error'], 'Rate limit exceeded.')
+                self.assertGreater(data['retry_after'], 0)
+                self.assertLessEqual(data['retry_after'], 2)
+
+            # 接続のバケットが通っても連続超過の回数は戻らず、3回目で切断される
+            await alice.send_json_to({'message': 'flood'})
+            self.assertEqual(await alice.receive_output(), {'type': 'websocket.close', 'code': 4008})
+            await alice.disconnect()
+
+        async_to_sync(run)()
+        self.assertEqual(ChatMessage.objects.filter(room=self.room).count(), 2)
+        stats = ratelimit.get_rate_limit_stats()
+        self.assertEqual((stats['rejected_user'], stats['rejected_connection'], stats['disconnected']), (3, 0, 1))
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.carol = User.objects.create(username='carol')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+        self.other_room, _ = ChatRoom.objects.get_or_create_direct(self.bob, self.carol)
+        self.messages = {}
+        for content in ('面接の日程はいつ頃がよろしいでしょうか。', 'ポートフォリオを拝見しました。',
+                        'Python の課題を提出しました', '来週の水曜日はいかがですか？'):
+            self.messages[content] = ChatMessage.objects.create(room=self.room, author=self.bob, content=content)
+        # alice が参加していないルーム
+        ChatMessage.objects.create(room=self.other_room, author=self.carol, content='面接の日程を決めましょう')
+
+    def search(self, query, user=None):
+        return [msg.content for msg in search.search_messages(user or self.alice, query)[0]]
+
+    def test_fts_index_is_used(self):
+        self.assertTrue(search.fts_available())
+
+    def test_japanese_words(self):
+        self.assertEqual(self.search('日程'), ['面接の日程はいつ頃がよろしいでしょうか。'])
+        self.assertEqual(self.search('拝見しました'), ['ポートフォリオを拝見しました。'])
+        # 語ごとの AND
+        self.assertEqual(self.search('面接 日程'), ['面接の日程はいつ頃がよろしいでしょうか。'])
+        self.assertEqual(self.search('面接 水曜日'), [])
+        # 1文字でも探せる
+        self.assertEqual(self.search('週'), ['来週の水曜日はいかがですか？'])
+
+    def test_width_and_case_are_ignored(self):
+        self.assertEqual(self.search('ＰＹＴＨＯＮ'), ['Python の課題を提出しました'])
+        self.assertEqual(self.search('ﾎﾟｰﾄﾌｫﾘｵ'), ['ポートフォリオを拝見しました。'])
+
+    def test_only_own_rooms(self):
+        self.assertEqual(self.search('決め'), [])
+        self.assertEqual(len(self.search('日程', user=self.bob)), 2)
+
+    def test_index_follows_edit_and_delete(self):
+        message = self.messages['来週の水曜日はいかがですか？']
+        message.content = '来週の金曜日はいかがですか？'
+        message.save(update_fields=['content'])
+        self.assertEqual(self.search('水曜'), [])
+        self.assertEqual(self.search('金曜'), ['来週の金曜日はいかがですか？'])
+        message.delete()
+        self.assertEqual(self.search('金曜'), [])
+
+    def test_bulk_create_is_indexed(self):
+        ChatMessage.objects.bulk_create([
+            build_message(self.room, self.alice, f'説明会の資料 {i}', seq=100 + i) for i in range(3)
+        ])
+        self.assertEqual(len(self.search('説明会')), 3)
+
+    def test_both_join_orders_and_like_fallback_agree(self):
+        expected = self.search('した')
+        self.assertEqual(len(expected), 2)
+        with mock.patch.object(search, 'SMALL_INBOX_MESSAGES', 0):
+            self.assertEqual(self.search('した'), expected)
+        with mock.patch.object(search, 'fts_available', return_value=False):
+            self.assertEqual(self.search('した'), expected)
+
+    def test_pagination_and_snippet(self):
+        for i in range(5):
+            ChatMessage.objects.create(room=self.room, author=self.alice, content=f'日程の候補 {i}')
+        first, next_before = search.search_messages(self.alice, '日程', limit=4)
+        self.assertEqual(len(first), 4)
+        rest, last_before = search.search_messages(self.alice, '日程', before=next_before, limit=4)
+        self.assertEqual(len(rest), 2)
+        self.assertIsNone(last_before)
+        self.assertEqual(len({msg.pk for msg in first + rest}), 6)
+        self.assertIn('<mark>日程</mark>', first[0].snippet)
+
+
+class ArchiveTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username='alice')
+        self.bob = User.objects.create(username='bob')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+        self.start = timezone.now() - timedelta(days=10)
+        self.ids = create_messages(self.room, self.alice, 40, self.start)
+        first = ChatMessage.objects.get(pk=self.ids[0])
+        first.content, first.author = '日本語と emoji 🎉 と "引用"\n改行', self.bob
+        first.save()
+
+    def snapshot(self, messages):
+        return [(msg.id, msg.room_id, msg.author_id, msg.seq, msg.timestamp, msg.content) for msg in messages]
+
+    def test_pack_and_unpack_round_trip(self):
+        messages = list(ChatMessage.objects.filter(room=self.room).order_by('timestamp', 'id'))
+        data, raw_size = pack_messages(messages)
+        self.assertLess(len(data), raw_size)
+        block = ChatArchiveBlock(room=self.room, data=data)
+        self.assertEqual(self.snapshot(unpack_block(block)), self.snapshot(messages))
+
+    def test_compact_moves_old_days_into_blocks(self):
+        before = self.snapshot(ChatMessage.objects.filter(room=self.room).order_by('timestamp', 'id'))
+        cutoff = get_cutoff(5)
+        old_count = ChatMessage.objects.filter(timestamp__lt=cutoff).count()
+
+        result = compact(days=5)
+        self.assertEqual(result['messages'], old_count)
+        self.assertEqual(result['rooms'], 1)
+        self.assertFalse(ChatMessage.objects.filter(timestamp__lt=cutoff).exists())
+        # 1日1ブロック
+        days = ChatArchiveBlock.objects.filter(room=self.room).values_list('day', flat=True)
+        self.assertEqual(len(days), len(set(days)))
+        self.assertEqual(sum(ChatArchiveBlock.objects.values_list('message_count', flat=True)), old_count)
+
+        archived = get_archived_messages(self.room, limit=1000)
+        hot = list(ChatMessage.objects.filter(room=self.room))
+        after = sorted(self.snapshot(archived) + self.snapshot(hot), key=lambda row: (row[4], row[0]))
+        self.assertEqual(after, before)
+
+    def test_compact_is_repeatable_and_merges_late_messages(self):
+        compact(days=5)
+        blocks = ChatArchiveBlock.objects.count()
+        self.assertEqual(compact(days=5)['messages'], 0)
+
+        # 保管済みの日に遅れて届いたメッセージは同じブロックにまとめ直す
+        block = ChatArchiveBlock.objects.order_by('day').first()
+        late = ChatMessage.objects.create(
+            room=self.room, author=self.bob, content='late', seq=999, timestamp=block.first_timestamp,
+        )
+        result = compact(days=5)
+        self.assertEqual((result['messages'], result['blocks']), (1, 1))
+        self.assertEqual(ChatArchiveBlock.objects.count(), blocks)
+        block.refresh_from_db()
+        self.assertIn(late.pk, [msg.id for msg in unpack_block(block)])
+
+    def test_archived_messages_leave_search_index(self):
+        self.assertEqual(len(search.search_messages(self.alice, '日本語')[0]), 1)
+        compact(days=5)
+        self.assertEqual(search.search_messages(self.alice, '日本語')[0], [])
+
+
+@override_settings(CHAT_WS_AUTH={'TTL': 60})
+class WebSocketAuthTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.school = School.objects.create(name='第一高校', address='東京都')
+        self.alice = User.objects.create_user(username='alice', password='pass')
+        Student.objects.create(user=self.alice, school=self.school, full_name='アリス', grade=1)
+        self.bob = User.objects.create_user(username='bob', password='pass')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+        self.client.force_login(self.alice)
+        self.session_key = self.client.session.session_key
+
+    def test_session_is_cached(self):
+        user, role, display_name = resolve_session(self.session_key)
+        self.assertEqual((user.pk, user.username, role, display_name), (self.alice.pk, 'alice', ROLE_STUDENT, 'アリス（第一高校）'))
+        # 2回目はセッションもユーザーも読まない
+        with self.assertNumQueries(0):
+            user, role, display_name = resolve_session(self.session_key)
+        self.assertEqual((user.pk, role, display_name), (self.alice.pk, ROLE_STUDENT, 'アリス（第一高校）'))
+        # キーにはセッションキーそのものを使わない
+        self.assertNotIn(self.session_key, _cache_key(self.session_key))
+
+    def test_anonymous_session_is_not_cached(self):
+        user, role, display_name = resolve_session('no-such-session')
+        self.assertEqual((user.is_authenticated, role, display_name), (False, ROLE_GUEST, ''))
+        self.assertIsNone(cache.get(_cache_key('no-such-session')))
+        self.assertFalse(resolve_session(None)[0].is_authenticated)
+
+    def test_logout_forgets_session(self):
+        resolve_session(self.session_key)
+        self.assertIsNotNone(cache.get(_cache_key(self.session_key)))
+        self.client.logout()
+        self.assertIsNone(cache.get(_cache_key(self.session_key)))
+        self.assertFalse(resolve_session(self.session_key)[0].is_authenticated)
+
+    def test_inactive_user_is_rejected_after_ttl(self):
+        with mock.patch('time.time', return_value=1000.0) as now:
+            resolve_session(self.session_key)
+            User.objects.filter(pk=self.alice.pk).update(is_active=False)
+            # TTL の間は覚えている結果を使う
+            now.return_value = 1059.0
+            self.assertEqual(resolve_session(self.session_key)[0].pk, self.alice.pk)
+            now.return_value = 1061.0
+            self.assertFalse(resolve_session(self.session_key)[0].is_authenticated)
+
+    async def connect_with_cookie(self, session_key):
+        from config.asgi import application
+
+        communicator = WebsocketCommunicator(
+            application, f'/ws/chat/room/{self.room.pk}/',
+            headers=[(b'cookie', f'sessionid={session_key}'.encode())],
+        )
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    def test_websocket_connects_with_session_cookie(self):
+        async def run():
+            communicator, connected = await self.connect_with_cookie(self.session_key)
+            self.assertTrue(connected)
+            await communicator.send_json_to({'message': 'hello'})
+            data = await receive_reply(communicator)
+            self.assertEqual((data['author_id'], data['author_username']), (self.alice.pk, 'アリス（第一高校）'))
+            await communicator.disconnect()
+
+            communicator, connected = await self.connect_with_cookie('no-such-session')
+            self.assertFalse(connected)
+
+        async_to_sync(run)()
+
+
+class InboxTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='alice', password='pass')
+        self.bob = User.objects.create_user(username='bob', password='pass')
+        self.carol = User.objects.create_user(username='carol', password='pass')
+        self.room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+
+    def unread(self, room, user):
+        return ChatReadState.objects.get(room=room, user=user).unread_count
+
+    def test_unread_count_goes_up_for_the_other_party(self):
+        save_message(self.room, self.alice, 'こんにちは')
+        save_message(self.room, self.alice, 'よろしくお願いします')
+        self.assertEqual((self.unread(self.room, self.alice), self.unread(self.room, self.bob)), (0, 2))
+        save_message(self.room, self.bob, '返信です')
+        self.assertEqual((self.unread(self.room, self.alice), self.unread(self.room, self.bob)), (1, 2))
+
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.last_message_preview, self.room.last_author), ('返信です', self.bob))
+
+    def test_summaries_from_a_batch(self):
+        group = ChatRoom.objects.create_group(self.alice, 'グループ', [self.bob, self.carol])
+        now = timezone.now()
+        messages = [
+            build_message(group, self.alice, 'alice 1', 1),
+            build_message(group, self.bob, 'bob 1', 2),
+            build_message(group, self.alice, 'alice 2', 3),
+        ]
+        for i, msg in enumerate(messages):
+            msg.timestamp = now + timedelta(seconds=i)
+        ChatMessage.objects.bulk_create(messages)
+        update_room_summaries(messages)
+        self.assertEqual(
+            [self.unread(group, user) for user in (self.alice, self.bob, self.carol)], [1, 2, 3],
+        )
+        group.refresh_from_db()
+        self.assertEqual((group.last_message_at, group.last_message_preview), (messages[-1].timestamp, 'alice 2'))
+
+        # 遅れて届いた古いメッセージで最後のメッセージは戻らない
+        late = build_message(group, self.carol, 'late', 4)
+        late.timestamp = now - timedelta(minutes=1)
+        late.save()
+        update_room_summaries([late])
+        group.refresh_from_db()
+        self.assertEqual(group.last_message_preview, 'alice 2')
+        self.assertEqual(self.unread(group, self.carol), 3)
+
+    def test_mark_read_resets_the_count(self):
+        for text in ('1', '2', '3'):
+            save_message(self.room, self.alice, text)
+        mark_read(self.room, self.bob)
+        state = ChatReadState.objects.get(room=self.room, user=self.bob)
+        self.assertEqual(state.unread_count, 0)
+        self.assertIsNotNone(state.last_read_at)
+
+        # 画面を開いても既読になる
+        save_message(self.room, self.alice, '4')
+        self.client.force_login(self.bob)
+        self.client.get(reverse('chat:chat_room', args=[self.room.pk]))
+        self.assertEqual(self.unread(self.room, self.bob), 0)
+
+    def test_mark_read_creates_missing_state(self):
+        ChatReadState.objects.filter(room=self.room, user=self.bob).delete()
+        mark_read(self.room, self.bob)
+        self.assertEqual(self.unread(self.room, self.bob), 0)
+
+    def test_inbox_is_ordered_by_last_message(self):
+        quiet, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.carol)
+        group = ChatRoom.objects.create_group(self.bob, 'グループ', [self.alice, self.carol])
+        save_message(group, self.bob, '古い方')
+        save_message(self.room, self.bob, '新しい方')
+        save_message(self.room, self.bob, 'もう1件')
+        self.client.force_login(self.alice)
+
+        with self.assertNumQueries(5):
+            # セッション・ユーザー・ロール (プロフィール)・既読状態とルーム・表示名
+            response = self.client.get(reverse('chat:chat_list'))
+        rooms = response.context['chat_rooms']
+        # メッセージの無いルームは最後
+        self.assertEqual(rooms, [self.room, group, quiet])
+        self.assertEqual([room.unread_count for room in rooms], [2, 1, 0])
+        self.assertEqual([room.other_participant_display_name for room in rooms], ['bob', 'グループ', 'carol'])
+        self.assertEqual(rooms[0].last_message_preview, 'もう1件')
+
+
+class DirectRoomTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user(username='alice', password='pass')
+        self.bob = User.objects.create_user(username='bob', password='pass')
+        self.carol = User.objects.create_user(username='carol', password='pass')
+
+    def test_get_or_create_direct(self):
+        room, created = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+        self.assertTrue(created)
+        self.assertEqual(room.pair_key, make_pair_key(self.bob, self.alice))
+        self.assertEqual(set(room.participants.all()), {self.alice, self.bob})
+        self.assertEqual(set(ChatReadState.objects.filter(room=room).values_list('user_id', flat=True)),
+                         {self.alice.pk, self.bob.pk})
+        # 逆の順番でも同じルーム
+        self.assertEqual(ChatRoom.objects.get_or_create_direct(self.bob.pk, self.alice), (room, False))
+        self.assertEqual(ChatRoom.objects.count(), 1)
+
+    def test_concurrently_created_room_is_reused(self):
+        room, _ = ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+        # 最初の検索では見つからず、作成がユニーク制約に当たった (同時に作られた) 場合
+        with mock.patch.object(ChatRoom.objects, 'filter', return_value=ChatRoom.objects.none()), \
+                mock.patch.object(ChatRoom.objects, 'create', wraps=ChatRoom.objects.create) as create:
+            self.assertEqual(ChatRoom.objects.get_or_create_direct(self.bob, self.alice), (room, False))
+        create.assert_called_once_with(pair_key=room.pair_key)
+        self.assertEqual(ChatRoom.objects.count(), 1)
+        self.assertEqual(ChatReadState.objects.filter(room=room).count(), 2)
+
+    def test_find_direct(self):
+        self.assertIsNone(ChatRoom.objects.find_direct(self.alice))
+        self.assertIsNone(ChatRoom.objects.find_direct(self.alice, self.bob, self.carol))
+        room, _ = ChatRoom.objects.get_or_create_direct(self.carol, self.alice)
+        self.assertEqual(ChatRoom.objects.find_direct(self.alice, self.bob.pk, self.carol.pk), room)
+        self.assertIsNone(ChatRoom.objects.find_direct(self.bob, self.alice, self.carol))
+        # グループルームは1対1ルームとして見つからない
+        ChatRoom.objects.create_group(self.bob, 'グループ', [self.alice])
+        self.assertIsNone(ChatRoom.objects.find_direct(self.bob, self.alice))
+
+    def legacy_room(self, *users):
+        """ 0004 で pair_key が付かなかった古い1対1ルーム """
+        room = ChatRoom.objects.create()
+        room.participants.add(*users)
+        ChatReadState.objects.bulk_create([ChatReadState(room=room, user=user) for user in users])
+        return room
+
+    def test_other_user_of_legacy_room(self):
+        room = self.legacy_room(self.alice, self.bob)
+        self.assertEqual(room.other_user_id(self.alice.pk), self.bob.pk)
+        self.assertEqual(room.other_user_id(self.bob.pk), self.alice.pk)
+        self.assertIsNone(self.legacy_room(self.alice).other_user_id(self.alice.pk))
+        group = ChatRoom.objects.create_group(self.alice, 'グループ', [self.bob])
+        with self.assertNumQueries(0):
+            self.assertIsNone(group.other_user_id(self.alice.pk))
+
+    def test_legacy_rooms_show_other_user_in_inbox_and_search(self):
+        room = self.legacy_room(self.alice, self.bob)
+        ChatMessage.objects.create(room=room, author=self.bob, content='古いルームのメッセージ')
+        self.legacy_room(self.alice, self.bob, self.carol)
+        self.client.force_login(self.alice)
+
+        response = self.client.get(reverse('chat:chat_list'))
+        names = sorted(room.other_participant_display_name for room in response.context['chat_rooms'])
+        self.assertEqual(names, ['bob', 'bob'])
+
+        response = self.client.get(reverse('chat:chat_search'), {'q': '古いルーム'})
+        [msg] = response.context['results']
+        self.assertEqual(msg.other_participant_display_name, 'bob')
+
+
+class ChatRoomAdminTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(username='admin', password='pass')
+        self.alice = User.objects.create_user(username='alice', password='pass')
+        self.bob = User.objects.create_user(username='bob', password='pass')
+        self.carol = User.objects.create_user(username='carol', password='pass')
+        self.client.force_login(self.admin)
+
+    def save(self, participants, is_group=False, name='', room=None):
+        url = (
+            reverse('admin:chat_chatroom_change', args=[room.pk]) if room
+            else reverse('admin:chat_chatroom_add')
+        )
+        return self.client.post(url, {
+            'participants': [u.pk for u in participants],
+            'is_group': 'on' if is_group else '',
+            'name': name,
+            'last_message_preview': '',
+            # ChatMessageInline の管理フォーム
+            'messages-TOTAL_FORMS': '0',
+            'messages-INITIAL_FORMS': '0',
+            'messages-MIN_NUM_FORMS': '0',
+            'messages-MAX_NUM_FORMS': '1000',
+        })
+
+    def read_state_users(self, room):
+        return set(ChatReadState.objects.filter(room=room).values_list('user_id', flat=True))
+
+    def test_direct_room_gets_pair_key_and_read_states(self):
+        response = self.save([self.alice, self.bob])
+        self.assertEqual(response.status_code, 302)
+        room = ChatRoom.objects.get()
+        self.assertEqual(room.pair_key, make_pair_key(self.alice, self.bob))
+        self.assertEqual(self.read_state_users(room), {self.alice.pk, self.bob.pk})
+        # 画面から開いたときと同じルームになる
+        self.assertEqual(ChatRoom.objects.get_or_create_direct(self.bob, self.alice), (room, False))
+
+    def test_duplicate_direct_room_is_rejected(self):
+        ChatRoom.objects.get_or_create_direct(self.alice, self.bob)
+        response = self.save([self.bob, self.alice])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ChatRoom.objects.count(), 1)
+
+    def test_direct_room_needs_two_participants(self):
+        response = self.save([self.alice, self.bob, self.carol])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ChatRoom.objects.exists())
+
+    def test_group_room_members_are_synced(self):
+        self.save([self.alice, self.bob, self.carol], is_group=True, name='クラス')
+        room = ChatRoom.objects.get()
+        self.assertIsNone(room.pair_key)
+        self.assertEqual(self.read_state_users(room), {self.alice.pk, self.bob.pk, self.carol.pk})
+
+        # 参加者を外すと既読状態も消え、未読数を持っていた人の行は残る
+        ChatReadState.objects.filter(room=room, user=self.alice).update(unread_count=3)
+        self.save([self.alice, self.bob], is_group=True, name='クラス', room=room)
+        self.assertEqual(self.read_state_users(room), {self.alice.pk, self.bob.pk})
+        self.assertEqual(ChatReadState.objects.get(room=room, user=self.alice).unread_count, 3)
+
+    def test_group_changed_to_direct_room(self):
+        room = ChatRoom.objects.create_group(self.alice, 'グループ', [self.bob])
+        response = self.save([self.alice, self.bob], room=room)
+        self.assertEqual(response.status_code, 302)
+        room.refresh_from_db()
+        self.assertEqual(room.pair_key, make_pair_key(self.alice, self.bob))
+
+    def test_messages_cannot_be_added_from_admin(self):
+        self.assertEqual(self.client.get(reverse('admin:chat_chatmessage_add')).status_code, 403)
@@ -0,0 +1,36 @@
+"""
+全文検索 (chat.search) 用に本文を区切る処理
+
+FTS5 の標準のトークナイザーは日本語を単語に分けられないので、本文を
+「2文字ずつ (bigram)」に区切って空白でつないだ文字列 (ChatMessage.search_text) を保存し、
+それを索引に入れる。検索語も同じように区切る。
+"""
+import re
+import unicodedata
+
+# 英数字はひとかたまりで1語、それ以外 (日本語など) は2文字ずつ区切る
+_WORD_RE = re.compile(r'[0-9a-z_]+|[^\W0-9a-z_]+')
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def bigrams(text):
+    """
+    索引・検索用に区切った語のリスト
+    「日本語」→ ['日本', '本語', '語'] (最後の1文字も入れておき、1文字の検索語でも前方一致で探せるようにする)
+    """
+    tokens = []
+    for run in _WORD_RE.findall(normalize(text or '')):
+        if run.isascii():
+            tokens.append(run)
+            continue
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return tokens
+
+
+def bigram_text(text):
+    """ FTS5 の unicode61 トークナイザーにそのまま渡せる形 (空白区切り) """
+    return ' '.join(bigrams(text))
@@ -7,6 +7,10 @@ urlpatterns = [
     # チャットテスト用のページURL
     path('test/', views.chat_test_room, name='chat_test_room'),
     path('start/<int:user_id>/', views.start_chat, name='start_chat'),
+    path('group/new/', views.create_group_room, name='create_group_room'),
     path('room/<int:room_id>/', views.chat_room, name='chat_room'),
+    path('room/<int:room_id>/history/', views.chat_history, name='chat_history'),
     path('list/', views.ChatRoomListView.as_view(), name='chat_list'),
+    path('search/', views.chat_search, name='chat_search'),
+    path('stats/', views.chat_stats, name='chat_stats'),
 ]
\ No newline at end of file
@@ -3,43 +3,20 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from .models import ChatRoom, ChatMessage
-from django.db.models import Q, Count, OuterRef, Subquery
+from .models import ChatRoom, ChatReadState, prefetch_legacy_participants
+from django.db.models import F
 from django.views.generic import ListView
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.urls import reverse, reverse_lazy
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, JsonResponse
 
-# ★ 1. モデルをインポート
-from accounts.models import Student, Teacher, CompanyRepresentative
-
-# ★ 2. === ヘルパー関数 (consumers.py からコピー) ===
-def get_display_name(user):
-    """ ユーザーオブジェクトから、チャット用の表示名を取得する """
-    try:
-        if hasattr(user, 'student'):
-            profile = user.student
-            school_name = profile.school.name if profile.school else "所属未設定"
-            return f"{profile.full_name}（{school_name}）"
-            
-        elif hasattr(user, 'teacher'):
-            profile = user.teacher
-            school_name = profile.school.name if profile.school else "所属未設定"
-            return f"{profile.full_name} 先生（{school_name}）"
-            
-        elif hasattr(user, 'companyrepresentative'):
-            profile = user.companyrepresentative
-            company_name = profile.company.name if profile.company else "所属未設定"
-            return f"{profile.full_name} 様（{company_name}）"
-            
-        elif user.is_superuser:
-            return f"{user.username} (管理者)"
-            
-    except Exception:
-        pass 
-        
-    return user.username
-# === ヘルパー関数ここまで ===
+from .display_names import resolve_display_names
+from .services import get_member_room, get_history, mark_read, serialize_message, HISTORY_PAGE_SIZE, MAX_DB_INTEGER
+from .buffer import get_buffer, write_behind_enabled
+from .ratelimit import get_rate_limit_stats
+from .search import search_messages
+from .forms import GroupRoomForm, get_group_candidates
+from accounts.roles import ROLE_TEACHER, ROLE_COMPANY
 
 
 @login_required
@@ -50,18 +27,8 @@ def chat_test_room(request):
 def start_chat(request, user_id):
     other_user = get_object_or_404(User, id=user_id)
     
-    room = ChatRoom.objects.annotate(
-        num_participants=Count('participants')
-    ).filter(
-        num_participants=2,
-        participants=request.user
-    ).filter(
-        participants=other_user
-    ).first()
-
-    if not room:
-        room = ChatRoom.objects.create()
-        room.participants.add(request.user, other_user)
+    # pair_key で1対1ルームを引く (無ければ作成。同時に押されても重複しない)
+    room, _created = ChatRoom.objects.get_or_create_direct(request.user, other_user)
         
     next_url = request.GET.get('next', reverse_lazy('chat:chat_list'))
     
@@ -70,25 +37,38 @@ def start_chat(request, user_id):
     return redirect(redirect_url)
 
 
+# グループチャットの作成 (教員・企業担当者のみ)
+@login_required
+def create_group_room(request):
+    if request.role not in (ROLE_TEACHER, ROLE_COMPANY) and not request.user.is_superuser:
+        return HttpResponseForbidden("アクセス権がありません。")
+
+    candidates = get_group_candidates(request.user, request.role, request.profile)
+    if request.method == 'POST':
+        form = GroupRoomForm(request.POST, candidates=candidates)
+        if form.is_valid():
+            room = ChatRoom.objects.create_group(
+                request.user, form.cleaned_data['name'], form.cleaned_data['members']
+            )
+            return redirect('chat:chat_room', room_id=room.id)
+    else:
+        form = GroupRoomForm(candidates=candidates)
+
+    return render(request, 'chat/group_create.html', {'form': form})
+
+
 # ★ 3. === chat_room ビューを修正 ===
 @login_required
 def chat_room(request, room_id):
-    try:
-        room = ChatRoom.objects.get(id=room_id)
-        
-        if request.user not in room.participants.all():
-            return redirect('accounts:dashboard')
-            
-        # 過去のメッセージを取得 (author情報も一緒に取得)
-        messages = room.messages.all().select_related('author').order_by('timestamp')
-        
-        # ★ 過去のメッセージにも表示名を追加
-        for msg in messages:
-            msg.author_display_name = get_display_name(msg.author)
-            
-    except ChatRoom.DoesNotExist:
+    # 参加していないルーム・存在しないルームはダッシュボードへ
+    room = get_member_room(room_id, request.user)
+    if room is None:
         return redirect('accounts:dashboard')
 
+    # 最新の HISTORY_PAGE_SIZE 件だけ表示する (それより前は「さらに読み込む」で取得)
+    messages, next_cursor = get_history(room)
+    mark_read(room, request.user)
+
     default_back_url = reverse_lazy('chat:chat_list')
     back_url = request.GET.get('next', default_back_url)
     
@@ -98,13 +78,86 @@ def chat_room(request, room_id):
     context = {
         'room': room,
         'room_id': room.id,
+        'room_title': room.name if room.is_group else "チャットルーム",
         'messages': messages, # ★ 表示名が追加されたメッセージリスト
+        'next_cursor': next_cursor,
+        # 表示した最後のメッセージの通し番号 (WebSocket の resume で使う)
+        'last_seq': messages[-1].seq if messages else 0,
         'back_url': back_url,
     }
     
     return render(request, 'chat/chat_room.html', context)
 
 
+# 過去のメッセージ (JSON)
+@login_required
+def chat_history(request, room_id):
+    room = get_member_room(room_id, request.user)
+    if room is None:
+        return HttpResponseForbidden("アクセス権がありません。")
+
+    try:
+        limit = int(request.GET.get('limit', HISTORY_PAGE_SIZE))
+        messages, next_cursor = get_history(room, before=request.GET.get('before'), limit=limit)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+
+    return JsonResponse({
+        'messages': [serialize_message(msg) for msg in messages],
+        'next_cursor': next_cursor,
+    })
+
+
+# 自分が参加しているチャットのメッセージを検索
+@login_required
+def chat_search(request):
+    query = request.GET.get('q', '').strip()
+    try:
+        before = int(request.GET['before']) if request.GET.get('before') else None
+    except ValueError:
+        before = None
+    if before is not None and not 0 < before <= MAX_DB_INTEGER:
+        before = None
+
+    results, next_before = [], None
+    if query:
+        results, next_before = search_messages(request.user, query, before=before)
+        # ★ 相手と送信者の表示名はまとめて1回で取得
+        prefetch_legacy_participants({msg.room.pk: msg.room for msg in results}.values())
+        for msg in results:
+            msg.other_participant_id = msg.room.other_user_id(request.user.pk)
+        names = resolve_display_names(
+            [msg.other_participant_id for msg in results if not msg.room.is_group]
+            + [msg.author_id for msg in results]
+        )
+        for msg in results:
+            if msg.room.is_group:
+                msg.other_participant_display_name = msg.room.name
+            else:
+                msg.other_participant_display_name = names.get(msg.other_participant_id, "（不明な相手）")
+            msg.author_display_name = names.get(msg.author_id, "（不明なユーザー）")
+
+    context = {
+        'query': query,
+        'results': results,
+        'next_before': next_before,
+    }
+    return render(request, 'chat/chat_search.html', context)
+
+
+# 監視用の集計 (JSON, 管理者のみ)
+# ※ 集計はプロセス内のものなので、WebSocket を受けているプロセス (daphne) に問い合わせること
+@login_required
+def chat_stats(request):
+    if not request.user.is_superuser:
+        return HttpResponseForbidden("アクセス権がありません。")
+
+    return JsonResponse({
+        'rate_limit': get_rate_limit_stats(),
+        'write_behind': get_buffer().stats() if write_behind_enabled() else None,
+    })
+
+
 # チャット一覧（受信箱）
 class ChatRoomListView(LoginRequiredMixin, ListView):
     model = ChatRoom
@@ -114,33 +167,31 @@ class ChatRoomListView(LoginRequiredMixin, ListView):
     def get_queryset(self):
         user = self.request.user
         
-        last_message = ChatMessage.objects.filter(
-            room=OuterRef('pk')
-        ).order_by('-timestamp')
-
-        queryset = ChatRoom.objects.filter(
-            participants=user
-        ).annotate(
-            last_message_timestamp=Subquery(last_message.values('timestamp')[:1]),
-            last_message_content=Subquery(last_message.values('content')[:1]),
-            other_participant_id=Subquery(
-                ChatRoom.participants.through.objects.filter(
-                    chatroom=OuterRef('pk')
-                ).exclude(
-                    user=user
-                ).values('user_id')[:1]
-            )
-        ).order_by('-last_message_timestamp')
-        
-        other_user_ids = [room.other_participant_id for room in queryset if room.other_participant_id]
-        other_users = User.objects.in_bulk(other_user_ids)
-
-        # ★ ここも修正: 一覧画面の「相手」の表示名も取得
-        for room in queryset:
-            other_user = other_users.get(room.other_participant_id)
-            if other_user:
-                room.other_participant_display_name = get_display_name(other_user)
+        # 自分の既読状態から、ルーム (最後のメッセージを保持している) を JOIN して1本で取る
+        read_states = ChatReadState.objects.filter(
+            user=user
+        ).select_related(
+            'room'
+        ).order_by(
+            F('room__last_message_at').desc(nulls_last=True), '-room_id'
+        )
+
+        rooms = []
+        for state in read_states:
+            room = state.room
+            room.unread_count = state.unread_count
+            rooms.append(room)
+        # 相手は pair_key から分かる (pair_key の無い古いルームだけ参加者を読む)
+        prefetch_legacy_participants(rooms)
+        for room in rooms:
+            room.other_participant_id = room.other_user_id(user.pk)
+
+        # ★ 一覧画面の「相手」の表示名はまとめて1回で取得 (グループはグループ名)
+        names = resolve_display_names(room.other_participant_id for room in rooms if not room.is_group)
+        for room in rooms:
+            if room.is_group:
+                room.other_participant_display_name = room.name
             else:
-                room.other_participant_display_name = "（不明な相手）"
+                room.other_participant_display_name = names.get(room.other_participant_id, "（不明な相手）")
             
-        return queryset
\ No newline at end of file
+        return rooms
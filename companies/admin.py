@@ -1,5 +1,6 @@
 from django.contrib import admin
 from .models import Company, Scout,CompanyTag #CompanyTag追加
+from core.matching import company_tags_changed
 
 # 1. タグのインライン設定
 class CompanyTagInline(admin.TabularInline):
@@ -12,6 +13,11 @@ class CompanyAdmin(admin.ModelAdmin):
     # ★ この行がないと画面に表示されません！
     inlines = [CompanyTagInline]
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # 管理画面でタグを編集した場合もマッチ度を更新する
+        company_tags_changed(form.instance)
+
 @admin.register(Scout)
 class ScoutAdmin(admin.ModelAdmin):
     list_display = ('company', 'student', 'created_at')
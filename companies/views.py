@@ -7,8 +7,10 @@ from accounts.models import FavoriteCompany, Student
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from chat.models import ChatRoom
-from django.db.models import Count, Q
-from core.utils import calculate_match_percentage
+from django.db.models import Q, FilteredRelation
+from django.db.models.functions import Coalesce
+from core.matching import get_match_score
+from accounts.roles import ROLE_STUDENT, ROLE_TEACHER
 
 # 1. 企業一覧ビュー
 class CompanyListView(LoginRequiredMixin, StudentOrTeacherOnlyMixin, ListView):
@@ -36,6 +38,15 @@ class CompanyListView(LoginRequiredMixin, StudentOrTeacherOnlyMixin, ListView):
         
         if sort_by == 'industry':
             queryset = queryset.order_by('industry')
+        elif sort_by == 'match' and self.request.role == ROLE_STUDENT:
+            # マッチ度順: 計算済みの MatchScore を LEFT JOIN して並べ替える (行が無ければ 0%)
+            queryset = queryset.annotate(
+                my_score=FilteredRelation(
+                    'match_scores',
+                    condition=Q(match_scores__student=self.request.profile),
+                ),
+                match_rate=Coalesce('my_score__percentage', 0),
+            ).order_by('-match_rate', 'name')
         else:
             queryset = queryset.order_by('name')
 
@@ -58,14 +69,16 @@ class CompanyDetailView(LoginRequiredMixin, StudentOrTeacherOnlyMixin, DetailVie
         company = self.get_object()
         user = self.request.user
         
-        rep_users = User.objects.filter(companyrepresentative__company=company)
+        rep_user_ids = list(
+            User.objects.filter(companyrepresentative__company=company).order_by('pk').values_list('pk', flat=True)
+        )
         
         # --- ログインユーザーが「学生」の場合 ---
-        if hasattr(user, 'student'):
-            student = user.student
+        if self.request.role == ROLE_STUDENT:
+            student = self.request.profile
 
-            # ★★★ マッチ度とタグ情報の計算・追加 ★★★
-            match_data = calculate_match_percentage(student, company)
+            # ★★★ マッチ度とタグ情報 (計算済みの MatchScore から取得) ★★★
+            match_data = get_match_score(student, company)
             
             # 辞書からデータを取り出してテンプレートへ渡す
             context['match_rate'] = match_data['percentage']
@@ -77,50 +90,36 @@ class CompanyDetailView(LoginRequiredMixin, StudentOrTeacherOnlyMixin, DetailVie
             context['is_favorited'] = is_favorited
             
             # (B) チャットルームの状態をチェック
-            if rep_users.exists():
-                existing_room = ChatRoom.objects.annotate(
-                    num_participants=Count('participants')
-                ).filter(
-                    num_participants=2,
-                    participants=student.user
-                ).filter(
-                    participants__in=rep_users
-                ).first()
+            if rep_user_ids:
+                existing_room = ChatRoom.objects.find_direct(user, *rep_user_ids)
 
                 if existing_room:
                     context['existing_chat_room_id'] = existing_room.id
                 else:
-                    context['first_rep_user_id'] = rep_users.first().id
+                    context['first_rep_user_id'] = rep_user_ids[0]
         
         # --- ログインユーザーが「教員」の場合 ---
-        elif hasattr(user, 'teacher'):
+        elif self.request.role == ROLE_TEACHER:
             teacher_user = user
             
-            if rep_users.exists():
-                existing_room = ChatRoom.objects.annotate(
-                    num_participants=Count('participants')
-                ).filter(
-                    num_participants=2,
-                    participants=teacher_user
-                ).filter(
-                    participants__in=rep_users
-                ).first()
+            if rep_user_ids:
+                existing_room = ChatRoom.objects.find_direct(teacher_user, *rep_user_ids)
             
                 if existing_room:
                     context['existing_chat_room_id'] = existing_room.id
                 else:
-                    context['first_rep_user_id'] = rep_users.first().id
+                    context['first_rep_user_id'] = rep_user_ids[0]
             
         return context
 
 # 4. お気に入り追加ビュー
 @login_required
 def add_favorite(request, company_pk):
-    if not hasattr(request.user, 'student'):
+    if request.role != ROLE_STUDENT:
         return redirect('companies:detail', pk=company_pk)
         
     company = get_object_or_404(Company, pk=company_pk)
-    student = request.user.student
+    student = request.profile
     
     FavoriteCompany.objects.get_or_create(student=student, company=company)
     return redirect('companies:detail', pk=company_pk)
@@ -128,11 +127,11 @@ def add_favorite(request, company_pk):
 # 5. お気に入り削除ビュー
 @login_required
 def remove_favorite(request, company_pk):
-    if not hasattr(request.user, 'student'):
+    if request.role != ROLE_STUDENT:
         return redirect('companies:detail', pk=company_pk)
         
     company = get_object_or_404(Company, pk=company_pk)
-    student = request.user.student
+    student = request.profile
     
     FavoriteCompany.objects.filter(student=student, company=company).delete()
     return redirect('companies:detail', pk=company_pk)
@@ -145,10 +144,10 @@ class ScoutedStudentListView(LoginRequiredMixin, CompanyOnlyMixin, ListView):
     paginate_by = 10
 
     def get_queryset(self):
-        company = self.request.user.companyrepresentative.company
+        company = self.request.profile.company
         return Scout.objects.filter(company=company).order_by('-created_at')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['company_name'] = self.request.user.companyrepresentative.company.name
+        context['company_name'] = self.request.profile.company.name
         return context
\ No newline at end of file
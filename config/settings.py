@@ -51,10 +51,13 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # セッション・認証の SQL も数えるので、なるべく先頭に置く
+    'core.middleware.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'accounts.middleware.RoleMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -92,6 +95,15 @@ CHANNEL_LAYERS = {
         # CONFIG は不要なので削除
     }
 }
+# 複数プロセスで動かすときは、requirements.txt の channels-redis を使う
+# (InMemoryChannelLayer はプロセスをまたいで配信できない)。例:
+# CHANNEL_LAYERS = {
+#     "default": {
+#         "BACKEND": "channels_redis.core.RedisChannelLayer",
+#         "CONFIG": {"hosts": ["redis://127.0.0.1:6379"]},
+#     }
+# }
+# 負荷試験は python manage.py chat_loadtest --redis redis://127.0.0.1:6379 で同じ構成を試せる
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -167,4 +179,88 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 # メール設定（開発用：コンソールに出力する）
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
-DEFAULT_FROM_EMAIL = 'webmaster@localhost'
\ No newline at end of file
+DEFAULT_FROM_EMAIL = 'webmaster@localhost'
+
+# SQL クエリ数の監視 (core.middleware.QueryBudgetMiddleware)
+# 上限を超えたり N+1 っぽい SQL があると warning ログを出す
+QUERY_BUDGET = {
+    'ENABLED': DEBUG,
+    # 同じ形の SQL が1リクエストでこの回数を超えたら N+1 とみなす
+    'N_PLUS_ONE_THRESHOLD': 10,
+    # URL名ごとのクエリ数の上限 (ビュー側で @query_budget を付けた場合はそちらが優先)
+    'BUDGETS': {
+        'companies:list': 15,
+        'companies:detail': 15,
+        'accounts:company_student_list': 15,
+        'accounts:teacher_student_list': 15,
+        'accounts:student_detail': 20,
+        'chat:chat_list': 15,
+        'chat:chat_room': 15,
+        'chat:chat_search': 15,
+    },
+    # テストで上限超過を失敗扱いにしたいときは True にする
+    'RAISE': False,
+    'RESPONSE_HEADERS': DEBUG,
+}
+
+# チャットメッセージの書き込みをまとめる (chat.buffer)
+# 有効にすると配信はすぐ行い、保存は FLUSH_INTERVAL_MS ごと or MAX_BATCH 件ごとに bulk_create する
+CHAT_WRITE_BEHIND = {
+    'ENABLED': False,
+    'FLUSH_INTERVAL_MS': 50,
+    'MAX_BATCH': 200,
+    'SEQ_BLOCK': 100,
+    'MAX_RETRIES': 5,
+    'RETRY_INTERVAL_MS': 1000,
+}
+
+# チャットのオンライン状態・入力中の表示 (chat.presence)
+CHAT_PRESENCE = {
+    'TTL': 60,
+    'HEARTBEAT_INTERVAL': 25,
+    'TYPING_INTERVAL_MS': 2000,
+}
+
+# チャットの受信のレート制限 (chat.ratelimit)
+# 接続ごと: すべてのフレーム / ユーザーごと: メッセージの送信だけ
+CHAT_RATE_LIMIT = {
+    'ENABLED': True,
+    'CONNECTION_BURST': 20,
+    'CONNECTION_RATE': 5,
+    'USER_BURST': 10,
+    'USER_RATE': 2,
+    'MAX_VIOLATIONS': 50,
+}
+
+# 古いチャットメッセージの保管 (chat.archive / compact_chat_messages コマンド)
+CHAT_ARCHIVE = {
+    'AFTER_DAYS': 180,
+    'COMPRESSION_LEVEL': 6,
+}
+
+# WebSocket 接続時の認証のキャッシュ (chat.auth)
+CHAT_WS_AUTH = {
+    'TTL': 60,
+}
+
+# ポートフォリオの作品ファイルの分割アップロード (portfolios.uploads)
+# MAX_FILE_SIZE・STUDENT_QUOTA (学生ごとの合計) はフォームからのアップロード (portfolios.upload_handlers) にも使う
+PORTFOLIO_UPLOAD = {
+    'CHUNK_SIZE': 8 * 1024 * 1024,
+    'MAX_FILE_SIZE': 500 * 1024 * 1024,
+    'STUDENT_QUOTA': 2 * 1024 * 1024 * 1024,
+    'EXPIRE_HOURS': 24,
+    'TEMP_DIR': None,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'core.middleware': {'handlers': ['console'], 'level': 'WARNING'},
+        'chat': {'handlers': ['console'], 'level': 'WARNING'},
+    },
+}
@@ -1,5 +1,10 @@
 from django.contrib import admin
-from .models import Announcement,Tag #Tag追加
+from .models import Announcement,Tag,MatchScore #Tag追加
 
 admin.site.register(Announcement)
-admin.site.register(Tag) # Tagを登録
\ No newline at end of file
+admin.site.register(Tag) # Tagを登録
+
+@admin.register(MatchScore)
+class MatchScoreAdmin(admin.ModelAdmin):
+    list_display = ('student', 'company', 'percentage', 'version', 'updated_at')
+    search_fields = ('student__full_name', 'company__name')
\ No newline at end of file
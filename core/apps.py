@@ -5,3 +5,7 @@ class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
     verbose_name = '基本機能（お知らせ等）'
+
+    def ready(self):
+        # タグの転置インデックスの更新 (core.signals) を登録する
+        from . import signals  # noqa: F401
@@ -0,0 +1,148 @@
+"""
+ベンチマーク (run_benchmarks コマンドから使う)
+
+固定シードのデータを作り、マッチ度計算・一覧画面・チャット画面を
+Django のテストクライアント経由で繰り返し実行して、
+実行時間のパーセンタイル・SQL の件数・取得行数を集計する。
+"""
+import math
+import time
+
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+
+from accounts.models import Student, CompanyRepresentative
+from chat.models import ChatRoom
+from .matching import get_match_score, rebuild_match_scores
+from .query_stats import QueryRecorder
+from .scale_data import ScaleDataGenerator
+from .utils import calculate_match_percentage
+
+# ベンチマーク用データの規模 (結果を比較するときは同じ値で実行すること)
+DEFAULT_DATASET = {
+    'schools': 50,
+    'students': 2000,
+    'companies': 200,
+    'chat_rooms': 500,
+    'messages_per_room': 50,
+}
+
+
+def seed_dataset(seed=42, **sizes):
+    """ ベンチマーク用のデータを作る (空のテスト用 DB に対して実行する) """
+    dataset = dict(DEFAULT_DATASET, **sizes)
+    generator = ScaleDataGenerator(seed=seed, prefix='bench')
+    generator.ensure_tags()
+    generator.generate(**dataset)
+    rebuild_match_scores()
+    return dataset
+
+
+def percentile(values, p):
+    """ 最近傍順位法によるパーセンタイル """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Scenario:
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    def run(self, iterations):
+        timings = []
+        queries = []
+        rows = []
+        sql_times = []
+        for _ in range(iterations):
+            with QueryRecorder() as recorder:
+                started = time.perf_counter()
+                self.func()
+                timings.append(time.perf_counter() - started)
+            queries.append(recorder.count)
+            rows.append(recorder.rows)
+            sql_times.append(recorder.total_time)
+
+        def ms(value):
+            return round(value * 1000, 3)
+
+        return {
+            'iterations': iterations,
+            'p50_ms': ms(percentile(timings, 50)),
+            'p90_ms': ms(percentile(timings, 90)),
+            'p99_ms': ms(percentile(timings, 99)),
+            'mean_ms': ms(sum(timings) / len(timings)),
+            'queries': max(queries),
+            'rows': max(rows),
+            'sql_ms': ms(sum(sql_times) / len(sql_times)),
+        }
+
+
+def _client_for(user):
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def _get(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError(f'{url} が {response.status_code} を返しました')
+    return response
+
+
+def build_scenarios():
+    """ 計測対象のシナリオを作る (データ作成後に呼ぶこと) """
+    student = Student.objects.filter(tags__isnull=False).order_by('pk').first()
+    rep = CompanyRepresentative.objects.filter(company__tags__isnull=False).select_related('company').order_by('pk').first()
+    company = rep.company
+    # メッセージが一番多いルームと、その参加者
+    busiest_room = ChatRoom.objects.annotate(n=Count('messages')).order_by('-n', 'pk').first()
+    chat_user = busiest_room.participants.order_by('pk').first()
+
+    student_client = _client_for(student.user)
+    rep_client = _client_for(rep.user)
+    chat_client = _client_for(chat_user)
+
+    company_list = reverse('companies:list')
+    student_list = reverse('accounts:company_student_list')
+    chat_list = reverse('chat:chat_list')
+    chat_room = reverse('chat:chat_room', args=[busiest_room.pk])
+
+    return [
+        Scenario('calculate_match_percentage', lambda: calculate_match_percentage(student, company)),
+        Scenario('get_match_score', lambda: get_match_score(student, company)),
+        Scenario('company_list', lambda: _get(student_client, company_list)),
+        Scenario('company_list_sort_match', lambda: _get(student_client, f'{company_list}?sort=match')),
+        Scenario('company_student_list', lambda: _get(rep_client, student_list)),
+        Scenario('company_student_list_sort_match', lambda: _get(rep_client, f'{student_list}?sort=match')),
+        Scenario('chat_list', lambda: _get(chat_client, chat_list)),
+        Scenario('chat_room', lambda: _get(chat_client, chat_room)),
+    ]
+
+
+def compare(current, baseline, threshold=1.2):
+    """
+    前回の結果 (baseline) と比べて悪化したシナリオを返す
+    p50 が threshold 倍を超えた、または SQL の件数・取得行数が増えたものを悪化とみなす
+    """
+    regressions = []
+    for name, result in current['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        reasons = []
+        if base['p50_ms'] and result['p50_ms'] > base['p50_ms'] * threshold:
+            reasons.append(f"p50 {base['p50_ms']}ms → {result['p50_ms']}ms")
+        if result['queries'] > base['queries']:
+            reasons.append(f"queries {base['queries']} → {result['queries']}")
+        if result['rows'] > base['rows']:
+            reasons.append(f"rows {base['rows']} → {result['rows']}")
+        if reasons:
+            regressions.append((name, reasons))
+    return regressions
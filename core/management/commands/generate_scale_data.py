@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.scale_data import ScaleDataGenerator
+
+
+class Command(BaseCommand):
+    help = (
+        '負荷試験用のダミーデータ (学校・企業・学生・タグ・ポートフォリオ・チャット) を大量に作成します。'
+        '全ユーザーのパスワードは --password の値になります。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--schools', type=int, default=2000, help='学校数')
+        parser.add_argument('--students', type=int, default=100000, help='学生数')
+        parser.add_argument('--teachers-per-school', type=int, default=1, help='1校あたりの教員数')
+        parser.add_argument('--companies', type=int, default=5000, help='企業数')
+        parser.add_argument('--reps-per-company', type=int, default=1, help='1社あたりの企業担当者数')
+        parser.add_argument('--portfolios-per-student', type=float, default=1.0, help='1人あたりの平均ポートフォリオ数')
+        parser.add_argument('--items-per-portfolio', type=int, default=2, help='1ポートフォリオあたりの平均作品ファイル数')
+        parser.add_argument('--chat-rooms', type=int, default=20000, help='チャットルーム数')
+        parser.add_argument('--messages-per-room', type=int, default=20, help='1ルームあたりの平均メッセージ数')
+        parser.add_argument('--seed', type=int, default=42, help='乱数のシード (同じ値なら同じデータになる)')
+        parser.add_argument('--batch-size', type=int, default=5000, help='bulk_create 1回あたりの件数')
+        parser.add_argument('--password', default='password', help='作成するユーザー共通のパスワード')
+        parser.add_argument('--prefix', default='scale', help='ユーザー名・学校名などに付ける接頭辞')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        generator = ScaleDataGenerator(
+            seed=options['seed'],
+            batch_size=options['batch_size'],
+            password=options['password'],
+            prefix=options['prefix'],
+            stdout=self.stdout,
+        )
+        try:
+            generator.generate(
+                schools=options['schools'],
+                students=options['students'],
+                teachers_per_school=options['teachers_per_school'],
+                companies=options['companies'],
+                reps_per_company=options['reps_per_company'],
+                portfolios_per_student=options['portfolios_per_student'],
+                items_per_portfolio=options['items_per_portfolio'],
+                chat_rooms=options['chat_rooms'],
+                messages_per_room=options['messages_per_room'],
+            )
+        except ValueError as e:
+            raise CommandError(e)
+
+        self.stdout.write(self.style.SUCCESS(f'完了しました ({time.perf_counter() - started:.1f} 秒)。'))
+        self.stdout.write('マッチ度を計算するには precompute_matches を実行してください。')
@@ -0,0 +1,114 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from companies.models import Company
+from core.matching import MATCH_SCORE_VERSION
+from core.precompute import (
+    Checkpoint, compute_shard, init_worker, load_company_rows, make_shards, write_shard,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        '全学生×全企業のマッチ度 (MatchScore) を複数プロセスで再計算します。'
+        '学校の追加やタグマスタの変更後に実行してください。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count() or 1,
+            help='計算に使うプロセス数 (デフォルト: CPU数)',
+        )
+        parser.add_argument(
+            '--shard-by', choices=['id', 'school'], default='id',
+            help='学生の分け方: id = 学生IDの範囲ごと / school = 学校ごと',
+        )
+        parser.add_argument(
+            '--shard-size', type=int, default=100,
+            help='--shard-by id のときの1シャードあたりのID幅 (デフォルト: 100)',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='INSERT (executemany) 1回あたりの行数 (デフォルト: 2000)',
+        )
+        parser.add_argument(
+            '--checkpoint', default=os.path.join(settings.BASE_DIR, '.precompute_matches.json'),
+            help='完了したシャードを記録するファイル',
+        )
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='前回中断した続きから再開する',
+        )
+
+    def handle(self, *args, **options):
+        params = {
+            'version': MATCH_SCORE_VERSION,
+            'shard_by': options['shard_by'],
+            'shard_size': options['shard_size'],
+        }
+        checkpoint = Checkpoint(options['checkpoint'], params)
+        if options['resume']:
+            if checkpoint.load():
+                self.stdout.write(f'{len(checkpoint.completed)} シャードは完了済みのためスキップします。')
+            else:
+                self.stdout.write('再開できる記録が無いため、最初から計算します。')
+        else:
+            checkpoint.clear()
+
+        shards = [
+            shard for shard in make_shards(options['shard_by'], options['shard_size'])
+            if shard.key not in checkpoint.completed
+        ]
+        company_count = Company.objects.count()
+        company_rows = load_company_rows()
+        self.stdout.write(f'シャード数: {len(shards)} / 企業数: {company_count} / プロセス数: {options["processes"]}')
+
+        # fork した子プロセスに親の DB 接続を引き継がせない
+        connections.close_all()
+
+        started = time.perf_counter()
+        total_pairs = 0
+        total_rows = 0
+        # 書き込み (親プロセス) より計算の方が速いので、同時に計算中のシャード数を制限して
+        # 結果がメモリに溜まり続けないようにする
+        max_in_flight = options['processes'] * 2
+        pending = deque()
+        remaining = iter(shards)
+        with multiprocessing.Pool(options['processes'], initializer=init_worker, initargs=(company_rows,)) as pool:
+
+            def submit_next():
+                shard = next(remaining, None)
+                if shard is not None:
+                    pending.append(pool.apply_async(compute_shard, (shard,)))
+
+            for _ in range(max_in_flight):
+                submit_next()
+            done = 0
+            while pending:
+                shard, student_count, rows = pending.popleft().get()
+                submit_next()
+
+                write_shard(shard, rows, batch_size=options['batch_size'])
+                checkpoint.mark(shard.key)
+
+                done += 1
+                total_pairs += student_count * company_count
+                total_rows += len(rows)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f'[{done}/{len(shards)}] {shard.key}: 学生 {student_count} 人 / {len(rows)} 行 '
+                    f'({total_pairs / elapsed:,.0f} pairs/sec)'
+                )
+
+        elapsed = time.perf_counter() - started
+        checkpoint.clear()
+        self.stdout.write(self.style.SUCCESS(
+            f'完了: {total_pairs:,} ペアを計算し {total_rows:,} 行を書き込みました '
+            f'({elapsed:.1f} 秒, {total_pairs / elapsed if elapsed else 0:,.0f} pairs/sec)'
+        ))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.matching import rebuild_match_scores
+
+
+class Command(BaseCommand):
+    help = 'MatchScore (学生×企業のマッチ度) を全件作り直します'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='1回の計算・書き込みで扱う学生の人数 (デフォルト: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        total = rebuild_match_scores(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'MatchScore を {total} 件作成しました。'))
@@ -0,0 +1,88 @@
+import json
+import platform
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from core.benchmarks import DEFAULT_DATASET, build_scenarios, compare, seed_dataset
+
+
+class Command(BaseCommand):
+    help = (
+        'マッチ度計算・一覧画面・チャット画面のベンチマークを実行します。'
+        'テスト用の DB に固定シードのデータを作って計測するので、開発用の DB は変更されません。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='1シナリオあたりの実行回数')
+        parser.add_argument('--seed', type=int, default=42, help='データ作成に使う乱数のシード')
+        for name, value in DEFAULT_DATASET.items():
+            parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=value, help=f'データ規模: {name}')
+        parser.add_argument('--scenario', action='append', help='実行するシナリオ名 (複数指定可。省略時は全て)')
+        parser.add_argument('--output', help='結果を JSON で書き出すファイル')
+        parser.add_argument('--compare', help='比較する前回の結果 (JSON)')
+        parser.add_argument('--threshold', type=float, default=1.2, help='p50 がこの倍率を超えたら悪化とみなす')
+        parser.add_argument('--fail-on-regression', action='store_true', help='悪化があれば終了コード 1 で終了する')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                baseline = json.load(f)
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            started = time.perf_counter()
+            dataset = seed_dataset(
+                seed=options['seed'],
+                **{name: options[name] for name in DEFAULT_DATASET},
+            )
+            self.stdout.write(f'データ作成: {time.perf_counter() - started:.1f} 秒 {dataset}')
+
+            results = {}
+            # クエリ数の監視ミドルウェアは計測の邪魔になるので止めておく
+            with override_settings(QUERY_BUDGET={'ENABLED': False}):
+                for scenario in build_scenarios():
+                    if options['scenario'] and scenario.name not in options['scenario']:
+                        continue
+                    result = scenario.run(options['iterations'])
+                    results[scenario.name] = result
+                    self.stdout.write(
+                        f"{scenario.name:<34} p50 {result['p50_ms']:>9.2f}ms  p90 {result['p90_ms']:>9.2f}ms  "
+                        f"p99 {result['p99_ms']:>9.2f}ms  queries {result['queries']:>5}  rows {result['rows']:>7}"
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'iterations': options['iterations'],
+                'seed': options['seed'],
+                'dataset': dataset,
+            },
+            'scenarios': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"結果を {options['output']} に書き出しました。")
+
+        if baseline is not None:
+            if baseline.get('meta', {}).get('dataset') != dataset:
+                self.stdout.write(self.style.WARNING('前回とデータ規模が異なるため、比較結果は参考値です。'))
+            regressions = compare(report, baseline, options['threshold'])
+            for name, reasons in regressions:
+                self.stdout.write(self.style.ERROR(f"悪化: {name}: {', '.join(reasons)}"))
+            if not regressions:
+                self.stdout.write(self.style.SUCCESS('前回から悪化したシナリオはありません。'))
+            elif options['fail_on_regression']:
+                raise CommandError(f'{len(regressions)} 件のシナリオが悪化しました。')
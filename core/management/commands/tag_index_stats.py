@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from core.tag_index import TagIndex
+
+
+class Command(BaseCommand):
+    help = 'タグの転置インデックスを構築し、メモリ使用量と構築時間を表示します'
+
+    def handle(self, *args, **options):
+        stats = TagIndex.build().stats()
+        self.stdout.write(f"構築時間: {stats['build_seconds'] * 1000:.1f} ms")
+        for side, label in (('student', '学生'), ('company', '企業')):
+            s = stats[side]
+            self.stdout.write(
+                f"{label}: {s['entities']} 件 / ポスティングリスト {s['posting_lists']} 本 / "
+                f"ポスティング {s['postings']} 件 / {s['posting_bytes'] / 1024:.1f} KiB"
+            )
+        self.stdout.write(self.style.SUCCESS(f"合計: {stats['posting_bytes'] / 1024:.1f} KiB"))
@@ -0,0 +1,315 @@
+import numpy as np
+from django.db import transaction
+
+from accounts.models import Student, StudentTag
+from companies.models import Company, CompanyTag
+from .models import MatchScore, Tag
+
+# 順位(1〜5位) → 重み(5〜1) の変換に使う定数
+MAX_RANK = 5
+# 1セクションの最大点 (5*5 + 4*4 + 3*3 + 2*2 + 1*1)
+MAX_SCORE_PER_SECTION = sum(w * w for w in range(1, MAX_RANK + 1))
+TOTAL_MAX = MAX_SCORE_PER_SECTION * 2
+
+# 計算ルールや保存する形を変えたら上げる (古いバージョンの MatchScore は再計算される)
+# 2: 一致したタグをタグ名ではなくタグIDで保存する (タグ名を変えても古い名前が残らない)
+MATCH_SCORE_VERSION = 2
+
+
+def get_weight(rank):
+    return (MAX_RANK + 1) - rank
+
+
+class MatchEngine:
+    """
+    学生×企業のマッチ度をまとめて計算するエンジン
+
+    StudentTag / CompanyTag を一度だけ読み込み、
+    (エンティティ数 × タグ数) の重み行列を4枚作る。
+        - 学生の強み      (strength)  × 企業が求める強み (strength)
+        - 学生が求めるもの (desire)    × 企業の特徴       (feature)
+    スコアは行列積で一括計算するので、ペア数が増えてもクエリ数は増えない。
+    """
+
+    def __init__(self, student_rows, company_rows):
+        """
+        student_rows / company_rows は
+        (entity_id, tag_id, tag_name, tag_type, rank) のタプルの並び
+        (順位順に並んでいること)
+        """
+        self.tag_names = {}
+        self.student_ids = []
+        self.company_ids = []
+        self.student_index = {}
+        self.company_index = {}
+
+        for rows, ids, index in (
+            (student_rows, self.student_ids, self.student_index),
+            (company_rows, self.company_ids, self.company_index),
+        ):
+            for entity_id, tag_id, tag_name, _tag_type, _rank in rows:
+                self.tag_names[tag_id] = tag_name
+                if entity_id not in index:
+                    index[entity_id] = len(ids)
+                    ids.append(entity_id)
+
+        self.tag_ids = list(self.tag_names)
+        self.tag_index = {tag_id: col for col, tag_id in enumerate(self.tag_ids)}
+
+        n_tags = len(self.tag_ids)
+        self.student_strengths = np.zeros((len(self.student_ids), n_tags), dtype=np.int32)
+        self.student_desires = np.zeros((len(self.student_ids), n_tags), dtype=np.int32)
+        self.company_needs = np.zeros((len(self.company_ids), n_tags), dtype=np.int32)
+        self.company_features = np.zeros((len(self.company_ids), n_tags), dtype=np.int32)
+
+        # 一致タグの並び順 (学生側の順位順) を保持する
+        self._student_order = {'strength': {}, 'desire': {}}
+
+        planes = {'strength': self.student_strengths, 'desire': self.student_desires}
+        for entity_id, tag_id, _name, tag_type, rank in student_rows:
+            plane = planes.get(tag_type)
+            if plane is None:
+                continue
+            # 同じタグが複数の順位にある場合は、後の順位で上書きする (従来の dict と同じ挙動)
+            plane[self.student_index[entity_id], self.tag_index[tag_id]] = get_weight(rank)
+            order = self._student_order[tag_type].setdefault(entity_id, [])
+            if tag_id not in order:
+                order.append(tag_id)
+
+        planes = {'strength': self.company_needs, 'feature': self.company_features}
+        for entity_id, tag_id, _name, tag_type, rank in company_rows:
+            plane = planes.get(tag_type)
+            if plane is None:
+                continue
+            plane[self.company_index[entity_id], self.tag_index[tag_id]] = get_weight(rank)
+
+    # --------------------------------------------------
+    # 読み込み
+    # --------------------------------------------------
+    @classmethod
+    def from_querysets(cls, student_tags, company_tags):
+        """ StudentTag / CompanyTag のクエリセットからエンジンを作る """
+        return cls(fetch_tag_rows(student_tags, 'student_id'), fetch_tag_rows(company_tags, 'company_id'))
+
+    @classmethod
+    def load(cls, students=None, companies=None):
+        """
+        学生・企業のタグを読み込む (クエリは2回だけ)
+        students / companies には モデルのインスタンス、ID、クエリセットのどれでも渡せる。
+        None の場合は全件を読み込む。
+        """
+        student_tags = StudentTag.objects.all()
+        company_tags = CompanyTag.objects.all()
+        if students is not None:
+            student_tags = student_tags.filter(student__in=_to_ids(students, Student))
+        if companies is not None:
+            company_tags = company_tags.filter(company__in=_to_ids(companies, Company))
+        return cls.from_querysets(student_tags, company_tags)
+
+    # --------------------------------------------------
+    # スコア計算
+    # --------------------------------------------------
+    def score_matrices(self):
+        """
+        (skills, conditions) の素点行列を返す
+        行は self.student_ids、列は self.company_ids の並び
+        """
+        skills = self.student_strengths @ self.company_needs.T
+        conditions = self.student_desires @ self.company_features.T
+        return skills, conditions
+
+    def percentage_matrix(self):
+        """ 学生×企業のマッチ度 (%) 行列を返す """
+        skills, conditions = self.score_matrices()
+        return to_percentage(skills + conditions)
+
+    def matched_tag_ids(self, student_id, company_id):
+        """ 1ペア分の一致タグID (学生側の順位順) を返す """
+        s = self.student_index.get(student_id)
+        c = self.company_index.get(company_id)
+        if s is None or c is None:
+            return [], []
+
+        matched_strengths = [
+            tag_id
+            for tag_id in self._student_order['strength'].get(student_id, [])
+            if self.company_needs[c, self.tag_index[tag_id]]
+        ]
+        matched_conditions = [
+            tag_id
+            for tag_id in self._student_order['desire'].get(student_id, [])
+            if self.company_features[c, self.tag_index[tag_id]]
+        ]
+        return matched_strengths, matched_conditions
+
+    def matched_tags(self, student_id, company_id):
+        """ 1ペア分の一致タグ名 (学生側の順位順) を返す """
+        return tuple(
+            [self.tag_names[tag_id] for tag_id in tag_ids]
+            for tag_ids in self.matched_tag_ids(student_id, company_id)
+        )
+
+    def match(self, student_id, company_id):
+        """ calculate_match_percentage と同じ形の辞書を返す """
+        s = self.student_index.get(student_id)
+        c = self.company_index.get(company_id)
+        if s is None or c is None:
+            return {'percentage': 0, 'matched_strengths': [], 'matched_conditions': []}
+
+        total = (
+            int(self.student_strengths[s] @ self.company_needs[c])
+            + int(self.student_desires[s] @ self.company_features[c])
+        )
+        matched_strengths, matched_conditions = self.matched_tags(student_id, company_id)
+        return {
+            'percentage': int((total / TOTAL_MAX) * 100),
+            'matched_strengths': matched_strengths,
+            'matched_conditions': matched_conditions,
+        }
+
+    def iter_score_rows(self):
+        """ MatchScore に保存する値を、スコアが 0 より大きいペアの分だけ辞書で返す """
+        for student_id, company_id, percentage, skills, conditions in self.iter_matches():
+            matched_strengths, matched_conditions = self.matched_tag_ids(student_id, company_id)
+            yield {
+                'student_id': student_id,
+                'company_id': company_id,
+                'percentage': percentage,
+                'skills_score': skills,
+                'conditions_score': conditions,
+                'matched_strength_ids': matched_strengths,
+                'matched_condition_ids': matched_conditions,
+                'version': MATCH_SCORE_VERSION,
+            }
+
+    def iter_matches(self):
+        """
+        スコアが 0 より大きいペアを
+        (student_id, company_id, percentage, skills_score, conditions_score) で順に返す
+        """
+        skills, conditions = self.score_matrices()
+        percentages = to_percentage(skills + conditions)
+        rows, cols = np.nonzero(skills + conditions)
+        for s, c in zip(rows.tolist(), cols.tolist()):
+            yield (
+                self.student_ids[s],
+                self.company_ids[c],
+                int(percentages[s, c]),
+                int(skills[s, c]),
+                int(conditions[s, c]),
+            )
+
+
+def fetch_tag_rows(tag_queryset, entity_field):
+    """ エンジンに渡す (entity_id, tag_id, tag_name, tag_type, rank) のリストを1クエリで取得する """
+    return list(
+        tag_queryset.order_by(entity_field, 'tag_type', 'rank')
+        .values_list(entity_field, 'tag_id', 'tag__name', 'tag_type', 'rank')
+    )
+
+
+def to_percentage(total):
+    """ 素点 (配列) をマッチ度 (%) に変換する。int() と同じく小数点以下は切り捨て """
+    return ((total / TOTAL_MAX) * 100).astype(np.int32)
+
+
+def _to_ids(values, model):
+    if hasattr(values, 'values_list'):
+        return values.values_list('pk', flat=True)
+    if isinstance(values, model):
+        values = [values]
+    return [v.pk if isinstance(v, model) else v for v in values]
+
+
+# ==================================
+# MatchScore テーブルの更新
+# ==================================
+
+def _replace_scores(engine, delete_filter):
+    """ delete_filter に当たる行を消して、エンジンの計算結果で入れ替える """
+    scores = [MatchScore(**row) for row in engine.iter_score_rows()]
+    with transaction.atomic():
+        MatchScore.objects.filter(**delete_filter).delete()
+        MatchScore.objects.bulk_create(scores, batch_size=1000)
+    return len(scores)
+
+
+def refresh_student_scores(student):
+    """ 学生のタグが変わったときに、その学生の行 (全企業分) だけを再計算する """
+    engine = MatchEngine.load(students=[student])
+    return _replace_scores(engine, {'student': student})
+
+
+def refresh_company_scores(company):
+    """ 企業のタグが変わったときに、その企業の列 (全学生分) だけを再計算する """
+    engine = MatchEngine.load(companies=[company])
+    return _replace_scores(engine, {'company': company})
+
+
+def rebuild_match_scores(batch_size=1000):
+    """
+    MatchScore を作り直す
+    企業側のタグは一度だけ読み込み、学生を batch_size 人ずつ計算して入れ替える。
+    戻り値: 保存した行数
+    """
+    company_rows = fetch_tag_rows(CompanyTag.objects.all(), 'company_id')
+    student_ids = list(Student.objects.order_by('pk').values_list('pk', flat=True))
+
+    total = 0
+    for start in range(0, len(student_ids), batch_size):
+        chunk = student_ids[start:start + batch_size]
+        student_rows = fetch_tag_rows(StudentTag.objects.filter(student_id__in=chunk), 'student_id')
+        engine = MatchEngine(student_rows, company_rows)
+        total += _replace_scores(engine, {'student_id__in': chunk})
+    return total
+
+
+def get_match_score(student, company):
+    """
+    MatchScore から1ペア分のマッチ度を取得する (インデックスで1クエリ)
+    行が無ければ 0%。計算ルールが古い行だけはその場で計算し直す。
+    """
+    score = MatchScore.objects.filter(student=student, company=company).first()
+    if score is None:
+        return {'percentage': 0, 'matched_strengths': [], 'matched_conditions': []}
+
+    if score.version != MATCH_SCORE_VERSION:
+        engine = MatchEngine.load(students=[student], companies=[company])
+        _replace_scores(engine, {'student': student, 'company': company})
+        return engine.match(student.pk, company.pk)
+
+    matched_strengths, matched_conditions = get_tag_names(score.matched_strength_ids, score.matched_condition_ids)
+    return {
+        'percentage': score.percentage,
+        'matched_strengths': matched_strengths,
+        'matched_conditions': matched_conditions,
+    }
+
+
+def get_tag_names(*id_lists):
+    """ タグIDのリスト (いくつでも) を、並びはそのままでタグ名のリストにする (1クエリ) """
+    tag_ids = {tag_id for id_list in id_lists for tag_id in id_list}
+    names = dict(Tag.objects.filter(pk__in=tag_ids).values_list('pk', 'name')) if tag_ids else {}
+    # 削除されたタグは除く
+    return tuple([names[tag_id] for tag_id in id_list if tag_id in names] for id_list in id_lists)
+
+
+# ==================================
+# タグ変更時の更新 (フォーム・管理画面から呼ぶ)
+# ==================================
+
+def student_tags_changed(student):
+    """ 学生のタグ保存後に呼ぶ: MatchScore の行と転置インデックスを更新する """
+    # tag_index は matching をインポートしているので、循環インポートを避けてここで読み込む
+    from .tag_index import STUDENT, tag_index_changed
+
+    refresh_student_scores(student)
+    tag_index_changed(STUDENT, student.pk)
+
+
+def company_tags_changed(company):
+    """ 企業のタグ保存後に呼ぶ: MatchScore の列と転置インデックスを更新する """
+    from .tag_index import COMPANY, tag_index_changed
+
+    refresh_company_scores(company)
+    tag_index_changed(COMPANY, company.pk)
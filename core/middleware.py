@@ -0,0 +1,126 @@
+import logging
+import threading
+
+from django.conf import settings
+
+from .query_stats import QueryRecorder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_BUDGET_SETTINGS = {
+    'ENABLED': False,
+    # 1リクエスト内で同じ形の SQL がこの回数を超えたら N+1 とみなす
+    'N_PLUS_ONE_THRESHOLD': 10,
+    # URL名ごとのクエリ数の上限 {'accounts:company_student_list': 15, ...}
+    'BUDGETS': {},
+    # True にすると上限超過・N+1 で例外を投げる (テストで使う)
+    'RAISE': False,
+    # True にすると X-Query-Count / X-Query-Time ヘッダーを付ける
+    'RESPONSE_HEADERS': False,
+}
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(max_queries):
+    """
+    ビューにクエリ数の上限を宣言するデコレーター
+    クラスベースビューの場合はクラス属性 query_budget = 10 でもよい
+    """
+    def decorator(view_func):
+        view_func.query_budget = max_queries
+        return view_func
+    return decorator
+
+
+def get_query_budget_settings():
+    return {**DEFAULT_QUERY_BUDGET_SETTINGS, **getattr(settings, 'QUERY_BUDGET', {})}
+
+
+# URL名ごとの集計 (プロセス内)
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_query_stats():
+    """ URL名ごとの {requests, queries, max_queries, sql_time, n_plus_one} を返す """
+    with _stats_lock:
+        return {name: dict(values) for name, values in _stats.items()}
+
+
+def reset_query_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class QueryBudgetMiddleware:
+    """
+    リクエストごとに SQL の件数・合計時間・同じ形の SQL の実行回数を記録し、
+    上限 (クエリバジェット) の超過や N+1 を警告する
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = get_query_budget_settings()
+        if not config['ENABLED']:
+            return self.get_response(request)
+
+        request._query_budget = None
+        with QueryRecorder() as recorder:
+            response = self.get_response(request)
+
+        url_name = self.get_url_name(request)
+        budget = request._query_budget
+        if budget is None:
+            budget = config['BUDGETS'].get(url_name)
+        n_plus_one = {
+            sql: count for sql, count in recorder.fingerprints().items()
+            if count > config['N_PLUS_ONE_THRESHOLD']
+        }
+        self.record(url_name, recorder, bool(n_plus_one))
+
+        if config['RESPONSE_HEADERS']:
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-Query-Time'] = f'{recorder.total_time * 1000:.1f}ms'
+
+        problems = []
+        if budget is not None and recorder.count > budget:
+            problems.append(f'{url_name}: クエリ数 {recorder.count} が上限 {budget} を超えました')
+        for sql, count in n_plus_one.items():
+            problems.append(f'{url_name}: N+1 の可能性 ({count} 回): {sql[:200]}')
+        for problem in problems:
+            logger.warning(problem)
+        if problems and config['RAISE']:
+            raise QueryBudgetExceeded('\n'.join(problems))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # デコレーター or クラス属性で宣言された上限を拾う
+        budget = getattr(view_func, 'query_budget', None)
+        view_class = getattr(view_func, 'view_class', None)
+        if budget is None and view_class is not None:
+            budget = getattr(view_class, 'query_budget', None)
+        request._query_budget = budget
+
+    @staticmethod
+    def get_url_name(request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return request.path
+        return match.view_name
+
+    @staticmethod
+    def record(url_name, recorder, n_plus_one):
+        with _stats_lock:
+            stats = _stats.setdefault(url_name, {
+                'requests': 0, 'queries': 0, 'max_queries': 0, 'sql_time': 0.0, 'n_plus_one': 0,
+            })
+            stats['requests'] += 1
+            stats['queries'] += recorder.count
+            stats['max_queries'] = max(stats['max_queries'], recorder.count)
+            stats['sql_time'] += recorder.total_time
+            stats['n_plus_one'] += int(n_plus_one)
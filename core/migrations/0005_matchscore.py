@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companies', '0004_companytag'),
+        ('accounts', '0006_studenttag'),
+        ('core', '0004_auto_20251120_1125'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchScore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('percentage', models.IntegerField(verbose_name='マッチ度')),
+                ('skills_score', models.IntegerField(verbose_name='強み・スキルの得点')),
+                ('conditions_score', models.IntegerField(verbose_name='条件・待遇の得点')),
+                ('matched_strengths', models.JSONField(default=list, verbose_name='一致した強み')),
+                ('matched_conditions', models.JSONField(default=list, verbose_name='一致した条件')),
+                ('version', models.IntegerField(verbose_name='計算バージョン')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_scores', to='companies.company')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_scores', to='accounts.student')),
+            ],
+            options={
+                'verbose_name': 'マッチ度',
+                'verbose_name_plural': 'マッチ度一覧',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='matchscore',
+            index=models.Index(fields=['company', '-percentage'], name='matchscore_company_rank'),
+        ),
+        migrations.AddIndex(
+            model_name='matchscore',
+            index=models.Index(fields=['student', '-percentage'], name='matchscore_student_rank'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='matchscore',
+            unique_together={('student', 'company')},
+        ),
+    ]
@@ -0,0 +1,116 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:02
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# core.matching のこの時点の計算ルールの写し (後で core.matching を変えても、このマイグレーションは変わらない)
+MAX_RANK = 5
+TOTAL_MAX = 110
+MATCH_SCORE_VERSION = 2
+
+
+def _weights(rows):
+    """
+    (entity_id, tag_id, tag_type, rank) の並び (順位順) → {tag_type: {entity_id: {tag_id: 重み}}}
+    同じタグが複数の順位にあれば後の順位で上書きする。dict の並びは最初に出てきた順
+    """
+    weights = defaultdict(lambda: defaultdict(dict))
+    for entity_id, tag_id, tag_type, rank in rows:
+        weights[tag_type][entity_id][tag_id] = (MAX_RANK + 1) - rank
+    return weights
+
+
+def _by_tag(entity_weights):
+    """ {entity_id: {tag_id: 重み}} → {tag_id: [(entity_id, 重み), ...]} """
+    index = defaultdict(list)
+    for entity_id, tags in entity_weights.items():
+        for tag_id, weight in tags.items():
+            index[tag_id].append((entity_id, weight))
+    return index
+
+
+def populate_match_scores(apps, schema_editor):
+    # MatchScore を作り直す (0005 までの行はタグ名で保存されているので、ID で作り直す)
+    # 行が無い学生・企業のペアは 0% として扱う
+    StudentTag = apps.get_model('accounts', 'StudentTag')
+    CompanyTag = apps.get_model('companies', 'CompanyTag')
+    MatchScore = apps.get_model('core', 'MatchScore')
+
+    students = _weights(
+        StudentTag.objects.order_by('student_id', 'tag_type', 'rank')
+        .values_list('student_id', 'tag_id', 'tag_type', 'rank')
+    )
+    companies = _weights(
+        CompanyTag.objects.order_by('company_id', 'tag_type', 'rank')
+        .values_list('company_id', 'tag_id', 'tag_type', 'rank')
+    )
+    # 学生の強み × 企業が求める強み、学生が求めるもの × 企業の特徴
+    sections = [
+        (students['strength'], _by_tag(companies['strength'])),
+        (students['desire'], _by_tag(companies['feature'])),
+    ]
+
+    MatchScore.objects.all().delete()
+    batch = []
+    for student_id in sorted(set(students['strength']) | set(students['desire'])):
+        scores = defaultdict(lambda: [0, 0, [], []])
+        for section, (student_weights, company_index) in enumerate(sections):
+            for tag_id, weight in student_weights.get(student_id, {}).items():
+                for company_id, company_weight in company_index.get(tag_id, ()):
+                    score = scores[company_id]
+                    score[section] += weight * company_weight
+                    score[section + 2].append(tag_id)
+        for company_id, (skills, conditions, matched_strengths, matched_conditions) in scores.items():
+            batch.append(MatchScore(
+                student_id=student_id,
+                company_id=company_id,
+                percentage=int(((skills + conditions) / TOTAL_MAX) * 100),
+                skills_score=skills,
+                conditions_score=conditions,
+                matched_strength_ids=matched_strengths,
+                matched_condition_ids=matched_conditions,
+                version=MATCH_SCORE_VERSION,
+            ))
+        if len(batch) >= BATCH_SIZE:
+            MatchScore.objects.bulk_create(batch)
+            batch = []
+    MatchScore.objects.bulk_create(batch)
+
+
+def clear_match_scores(apps, schema_editor):
+    # 戻すときは行を消す (タグIDのままでは前のコードで表示できない。rebuild_match_scores で作り直す)
+    apps.get_model('core', 'MatchScore').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_matchscore'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='matchscore',
+            old_name='matched_strengths',
+            new_name='matched_strength_ids',
+        ),
+        migrations.RenameField(
+            model_name='matchscore',
+            old_name='matched_conditions',
+            new_name='matched_condition_ids',
+        ),
+        migrations.AlterField(
+            model_name='matchscore',
+            name='matched_strength_ids',
+            field=models.JSONField(default=list, verbose_name='一致した強み (タグID)'),
+        ),
+        migrations.AlterField(
+            model_name='matchscore',
+            name='matched_condition_ids',
+            field=models.JSONField(default=list, verbose_name='一致した条件 (タグID)'),
+        ),
+        migrations.RunPython(populate_match_scores, clear_match_scores),
+    ]
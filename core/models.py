@@ -36,4 +36,32 @@ class Tag(models.Model):
 
     class Meta:
         verbose_name = "タグ"
-        verbose_name_plural = "タグ一覧"
\ No newline at end of file
+        verbose_name_plural = "タグ一覧"
+
+# 学生×企業のマッチ度（計算済みの結果を保存しておくテーブル）
+# スコアが 0 の組み合わせは保存しない (行が無ければマッチ度 0%)
+class MatchScore(models.Model):
+    student = models.ForeignKey('accounts.Student', on_delete=models.CASCADE, related_name='match_scores')
+    company = models.ForeignKey('companies.Company', on_delete=models.CASCADE, related_name='match_scores')
+    percentage = models.IntegerField(verbose_name="マッチ度")
+    skills_score = models.IntegerField(verbose_name="強み・スキルの得点")
+    conditions_score = models.IntegerField(verbose_name="条件・待遇の得点")
+    # 一致したタグのID (学生側の順位順)。名前は表示するときに Tag から引く
+    matched_strength_ids = models.JSONField(default=list, verbose_name="一致した強み (タグID)")
+    matched_condition_ids = models.JSONField(default=list, verbose_name="一致した条件 (タグID)")
+    # 計算ルールのバージョン (core.matching.MATCH_SCORE_VERSION)
+    version = models.IntegerField(verbose_name="計算バージョン")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新日時")
+
+    def __str__(self):
+        return f"{self.student} × {self.company}: {self.percentage}%"
+
+    class Meta:
+        unique_together = ('student', 'company')
+        indexes = [
+            # 「マッチ度順」の一覧用
+            models.Index(fields=['company', '-percentage'], name='matchscore_company_rank'),
+            models.Index(fields=['student', '-percentage'], name='matchscore_student_rank'),
+        ]
+        verbose_name = "マッチ度"
+        verbose_name_plural = "マッチ度一覧"
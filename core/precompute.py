@@ -0,0 +1,157 @@
+"""
+precompute_matches コマンド用の処理
+
+学生をシャード (ID の範囲 or 学校) に分けてプロセスプールで計算し、
+結果は親プロセスがシャード単位のトランザクションでまとめて書き込む。
+(SQLite は書き込みが1本しか通らないので、書き込みは親に集約する)
+"""
+import json
+import os
+from itertools import islice
+
+import django
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from accounts.models import Student, StudentTag
+from companies.models import CompanyTag
+from .matching import MATCH_SCORE_VERSION, MatchEngine, fetch_tag_rows
+from .models import MatchScore
+
+# ワーカープロセスで共有する企業側のタグ (initializer で一度だけ受け取る)
+_company_rows = None
+
+
+class Shard:
+    """ 計算単位。key は再開時の照合に使うので、同じ条件なら毎回同じ値になること """
+
+    def __init__(self, key, id_range=None, school_id=None):
+        self.key = key
+        self.id_range = id_range
+        self.school_id = school_id
+
+    def student_filter(self):
+        if self.id_range is not None:
+            lo, hi = self.id_range
+            return {'student_id__gte': lo, 'student_id__lt': hi}
+        return {'student__school_id': self.school_id}
+
+    def student_queryset(self):
+        if self.id_range is not None:
+            lo, hi = self.id_range
+            return Student.objects.filter(pk__gte=lo, pk__lt=hi)
+        return Student.objects.filter(school_id=self.school_id)
+
+
+def make_shards(shard_by='id', shard_size=100):
+    """ 学生全体をシャードに分ける """
+    if shard_by == 'school':
+        school_ids = Student.objects.order_by('school_id').values_list('school_id', flat=True).distinct()
+        return [Shard(f'school:{school_id}', school_id=school_id) for school_id in school_ids]
+
+    ids = Student.objects.order_by('pk').values_list('pk', flat=True)
+    first, last = ids.first(), ids.last()
+    if first is None:
+        return []
+    # 人数ではなく ID の値で区切る (学生が増えても既存シャードの範囲が変わらない)
+    return [
+        Shard(f'id:{lo}-{lo + shard_size}', id_range=(lo, lo + shard_size))
+        for lo in range(first, last + 1, shard_size)
+    ]
+
+
+# ==================================
+# ワーカープロセス側
+# ==================================
+
+def init_worker(company_rows):
+    global _company_rows
+    django.setup()
+    _company_rows = company_rows
+
+
+def compute_shard(shard):
+    """
+    1シャード分を計算し、(shard, 学生数, 書き込む行のリスト) を返す
+    行は MatchScore のフィールド順のタプル
+    """
+    student_rows = fetch_tag_rows(StudentTag.objects.filter(**shard.student_filter()), 'student_id')
+    student_count = shard.student_queryset().count()
+    engine = MatchEngine(student_rows, _company_rows)
+    rows = [
+        (r['student_id'], r['company_id'], r['percentage'], r['skills_score'],
+         r['conditions_score'], r['matched_strength_ids'], r['matched_condition_ids'])
+        for r in engine.iter_score_rows()
+    ]
+    # 子プロセスの接続は使い回さない
+    connections.close_all()
+    return shard, student_count, rows
+
+
+# ==================================
+# 親プロセス側
+# ==================================
+
+def load_company_rows():
+    return fetch_tag_rows(CompanyTag.objects.all(), 'company_id')
+
+
+def write_shard(shard, rows, batch_size=2000):
+    """
+    シャード分の古い行を消して新しい行を書き込む (1トランザクション)
+    行数が多いので、モデルのインスタンスは作らず executemany で直接 INSERT する
+    """
+    columns = [
+        'student_id', 'company_id', 'percentage', 'skills_score', 'conditions_score',
+        'matched_strength_ids', 'matched_condition_ids', 'version', 'updated_at',
+    ]
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        connection.ops.quote_name(MatchScore._meta.db_table),
+        ', '.join(connection.ops.quote_name(MatchScore._meta.get_field(c).column) for c in columns),
+        ', '.join(['%s'] * len(columns)),
+    )
+    updated_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    params = (
+        (student_id, company_id, percentage, skills, conditions,
+         json.dumps(matched_strengths), json.dumps(matched_conditions), MATCH_SCORE_VERSION, updated_at)
+        for student_id, company_id, percentage, skills, conditions, matched_strengths, matched_conditions in rows
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        MatchScore.objects.filter(**shard.student_filter()).delete()
+        while True:
+            batch = list(islice(params, batch_size))
+            if not batch:
+                break
+            cursor.executemany(sql, batch)
+
+
+class Checkpoint:
+    """ 完了したシャードを JSON ファイルに記録し、中断後に再開できるようにする """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.completed = set()
+
+    def load(self):
+        """ 条件が同じ記録があれば読み込む。戻り値: 読み込めたかどうか """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('params') != self.params:
+            return False
+        self.completed = set(data.get('completed', []))
+        return True
+
+    def mark(self, key):
+        self.completed.add(key)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'params': self.params, 'completed': sorted(self.completed)}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,113 @@
+"""
+SQL の実行状況 (件数・時間・取得行数) を記録するためのヘルパー
+
+    with QueryRecorder() as recorder:
+        ...
+    recorder.count, recorder.total_time, recorder.rows
+"""
+import re
+import time
+
+from django.db import connection
+
+_NUMBER_RE = re.compile(r'\b\d+\b')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_IN_LIST_RE = re.compile(r'\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)')
+
+
+def fingerprint(sql):
+    """
+    SQL を「形」だけにそろえる (N+1 の検出用)
+    数値・文字列リテラルと IN (%s, %s, ...) の個数の違いを無視する
+    """
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _IN_LIST_RE.sub('(...)', sql)
+    return ' '.join(sql.split())
+
+
+class _RowCountingCursor:
+    """ DB ドライバのカーソルを包み、fetch された行数を数える """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.record = None
+
+    def _count(self, n):
+        if self.record is not None:
+            self.record['rows'] += n
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._count(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class QueryRecorder:
+    """ connection.execute_wrapper を使って、ブロック内で実行された SQL を記録する """
+
+    def __init__(self, using=connection):
+        self.connection = using
+        self.queries = []
+        self._wrapper = None
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def __call__(self, execute, sql, params, many, context):
+        cursor_wrapper = context['cursor']
+        if not isinstance(cursor_wrapper.cursor, _RowCountingCursor):
+            cursor_wrapper.cursor = _RowCountingCursor(cursor_wrapper.cursor)
+        record = {'sql': sql, 'time': 0.0, 'rows': 0, 'many': many}
+        cursor_wrapper.cursor.record = record
+        self.queries.append(record)
+
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            record['time'] = time.perf_counter() - started
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(q['time'] for q in self.queries)
+
+    @property
+    def rows(self):
+        return sum(q['rows'] for q in self.queries)
+
+    def fingerprints(self):
+        """ {SQL の形: 実行回数} を返す """
+        counts = {}
+        for q in self.queries:
+            key = fingerprint(q['sql'])
+            counts[key] = counts.get(key, 0) + 1
+        return counts
@@ -0,0 +1,272 @@
+"""
+負荷試験用のダミーデータ生成 (generate_scale_data コマンド・ベンチマークから使う)
+
+- bulk_create でバッチごとに書き込む
+- SQLite + Django 3.2 では bulk_create 後に ID が返らないので、ID は自前で採番する
+- パスワードのハッシュ計算は1回だけ行い、全ユーザーで使い回す
+"""
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from accounts.models import Student, Teacher, CompanyRepresentative, StudentTag
+from chat.models import ChatRoom, ChatMessage, ChatReadState, make_pair_key
+from companies.models import Company, CompanyTag
+from core.models import Tag
+from portfolios.models import Portfolio, PortfolioItem
+from schools.models import School
+
+INDUSTRIES = ['IT・通信', '製造', '建設', '医療・福祉', '小売', '飲食', '金融', '物流', '広告・出版', '教育']
+FILE_EXTENSIONS = ['.pdf', '.jpg', '.png', '.zip', '.py', '.html']
+MESSAGES = [
+    'こんにちは、よろしくお願いします。',
+    'ポートフォリオを拝見しました。',
+    'ありがとうございます！',
+    '面接の日程はいつ頃がよろしいでしょうか。',
+    '来週の水曜日はいかがですか？',
+    '承知しました。',
+    '会社説明会の資料をお送りします。',
+    '質問してもよろしいでしょうか。',
+]
+
+# 1人あたりのタグ数 (0〜5個) の出やすさ。5個すべて埋める人が一番多い想定
+TAG_COUNT_WEIGHTS = [5, 5, 10, 15, 25, 40]
+
+
+class ScaleDataGenerator:
+
+    def __init__(self, seed=42, batch_size=5000, password='password', prefix='scale', stdout=None):
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self.stdout = stdout
+        # ハッシュ計算は重いので1回だけ (全ユーザー共通のパスワードになる)
+        self.password_hash = make_password(password)
+        self.now = timezone.now()
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    # --------------------------------------------------
+    # 共通処理
+    # --------------------------------------------------
+    @staticmethod
+    def next_id(model):
+        return (model.objects.aggregate(max_id=Max('pk'))['max_id'] or 0) + 1
+
+    def bulk_insert(self, model, objects):
+        """ objects (イテレータ可) を batch_size 件ずつ書き込む。戻り値: 件数 """
+        count = 0
+        batch = []
+        with transaction.atomic():
+            for obj in objects:
+                batch.append(obj)
+                if len(batch) >= self.batch_size:
+                    model.objects.bulk_create(batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                model.objects.bulk_create(batch)
+                count += len(batch)
+        self.log(f'  {model._meta.verbose_name}: {count} 件')
+        return count
+
+    def create_users(self, count, kind):
+        """ User を count 人作り、ID のリストを返す """
+        start = self.next_id(User)
+        ids = list(range(start, start + count))
+        self.bulk_insert(User, (
+            User(
+                id=user_id,
+                username=f'{self.prefix}_{kind}_{user_id}',
+                password=self.password_hash,
+                date_joined=self.now,
+            )
+            for user_id in ids
+        ))
+        return ids
+
+    def pick_tags(self, tag_ids, weights):
+        """ 人気の偏りを付けて、重複なしでタグを選ぶ (順位順に並ぶ) """
+        k = self.random.choices(range(len(TAG_COUNT_WEIGHTS)), weights=TAG_COUNT_WEIGHTS)[0]
+        k = min(k, len(tag_ids))
+        picked = []
+        while len(picked) < k:
+            tag_id = self.random.choices(tag_ids, weights=weights)[0]
+            if tag_id not in picked:
+                picked.append(tag_id)
+        return picked
+
+    def ensure_tags(self, count=16):
+        """ タグが1件も無ければ、setup_data.py と同じ比率 (強み7・条件7・両方2) でダミーのタグを作る """
+        if Tag.objects.exists():
+            return
+        categories = ['strength', 'condition'] * 7 + ['both'] * 2
+        Tag.objects.bulk_create([
+            Tag(name=f'{self.prefix}タグ{n}', category=categories[n % len(categories)])
+            for n in range(count)
+        ])
+
+    def tag_pools(self):
+        """ フォームと同じく、強み用・条件用のタグ候補と人気度の重みを返す """
+        tags = list(Tag.objects.values_list('pk', 'category'))
+        if not tags:
+            raise ValueError('タグが登録されていません。先に setup_data.py を実行してください。')
+        strength = [pk for pk, category in tags if category in ('strength', 'both')]
+        condition = [pk for pk, category in tags if category in ('condition', 'both')]
+        pools = {}
+        for name, ids in (('strength', strength), ('condition', condition)):
+            self.random.shuffle(ids)
+            # 順位が上のタグほど選ばれやすい (Zipf 風)
+            pools[name] = (ids, [1 / (i + 1) for i in range(len(ids))])
+        return pools
+
+    # --------------------------------------------------
+    # 生成
+    # --------------------------------------------------
+    def generate(self, schools=2000, students=100000, teachers_per_school=1, companies=5000,
+                 reps_per_company=1, portfolios_per_student=1.0, items_per_portfolio=2,
+                 chat_rooms=20000, messages_per_room=20):
+        pools = self.tag_pools()
+
+        self.log('学校')
+        school_start = self.next_id(School)
+        school_ids = list(range(school_start, school_start + schools))
+        self.bulk_insert(School, (
+            School(id=pk, name=f'{self.prefix}学校{pk}', address=f'東京都千代田区{pk}')
+            for pk in school_ids
+        ))
+
+        self.log('企業')
+        company_start = self.next_id(Company)
+        company_ids = list(range(company_start, company_start + companies))
+        self.bulk_insert(Company, (
+            Company(id=pk, name=f'{self.prefix}株式会社{pk}', industry=self.random.choice(INDUSTRIES),
+                    description='スケールテスト用の企業です。')
+            for pk in company_ids
+        ))
+        self.bulk_insert(CompanyTag, self._entity_tags(CompanyTag, 'company_id', company_ids, pools, 'feature'))
+
+        self.log('学生')
+        student_user_ids = self.create_users(students, 'student')
+        student_start = self.next_id(Student)
+        student_ids = list(range(student_start, student_start + students))
+        self.bulk_insert(Student, (
+            Student(id=pk, user_id=user_id, school_id=self.random.choice(school_ids) if school_ids else None,
+                    full_name=f'学生{pk}', grade=self.random.randint(1, 4),
+                    is_public_to_companies=self.random.random() < 0.9)
+            for pk, user_id in zip(student_ids, student_user_ids)
+        ))
+        self.bulk_insert(StudentTag, self._entity_tags(StudentTag, 'student_id', student_ids, pools, 'desire'))
+
+        self.log('教員')
+        teacher_user_ids = self.create_users(schools * teachers_per_school, 'teacher')
+        self.bulk_insert(Teacher, (
+            Teacher(user_id=user_id, school_id=school_ids[i % len(school_ids)],
+                    full_name=f'教員{user_id}', subject='情報')
+            for i, user_id in enumerate(teacher_user_ids)
+        ))
+
+        self.log('企業担当者')
+        rep_user_ids = self.create_users(companies * reps_per_company, 'company')
+        self.bulk_insert(CompanyRepresentative, (
+            CompanyRepresentative(user_id=user_id, company_id=company_ids[i % len(company_ids)],
+                                  full_name=f'担当者{user_id}', department='人事部')
+            for i, user_id in enumerate(rep_user_ids)
+        ))
+
+        self.log('ポートフォリオ')
+        self._portfolios(student_ids, portfolios_per_student, items_per_portfolio)
+
+        self.log('チャット')
+        if student_user_ids and rep_user_ids:
+            self._chats(student_user_ids, rep_user_ids, chat_rooms, messages_per_room)
+
+    def _entity_tags(self, model, entity_field, entity_ids, pools, condition_type):
+        for entity_id in entity_ids:
+            for tag_type, pool in (('strength', pools['strength']), (condition_type, pools['condition'])):
+                for rank, tag_id in enumerate(self.pick_tags(*pool), 1):
+                    yield model(**{entity_field: entity_id}, tag_id=tag_id, tag_type=tag_type, rank=rank)
+
+    def _portfolios(self, student_ids, portfolios_per_student, items_per_portfolio):
+        portfolio_start = self.next_id(Portfolio)
+        # 作成数は平均 portfolios_per_student 個になるようにばらつかせる
+        owners = [
+            student_id
+            for student_id in student_ids
+            for _ in range(self.random.randint(0, round(portfolios_per_student * 2)))
+        ]
+        portfolio_ids = list(range(portfolio_start, portfolio_start + len(owners)))
+        self.bulk_insert(Portfolio, (
+            Portfolio(id=pk, student_id=student_id, title=f'作品{pk}', description='スケールテスト用の作品です。')
+            for pk, student_id in zip(portfolio_ids, owners)
+        ))
+        self.bulk_insert(PortfolioItem, (
+            PortfolioItem(portfolio_id=portfolio_id,
+                          file=f'portfolio_files/{self.prefix}_{portfolio_id}_{n}{self.random.choice(FILE_EXTENSIONS)}')
+            for portfolio_id in portfolio_ids
+            for n in range(self.random.randint(0, items_per_portfolio * 2))
+        ))
+
+    def _chats(self, student_user_ids, rep_user_ids, chat_rooms, messages_per_room):
+        room_start = self.next_id(ChatRoom)
+        pairs = set()
+        # 同じ組み合わせのルームは作らない
+        max_pairs = len(student_user_ids) * len(rep_user_ids)
+        while len(pairs) < min(chat_rooms, max_pairs):
+            pairs.add((self.random.choice(student_user_ids), self.random.choice(rep_user_ids)))
+        rooms = list(zip(range(room_start, room_start + len(pairs)), sorted(pairs)))
+
+        self.bulk_insert(ChatRoom, (
+            ChatRoom(id=room_id, created_at=self.now, pair_key=make_pair_key(*pair))
+            for room_id, pair in rooms
+        ))
+        Participant = ChatRoom.participants.through
+        self.bulk_insert(Participant, (
+            Participant(chatroom_id=room_id, user_id=user_id)
+            for room_id, pair in rooms
+            for user_id in pair
+        ))
+        last_messages = {}
+        self.bulk_insert(ChatMessage, self._messages(rooms, messages_per_room, last_messages))
+
+        # 受信箱用の最後のメッセージと既読状態 (生成したメッセージはすべて既読扱い)
+        self.log('  受信箱')
+        preview_length = ChatRoom._meta.get_field('last_message_preview').max_length
+        with transaction.atomic():
+            ChatRoom.objects.bulk_update(
+                [
+                    ChatRoom(id=room_id, last_message_at=msg.timestamp, last_seq=msg.seq,
+                             last_message_preview=msg.content[:preview_length], last_author_id=msg.author_id)
+                    for room_id, msg in last_messages.items()
+                ],
+                ['last_message_at', 'last_message_preview', 'last_author', 'last_seq'],
+                batch_size=500,
+            )
+        self.bulk_insert(ChatReadState, (
+            ChatReadState(room_id=room_id, user_id=user_id, last_read_at=self.now)
+            for room_id, pair in rooms
+            for user_id in pair
+        ))
+
+    def _messages(self, rooms, messages_per_room, last_messages):
+        for room_id, pair in rooms:
+            count = self.random.randint(0, messages_per_room * 2)
+            timestamp = self.now - timedelta(days=self.random.randint(1, 365))
+            for n in range(count):
+                timestamp += timedelta(minutes=self.random.randint(1, 600))
+                message = ChatMessage(
+                    room_id=room_id,
+                    author_id=pair[n % 2],
+                    content=self.random.choice(MESSAGES),
+                    timestamp=min(timestamp, self.now),
+                    seq=n + 1,
+                )
+                last_messages[room_id] = message
+                yield message
@@ -0,0 +1,26 @@
+"""
+- 学生・企業が削除されたら、タグの転置インデックス (core.tag_index) から外す
+- タグ自体が削除されたら (StudentTag / CompanyTag も消える)、インデックスを作り直させる
+"""
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from accounts.models import Student
+from companies.models import Company
+from .models import Tag
+from .tag_index import COMPANY, STUDENT, tag_index_changed
+
+
+@receiver(post_delete, sender=Student)
+def student_deleted(sender, instance, **kwargs):
+    tag_index_changed(STUDENT, instance.pk)
+
+
+@receiver(post_delete, sender=Company)
+def company_deleted(sender, instance, **kwargs):
+    tag_index_changed(COMPANY, instance.pk)
+
+
+@receiver(post_delete, sender=Tag)
+def tag_deleted(sender, instance, **kwargs):
+    tag_index_changed()
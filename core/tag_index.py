@@ -0,0 +1,299 @@
+import heapq
+import sys
+import threading
+import time
+from array import array
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import StudentTag
+from companies.models import CompanyTag
+from .matching import TOTAL_MAX, get_weight
+
+STUDENT = 'student'
+COMPANY = 'company'
+
+# どのタグ種別同士を掛け合わせるか (学生側 → 企業側)
+STUDENT_TO_COMPANY_TYPE = {'strength': 'strength', 'desire': 'feature'}
+COMPANY_TO_STUDENT_TYPE = {v: k for k, v in STUDENT_TO_COMPANY_TYPE.items()}
+
+
+class Postings:
+    """
+    1つの (tag_type, tag_id) に対するポスティングリスト
+    モデルのインスタンスではなく、ID と重みを array に詰めて持つ
+    """
+    __slots__ = ('ids', 'weights', 'max_weight')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.weights = array('b')
+        self.max_weight = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, entity_id, weight):
+        self.ids.append(entity_id)
+        self.weights.append(weight)
+        if weight > self.max_weight:
+            self.max_weight = weight
+
+    def remove(self, entity_id):
+        keep = [i for i, e in enumerate(self.ids) if e != entity_id]
+        self.ids = array('q', (self.ids[i] for i in keep))
+        self.weights = array('b', (self.weights[i] for i in keep))
+        self.max_weight = max(self.weights, default=0)
+
+    def nbytes(self):
+        return sys.getsizeof(self.ids) + sys.getsizeof(self.weights)
+
+
+class TagIndex:
+    """
+    StudentTag / CompanyTag の転置インデックス (プロセス内で保持)
+
+        postings[side][(tag_type, tag_id)] -> Postings (entity_id, 重み)
+        forward[side][entity_id]           -> [(tag_type, tag_id, 重み), ...]
+
+    「この学生に合う企業トップK」(とその逆) を、各タグの重みの上限を使った
+    max-score 方式の枝刈りで求める。
+    """
+
+    def __init__(self):
+        self.postings = {STUDENT: {}, COMPANY: {}}
+        self.forward = {STUDENT: {}, COMPANY: {}}
+        self.build_seconds = None
+        self.built_at = None
+        self.updates = 0
+        # 構築・差分反映した時点の世代番号 (get_tag_index が他プロセスの変更の検知に使う)
+        self.version = None
+        self._lock = threading.Lock()
+
+    # --------------------------------------------------
+    # 構築・更新
+    # --------------------------------------------------
+    @classmethod
+    def build(cls):
+        """ DB から全件読み込んでインデックスを作る (クエリは2回) """
+        started = time.perf_counter()
+        index = cls()
+        fields = ('tag_id', 'tag_type', 'rank')
+        for side, rows in (
+            (STUDENT, StudentTag.objects.order_by('student_id', 'tag_type', 'rank').values_list('student_id', *fields)),
+            (COMPANY, CompanyTag.objects.order_by('company_id', 'tag_type', 'rank').values_list('company_id', *fields)),
+        ):
+            entries = {}
+            for entity_id, tag_id, tag_type, rank in rows:
+                entries.setdefault(entity_id, []).append((tag_type, tag_id, rank))
+            for entity_id, tags in entries.items():
+                index._add(side, entity_id, tags)
+        index.build_seconds = time.perf_counter() - started
+        index.built_at = timezone.now()
+        return index
+
+    def _add(self, side, entity_id, tags):
+        """ tags: (tag_type, tag_id, rank) の並び (順位順) """
+        # 同じタグが複数の順位にある場合は後の順位で上書きする (MatchEngine と同じ挙動)
+        weights = {}
+        for tag_type, tag_id, rank in tags:
+            weights[(tag_type, tag_id)] = get_weight(rank)
+
+        postings = self.postings[side]
+        for key, weight in weights.items():
+            postings.setdefault(key, Postings()).add(entity_id, weight)
+        self.forward[side][entity_id] = [(t, tag_id, w) for (t, tag_id), w in weights.items()]
+
+    def _remove(self, side, entity_id):
+        postings = self.postings[side]
+        for tag_type, tag_id, _weight in self.forward[side].pop(entity_id, []):
+            plist = postings.get((tag_type, tag_id))
+            if plist is None:
+                continue
+            plist.remove(entity_id)
+            if not len(plist):
+                del postings[(tag_type, tag_id)]
+
+    def update_student(self, student_id):
+        """ 学生1人分のタグを DB から読み直して差し替える """
+        tags = list(StudentTag.objects.filter(student_id=student_id).order_by('tag_type', 'rank').values_list('tag_type', 'tag_id', 'rank'))
+        self._replace(STUDENT, student_id, tags)
+
+    def update_company(self, company_id):
+        """ 企業1社分のタグを DB から読み直して差し替える """
+        tags = list(CompanyTag.objects.filter(company_id=company_id).order_by('tag_type', 'rank').values_list('tag_type', 'tag_id', 'rank'))
+        self._replace(COMPANY, company_id, tags)
+
+    def remove_student(self, student_id):
+        self._replace(STUDENT, student_id, [])
+
+    def remove_company(self, company_id):
+        self._replace(COMPANY, company_id, [])
+
+    def _replace(self, side, entity_id, tags):
+        with self._lock:
+            self._remove(side, entity_id)
+            if tags:
+                self._add(side, entity_id, tags)
+            self.updates += 1
+
+    # --------------------------------------------------
+    # 検索
+    # --------------------------------------------------
+    def top_companies_for_student(self, student_id, k=10, exclude=None):
+        """ 学生に合う企業を [(company_id, percentage, score), ...] でマッチ度順に返す """
+        terms = [
+            (STUDENT_TO_COMPANY_TYPE[tag_type], tag_id, weight)
+            for tag_type, tag_id, weight in self.forward[STUDENT].get(student_id, [])
+            if tag_type in STUDENT_TO_COMPANY_TYPE
+        ]
+        return self.top_k(COMPANY, terms, k, exclude)
+
+    def top_students_for_company(self, company_id, k=10, exclude=None):
+        """ 企業に合う学生を [(student_id, percentage, score), ...] でマッチ度順に返す """
+        terms = [
+            (COMPANY_TO_STUDENT_TYPE[tag_type], tag_id, weight)
+            for tag_type, tag_id, weight in self.forward[COMPANY].get(company_id, [])
+            if tag_type in COMPANY_TO_STUDENT_TYPE
+        ]
+        return self.top_k(STUDENT, terms, k, exclude)
+
+    def top_k(self, side, terms, k, exclude=None):
+        """
+        terms: 検索する側の (tag_type, tag_id, 重み) の並び
+        side のエンティティから、重みの積の合計が大きい順に k 件を返す
+
+        重みの上限 (クエリ側の重み × ポスティングの最大重み) が大きいタグから順に足していき、
+        残りのタグの上限の合計が現在の k 位のスコアを下回ったら、
+        それ以降は新しい候補を増やさず既存候補のスコアだけを更新する。
+        """
+        exclude = exclude or ()
+        postings = self.postings[side]
+        plists = []
+        for tag_type, tag_id, weight in terms:
+            plist = postings.get((tag_type, tag_id))
+            if plist is not None:
+                plists.append((weight * plist.max_weight, weight, plist))
+        plists.sort(key=lambda p: p[0], reverse=True)
+
+        remaining = sum(p[0] for p in plists)
+        scores = {}
+        admitting = True
+        for upper_bound, weight, plist in plists:
+            if admitting and len(scores) >= k and heapq.nlargest(k, scores.values())[-1] > remaining:
+                admitting = False
+            for entity_id, entity_weight in zip(plist.ids, plist.weights):
+                if entity_id in scores:
+                    scores[entity_id] += weight * entity_weight
+                elif admitting and entity_id not in exclude:
+                    scores[entity_id] = weight * entity_weight
+            remaining -= upper_bound
+
+        top = heapq.nsmallest(k, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [(entity_id, int((score / TOTAL_MAX) * 100), score) for entity_id, score in top]
+
+    # --------------------------------------------------
+    # 統計
+    # --------------------------------------------------
+    def stats(self):
+        """ メモリ使用量・構築時間などの統計を返す """
+        result = {
+            'built_at': self.built_at,
+            'build_seconds': self.build_seconds,
+            'updates': self.updates,
+            'version': self.version,
+        }
+        for side in (STUDENT, COMPANY):
+            postings = self.postings[side]
+            result[side] = {
+                'entities': len(self.forward[side]),
+                'posting_lists': len(postings),
+                'postings': sum(len(p) for p in postings.values()),
+                'posting_bytes': sum(p.nbytes() for p in postings.values()),
+            }
+        result['posting_bytes'] = result[STUDENT]['posting_bytes'] + result[COMPANY]['posting_bytes']
+        return result
+
+
+def with_objects(results, queryset):
+    """
+    top_companies_for_student などの結果を [(インスタンス, percentage), ...] にする (1クエリ)
+    並びはそのまま。インデックスにあってもう DB に無いものは除く
+    """
+    objects = queryset.in_bulk([entity_id for entity_id, _percentage, _score in results])
+    return [(objects[entity_id], percentage) for entity_id, percentage, _score in results if entity_id in objects]
+
+
+# 他のプロセスでのタグ変更に気付くための世代番号 (キャッシュに置いて全プロセスで共有する)
+VERSION_CACHE_KEY = 'core:tag_index:version'
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _current_version():
+    return cache.get(VERSION_CACHE_KEY, 0)
+
+
+def _bump_version():
+    """ 世代番号を1つ進めて、新しい番号を返す """
+    cache.add(VERSION_CACHE_KEY, 0, timeout=None)
+    try:
+        return cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        # add と incr の間にキーが消えた場合。番号が飛べば各プロセスは作り直すので問題ない
+        cache.set(VERSION_CACHE_KEY, 1, timeout=None)
+        return 1
+
+
+def get_tag_index():
+    """
+    プロセス内で共有するインデックスを返す
+    初回アクセス時と、他のプロセスでタグが変わって世代番号がずれたときに構築し直す
+    """
+    global _index
+    version = _current_version()
+    if _index is None or _index.version != version:
+        with _index_lock:
+            if _index is None or _index.version != version:
+                index = TagIndex.build()
+                index.version = version
+                _index = index
+    return _index
+
+
+def get_tag_index_if_built():
+    """ 構築済みの場合だけインデックスを返す """
+    return _index
+
+
+def reset_tag_index():
+    """ インデックスを破棄する (次回アクセス時に作り直される) """
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def tag_index_changed(side=None, entity_id=None):
+    """
+    タグの変更・学生/企業の削除のあとに呼ぶ (コミット後に反映する)
+    side / entity_id を省略すると、差分ではなく全プロセスで作り直させる (タグ自体の削除など)
+    """
+    transaction.on_commit(lambda: _apply_change(side, entity_id))
+
+
+def _apply_change(side, entity_id):
+    with _index_lock:
+        version = _bump_version()
+        index = _index
+        # このプロセスのインデックスが直前の世代のときだけ差分を当てる
+        # (他のプロセスの変更を取りこぼしていれば、次の get_tag_index で作り直される)
+        if index is None or side is None or index.version != version - 1:
+            return
+        if side == STUDENT:
+            index.update_student(entity_id)
+        else:
+            index.update_company(entity_id)
+        index.version = version
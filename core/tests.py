@@ -1,3 +1,369 @@
-from django.test import TestCase
+import importlib
+import random
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from accounts.models import Student, StudentTag
+from companies.models import Company, CompanyTag
+from .matching import (
+    MATCH_SCORE_VERSION, MatchEngine, company_tags_changed, get_match_score, rebuild_match_scores, student_tags_changed,
+)
+from .middleware import (
+    QueryBudgetExceeded, QueryBudgetMiddleware, get_query_stats, query_budget, reset_query_stats,
+)
+from .models import MatchScore, Tag
+from .query_stats import QueryRecorder, fingerprint
+from .tag_index import (
+    COMPANY, STUDENT, TagIndex, get_tag_index, get_tag_index_if_built, reset_tag_index, tag_index_changed,
+)
+from .utils import calculate_match_percentage
+
+
+def reference_match(student, company):
+    """ MatchEngine にする前の、1ペアずつ計算していたときの calculate_match_percentage """
+    def get_weight(rank):
+        return 6 - rank
+
+    student_strengths = {t.tag.name: get_weight(t.rank) for t in student.tags.filter(tag_type='strength').order_by('rank')}
+    student_desires = {t.tag.name: get_weight(t.rank) for t in student.tags.filter(tag_type='desire').order_by('rank')}
+    company_needs = {t.tag.name: get_weight(t.rank) for t in company.tags.filter(tag_type='strength').order_by('rank')}
+    company_features = {t.tag.name: get_weight(t.rank) for t in company.tags.filter(tag_type='feature').order_by('rank')}
+
+    skills_score = 0
+    matched_strengths = []
+    for tag_name, weight in student_strengths.items():
+        if tag_name in company_needs:
+            skills_score += weight * company_needs[tag_name]
+            matched_strengths.append(tag_name)
+
+    conditions_score = 0
+    matched_conditions = []
+    for tag_name, weight in student_desires.items():
+        if tag_name in company_features:
+            conditions_score += weight * company_features[tag_name]
+            matched_conditions.append(tag_name)
+
+    return {
+        'percentage': int(((skills_score + conditions_score) / 110) * 100),
+        'matched_strengths': matched_strengths,
+        'matched_conditions': matched_conditions,
+    }
+
+
+class MatchTestData(TestCase):
+    """ 学生12人 + 企業6社 (ランダムなタグ) と、全部一致する学生・企業を1つずつ """
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(2)
+        cls.tags = [Tag.objects.create(name=f'タグ{i}') for i in range(10)]
+        cls.students = []
+        for i in range(12):
+            user = User.objects.create(username=f'student{i}')
+            student = Student.objects.create(user=user, full_name=f'学生{i}', grade=1)
+            cls.students.append(student)
+            for tag_type in ('strength', 'desire'):
+                for rank in range(1, rnd.randint(0, 5) + 1):
+                    StudentTag.objects.create(student=student, tag=rnd.choice(cls.tags), tag_type=tag_type, rank=rank)
+        cls.companies = []
+        for i in range(6):
+            company = Company.objects.create(name=f'企業{i}', industry='IT', description='説明')
+            cls.companies.append(company)
+            for tag_type in ('strength', 'feature'):
+                for rank in range(1, rnd.randint(0, 5) + 1):
+                    CompanyTag.objects.create(company=company, tag=rnd.choice(cls.tags), tag_type=tag_type, rank=rank)
+
+        # 強みは全部一致、求めるものは同じタグを1位と5位に付けたもの (後の順位の重みになる)
+        full = Student.objects.create(user=User.objects.create(username='full'), full_name='全一致', grade=1)
+        company = Company.objects.create(name='全一致企業', industry='IT', description='説明')
+        desires = cls.tags[:4] + cls.tags[:1]
+        for rank, (tag, desire) in enumerate(zip(cls.tags[:5], desires), start=1):
+            StudentTag.objects.create(student=full, tag=tag, tag_type='strength', rank=rank)
+            StudentTag.objects.create(student=full, tag=desire, tag_type='desire', rank=rank)
+            CompanyTag.objects.create(company=company, tag=tag, tag_type='strength', rank=rank)
+            CompanyTag.objects.create(company=company, tag=tag, tag_type='feature', rank=rank)
+        cls.students.append(full)
+        cls.companies.append(company)
+
+    def pairs(self):
+        for student in self.students:
+            for company in self.companies:
+                yield student, company
+
+
+class MatchEngineTests(MatchTestData):
+    def test_engine_matches_reference(self):
+        engine = MatchEngine.load()
+        matched = 0
+        for student, company in self.pairs():
+            expected = reference_match(student, company)
+            self.assertEqual(engine.match(student.pk, company.pk), expected, (student, company))
+            matched += expected['percentage'] > 0
+        # 一致するペアも一致しないペアもあること
+        self.assertGreater(matched, 0)
+        self.assertLess(matched, len(self.students) * len(self.companies))
+        # (55 + 1*5 + 4*4 + 3*3 + 2*2) / 110
+        self.assertEqual(engine.match(self.students[-1].pk, self.companies[-1].pk)['percentage'], 80)
+
+    def test_calculate_match_percentage_matches_reference(self):
+        for student, company in self.pairs():
+            self.assertEqual(calculate_match_percentage(student, company), reference_match(student, company))
+
+    def test_stored_scores_match_reference(self):
+        rebuild_match_scores(batch_size=5)
+        for student, company in self.pairs():
+            expected = reference_match(student, company)
+            self.assertEqual(get_match_score(student, company), expected, (student, company))
+            # 0% のペアは行を作らない
+            self.assertEqual(
+                MatchScore.objects.filter(student=student, company=company).exists(), expected['percentage'] > 0,
+            )
+
+    def test_migration_backfill_matches_engine(self):
+        migration = importlib.import_module('core.migrations.0006_matchscore_tag_ids')
+        migration.populate_match_scores(apps, None)
+        migrated = {
+            (row['student_id'], row['company_id']): row
+            for row in MatchScore.objects.values(
+                'student_id', 'company_id', 'percentage', 'skills_score', 'conditions_score',
+                'matched_strength_ids', 'matched_condition_ids', 'version',
+            )
+        }
+        expected = {(row['student_id'], row['company_id']): row for row in MatchEngine.load().iter_score_rows()}
+        self.assertEqual(migrated, expected)
+
+    def test_renamed_tag_is_shown_with_new_name(self):
+        rebuild_match_scores()
+        student, company = self.students[-1], self.companies[-1]
+        tag = self.tags[0]
+        tag.name = '新しい名前'
+        tag.save()
+
+        result = get_match_score(student, company)
+        self.assertIn('新しい名前', result['matched_strengths'])
+        self.assertEqual(result, reference_match(student, company))
+
+    def test_old_version_is_recalculated(self):
+        student, company = self.students[-1], self.companies[-1]
+        MatchScore.objects.create(
+            student=student, company=company, percentage=1, skills_score=1, conditions_score=0,
+            matched_strength_ids=[], matched_condition_ids=[], version=MATCH_SCORE_VERSION - 1,
+        )
+        self.assertEqual(get_match_score(student, company), reference_match(student, company))
+        self.assertEqual(MatchScore.objects.get(student=student, company=company).version, MATCH_SCORE_VERSION)
+
+    def test_tag_change_refreshes_student_row(self):
+        rebuild_match_scores()
+        student, company = self.students[-1], self.companies[-1]
+        StudentTag.objects.filter(student=student, tag_type='strength').delete()
+        student_tags_changed(student)
+        self.assertEqual(get_match_score(student, company), reference_match(student, company))
+
+
+class TagIndexTests(MatchTestData):
+    def setUp(self):
+        cache.clear()
+        reset_tag_index()
+        self.addCleanup(reset_tag_index)
+
+    def brute_force(self, side, entity_id, k):
+        """ MatchEngine で全ペアを計算して並べた上位 k 件 (同点は ID の小さい順) """
+        rows = [
+            (company_id if side == STUDENT else student_id, percentage, skills + conditions)
+            for student_id, company_id, percentage, skills, conditions in MatchEngine.load().iter_matches()
+            if (student_id if side == STUDENT else company_id) == entity_id
+        ]
+        return sorted(rows, key=lambda row: (-row[2], row[0]))[:k]
+
+    def assertMatchesBruteForce(self, index):
+        for k in (1, 3, 100):
+            for student in self.students:
+                self.assertEqual(
+                    index.top_companies_for_student(student.pk, k=k), self.brute_force(STUDENT, student.pk, k),
+                    (student, k),
+                )
+            for company in self.companies:
+                self.assertEqual(
+                    index.top_students_for_company(company.pk, k=k), self.brute_force(COMPANY, company.pk, k),
+                    (company, k),
+                )
+
+    def test_top_k_matches_brute_force(self):
+        self.assertMatchesBruteForce(TagIndex.build())
+
+    def test_tag_change_updates_built_index(self):
+        index = get_tag_index()
+        student, company = self.students[0], self.companies[0]
+        StudentTag.objects.filter(student=student).delete()
+        StudentTag.objects.create(student=student, tag=self.tags[9], tag_type='desire', rank=1)
+        CompanyTag.objects.filter(company=company).delete()
+        CompanyTag.objects.create(company=company, tag=self.tags[9], tag_type='feature', rank=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            student_tags_changed(student)
+            company_tags_changed(company)
+
+        # 作り直さずに差分だけ当てている
+        self.assertIs(get_tag_index(), index)
+        self.assertEqual(index.updates, 2)
+        self.assertMatchesBruteForce(index)
+        self.assertEqual(index.top_companies_for_student(student.pk, k=1), [(company.pk, 18, 20)])
+
+    def test_deleted_student_and_company_are_removed(self):
+        index = get_tag_index()
+        student, company = self.students[-1], self.companies[-1]
+        with self.captureOnCommitCallbacks(execute=True):
+            student.delete()
+            company.delete()
+
+        self.assertIs(get_tag_index(), index)
+        self.assertNotIn(student.pk, index.forward[STUDENT])
+        self.assertNotIn(company.pk, index.forward[COMPANY])
+        for postings in list(index.postings[STUDENT].values()) + list(index.postings[COMPANY].values()):
+            self.assertNotIn(student.pk, postings.ids)
+            self.assertNotIn(company.pk, postings.ids)
+        self.assertMatchesBruteForce(index)
+
+    def test_change_in_other_process_rebuilds(self):
+        index = get_tag_index()
+        student = self.students[0]
+        StudentTag.objects.filter(student=student).delete()
+        # 他のプロセスがタグを変えて世代番号を進めた (このプロセスのインデックスは古いまま)
+        with self.captureOnCommitCallbacks(execute=True):
+            tag_index_changed(STUDENT, student.pk)
+            tag_index_changed(STUDENT, student.pk)
+        index.version -= 1
+
+        rebuilt = get_tag_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(rebuilt.top_companies_for_student(student.pk), [])
+
+    def test_deleted_tag_rebuilds(self):
+        index = get_tag_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tags[0].delete()
+        self.assertIs(get_tag_index_if_built(), index)
+        rebuilt = get_tag_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertMatchesBruteForce(rebuilt)
+
+    def test_stats(self):
+        index = TagIndex.build()
+        stats = index.stats()
+        student_tags = {(s, t, tag) for s, t, tag in StudentTag.objects.values_list('student_id', 'tag_type', 'tag_id')}
+        company_tags = {(c, t, tag) for c, t, tag in CompanyTag.objects.values_list('company_id', 'tag_type', 'tag_id')}
+        self.assertEqual(stats[STUDENT]['postings'], len(student_tags))
+        self.assertEqual(stats[COMPANY]['postings'], len(company_tags))
+        self.assertEqual(stats[STUDENT]['entities'], len({s for s, _t, _tag in student_tags}))
+        self.assertEqual(stats[COMPANY]['posting_lists'], len({(t, tag) for _c, t, tag in company_tags}))
+        self.assertGreater(stats['posting_bytes'], 0)
+        self.assertEqual(stats['posting_bytes'], stats[STUDENT]['posting_bytes'] + stats[COMPANY]['posting_bytes'])
+        self.assertGreaterEqual(stats['build_seconds'], 0)
+        self.assertIsNotNone(stats['built_at'])
+
+
+class QueryStatsTests(TestCase):
+
+    def test_fingerprint_ignores_literals_and_in_lists(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE id = 12 AND name = 'it''s' AND x IN (%s, %s, %s)"),
+            fingerprint("SELECT  *  FROM t WHERE id = 3 AND name = 'b' AND x IN (%s)"),
+        )
+        self.assertNotEqual(fingerprint('SELECT * FROM a WHERE id = 1'), fingerprint('SELECT * FROM b WHERE id = 1'))
+
+    def test_recorder_counts_queries_and_rows(self):
+        for i in range(3):
+            Tag.objects.create(name=f'タグ{i}')
+        with QueryRecorder() as recorder:
+            list(Tag.objects.all())
+            for pk in (1, 2):
+                Tag.objects.filter(pk=pk).first()
+        self.assertEqual(recorder.count, 3)
+        self.assertEqual(recorder.rows, 5)
+        self.assertEqual(sorted(recorder.fingerprints().values()), [1, 2])
+
+
+@override_settings(QUERY_BUDGET={'ENABLED': True, 'N_PLUS_ONE_THRESHOLD': 5})
+class QueryBudgetMiddlewareTests(TestCase):
+
+    def setUp(self):
+        reset_query_stats()
+        self.addCleanup(reset_query_stats)
+        self.user = User.objects.create_user(username='user', password='pass')
+        self.client.force_login(self.user)
+
+    def run_view(self, view, path='/some/path/'):
+        """ view を QueryBudgetMiddleware に通して呼ぶ (URL の解決は通さない) """
+        middleware = QueryBudgetMiddleware(None)
+        request = RequestFactory().get(path)
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            return view(request)
+        middleware.get_response = get_response
+        return middleware(request)
+
+    @staticmethod
+    def n_plus_one_view(request, count=6):
+        for pk in range(count):
+            User.objects.filter(pk=pk).first()
+        return HttpResponse()
+
+    @override_settings(QUERY_BUDGET={'ENABLED': True, 'BUDGETS': {'accounts:dashboard': 1}})
+    def test_budget_overrun_is_logged(self):
+        with self.assertLogs('core.middleware', 'WARNING') as logs:
+            response = self.client.get(reverse('accounts:dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('accounts:dashboard: クエリ数', logs.output[0])
+        self.assertIn('上限 1 を超えました', logs.output[0])
+        stats = get_query_stats()['accounts:dashboard']
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreater(stats['max_queries'], 1)
+
+    @override_settings(QUERY_BUDGET={
+        'ENABLED': True, 'BUDGETS': {'accounts:dashboard': 1}, 'RAISE': True, 'RESPONSE_HEADERS': True,
+    })
+    def test_budget_overrun_raises(self):
+        with self.assertRaises(QueryBudgetExceeded), self.assertLogs('core.middleware', 'WARNING'):
+            self.client.get(reverse('accounts:dashboard'))
+
+        # 上限内ならそのまま返す
+        with self.settings(QUERY_BUDGET={'ENABLED': True, 'BUDGETS': {'accounts:dashboard': 100}, 'RAISE': True,
+                                         'RESPONSE_HEADERS': True}):
+            response = self.client.get(reverse('accounts:dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response['X-Query-Count']), 1)
+
+    def test_view_budget_takes_precedence(self):
+        view = query_budget(2)(lambda request: self.n_plus_one_view(request, count=3))
+        with self.settings(QUERY_BUDGET={'ENABLED': True, 'BUDGETS': {'/some/path/': 100}, 'RAISE': True}):
+            with self.assertRaisesRegex(QueryBudgetExceeded, 'クエリ数 3 が上限 2'), self.assertLogs('core.middleware'):
+                self.run_view(view)
+
+    def test_repeated_query_is_reported_as_n_plus_one(self):
+        with self.assertLogs('core.middleware', 'WARNING') as logs:
+            self.run_view(self.n_plus_one_view)
+        [message] = logs.output
+        self.assertIn('N+1 の可能性 (6 回)', message)
+        self.assertIn('SELECT "auth_user"."id"', message)
+        self.assertEqual(get_query_stats()['/some/path/']['n_plus_one'], 1)
+
+        with self.settings(QUERY_BUDGET={'ENABLED': True, 'N_PLUS_ONE_THRESHOLD': 5, 'RAISE': True}):
+            with self.assertRaisesRegex(QueryBudgetExceeded, 'N\\+1'), self.assertLogs('core.middleware'):
+                self.run_view(self.n_plus_one_view)
+
+    def test_below_threshold_is_quiet(self):
+        with self.assertNoLogs('core.middleware', 'WARNING'):
+            self.run_view(lambda request: self.n_plus_one_view(request, count=5))
+        self.assertEqual(get_query_stats()['/some/path/'], {
+            'requests': 1, 'queries': 5, 'max_queries': 5, 'sql_time': mock.ANY, 'n_plus_one': 0,
+        })
+
+    @override_settings(QUERY_BUDGET={'ENABLED': False, 'BUDGETS': {'accounts:dashboard': 1}, 'RAISE': True})
+    def test_disabled(self):
+        self.assertEqual(self.client.get(reverse('accounts:dashboard')).status_code, 200)
+        self.assertEqual(get_query_stats(), {})
@@ -1,5 +1,12 @@
 from django.contrib import admin
-from .models import Portfolio, PortfolioItem
+from .models import Portfolio, PortfolioItem, PortfolioUpload
 
 admin.site.register(Portfolio)
 admin.site.register(PortfolioItem)
+
+
+@admin.register(PortfolioUpload)
+class PortfolioUploadAdmin(admin.ModelAdmin):
+    list_display = ('filename', 'portfolio', 'size', 'received', 'status', 'updated_at')
+    list_filter = ('status',)
+    raw_id_fields = ('portfolio', 'item')
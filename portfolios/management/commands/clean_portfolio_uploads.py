@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolios.uploads import clean_expired_uploads, get_upload_settings
+
+
+class Command(BaseCommand):
+    help = '途中で止まったままの分割アップロードと、その一時ファイルを削除します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=int, default=None,
+            help='この時間動きのないものを削除する (省略時は settings.PORTFOLIO_UPLOAD の EXPIRE_HOURS)',
+        )
+
+    def handle(self, *args, **options):
+        hours = options['hours'] if options['hours'] is not None else get_upload_settings()['EXPIRE_HOURS']
+        if hours < 1:
+            raise CommandError('--hours には1以上を指定してください。')
+        count = clean_expired_uploads(hours)
+        self.stdout.write(f'{hours} 時間以上動きのないアップロード {count} 件を削除しました。')
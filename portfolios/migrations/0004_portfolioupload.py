@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolios', '0003_auto_20251118_1146'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255, verbose_name='ファイル名')),
+                ('size', models.BigIntegerField(verbose_name='ファイルサイズ')),
+                ('sha256', models.CharField(max_length=64, verbose_name='SHA-256')),
+                ('received', models.BigIntegerField(default=0, verbose_name='受け取ったバイト数')),
+                ('status', models.CharField(choices=[('uploading', 'アップロード中'), ('completed', '完了')], default='uploading', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('item', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='portfolios.portfolioitem')),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to='portfolios.portfolio')),
+            ],
+            options={
+                'verbose_name': '分割アップロード',
+                'verbose_name_plural': '分割アップロード',
+            },
+        ),
+    ]
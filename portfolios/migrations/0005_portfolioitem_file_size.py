@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:16
+
+from django.db import migrations, models
+
+
+def fill_file_sizes(apps, schema_editor):
+    # これまでのファイルの大きさをストレージから読む (ファイルが無くなっているものは 0 のまま)
+    PortfolioItem = apps.get_model('portfolios', 'PortfolioItem')
+    items = []
+    for item in PortfolioItem.objects.exclude(file='').iterator():
+        try:
+            item.file_size = item.file.size
+        except OSError:
+            continue
+        items.append(item)
+    PortfolioItem.objects.bulk_update(items, ['file_size'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolios', '0004_portfolioupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolioitem',
+            name='file_size',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='ファイルサイズ'),
+        ),
+        migrations.RunPython(fill_file_sizes, migrations.RunPython.noop),
+    ]
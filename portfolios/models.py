@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from .validators import validate_file_extension
 # ↓↓ 循環インポートエラーを避けるため、直接インポートしない
@@ -40,9 +42,17 @@ class PortfolioItem(models.Model):
         validators=[validate_file_extension],
         help_text="PDF, 画像(JPG/PNG), またはソースコード一式(ZIP)をアップロードしてください。"
     )
+    # 学生ごとの容量の集計 (portfolios.uploads.get_used_bytes) 用
+    file_size = models.BigIntegerField(default=0, editable=False, verbose_name="ファイルサイズ")
     
     def __str__(self):
         return f"{self.portfolio.title} の添付ファイル"
+
+    def save(self, *args, **kwargs):
+        # 新しいファイルが付いたときだけ大きさを記録する (保存済みのファイルを毎回調べない)
+        if self.file and not self.file._committed:
+            self.file_size = self.file.size
+        super().save(*args, **kwargs)
     
     def delete(self, *args, **kwargs):
         self.file.delete(save=False)
@@ -50,4 +60,36 @@ class PortfolioItem(models.Model):
 
     class Meta:
         verbose_name = "ポートフォリオ作品"
-        verbose_name_plural = "ポートフォリオ作品"
\ No newline at end of file
+        verbose_name_plural = "ポートフォリオ作品"
+
+
+class PortfolioUpload(models.Model):
+    """
+    分割アップロード (portfolios.uploads) の途中経過
+    受け取った分は一時ファイルに書き、finalize で PortfolioItem に移す
+    """
+    STATUS_UPLOADING = 'uploading'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'アップロード中'),
+        (STATUS_COMPLETED, '完了'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name="uploads")
+    filename = models.CharField(max_length=255, verbose_name="ファイル名")
+    size = models.BigIntegerField(verbose_name="ファイルサイズ")
+    # クライアントが計算したファイル全体の SHA-256 (16進数)。finalize で照合する
+    sha256 = models.CharField(max_length=64, verbose_name="SHA-256")
+    received = models.BigIntegerField(default=0, verbose_name="受け取ったバイト数")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_UPLOADING)
+    item = models.ForeignKey(PortfolioItem, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
+    class Meta:
+        verbose_name = "分割アップロード"
+        verbose_name_plural = "分割アップロード"
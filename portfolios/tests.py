@@ -1,3 +1,283 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopUpload
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from accounts.models import Student
+from .models import Portfolio, PortfolioItem, PortfolioUpload
+from .upload_handlers import PortfolioUploadHandler
+from .uploads import chunked_sha256, get_temp_path
+
+CHUNK_SIZE = 1000
+
+
+def make_zip(size):
+    """ 先頭だけ ZIP の形式になっている size バイトのデータ """
+    return (b'PK\x03\x04' + os.urandom(size))[:size]
+
+
+def checksum(data, chunk_size=CHUNK_SIZE):
+    # ブラウザ側 (portfolio_detail.html の checksum) と同じ計算
+    joined = b''.join(
+        hashlib.sha256(data[i:i + chunk_size]).digest() for i in range(0, len(data), chunk_size)
+    )
+    return hashlib.sha256(joined).hexdigest()
+
+
+class MediaRootMixin:
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        user = User.objects.create_user(username='student', password='pass')
+        self.student = Student.objects.create(user=user, full_name='学生', grade=1)
+        self.portfolio = Portfolio.objects.create(student=self.student, title='作品集', description='説明')
+        self.client.force_login(user)
+
+
+@override_settings(PORTFOLIO_UPLOAD={'CHUNK_SIZE': CHUNK_SIZE})
+class ChunkedUploadTests(MediaRootMixin, TestCase):
+    def init(self, data, filename='src.zip', sha256=None):
+        return self.client.post(
+            reverse('portfolios:upload_init', kwargs={'portfolio_pk': self.portfolio.pk}),
+            json.dumps({'filename': filename, 'size': len(data), 'sha256': sha256 or checksum(data)}),
+            content_type='application/json',
+        )
+
+    def put(self, upload, offset, chunk, chunk_sha256=None):
+        headers = {}
+        if chunk_sha256:
+            headers['HTTP_X_CHUNK_SHA256'] = chunk_sha256
+        return self.client.put(
+            f"{upload['chunk_url']}?offset={offset}", chunk,
+            content_type='application/octet-stream', **headers,
+        )
+
+    def send(self, upload, data, start=0):
+        for offset in range(start, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            response = self.put(upload, offset, chunk, hashlib.sha256(chunk).hexdigest())
+            self.assertEqual(response.status_code, 200, response.content)
+
+    def test_chunked_sha256_matches_client_checksum(self):
+        data = make_zip(2500)
+        path = os.path.join(self.media_root, 'data')
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        self.assertEqual(chunked_sha256(path), checksum(data))
+        self.assertEqual(chunked_sha256(path, 500), checksum(data, 500))
+
+    def test_upload_in_chunks_and_finalize(self):
+        data = make_zip(2500)
+        upload = self.init(data).json()
+        self.assertEqual(upload['received'], 0)
+        self.assertEqual(upload['chunk_size'], CHUNK_SIZE)
+
+        self.send(upload, data)
+        response = self.client.post(upload['finalize_url'])
+        self.assertEqual(response.status_code, 200, response.content)
+
+        item = PortfolioItem.objects.get(pk=response.json()['item_id'])
+        self.assertEqual(item.portfolio, self.portfolio)
+        self.assertEqual(item.file_size, len(data))
+        with item.file.open('rb') as fh:
+            self.assertEqual(fh.read(), data)
+        upload_obj = PortfolioUpload.objects.get(pk=upload['upload_id'])
+        self.assertEqual(upload_obj.status, PortfolioUpload.STATUS_COMPLETED)
+        self.assertFalse(os.path.exists(get_temp_path(upload_obj)))
+
+        # もう一度 finalize しても同じ作品を返す
+        again = self.client.post(upload['finalize_url'])
+        self.assertEqual(again.json()['item_id'], item.pk)
+        self.assertEqual(PortfolioItem.objects.count(), 1)
+
+    def test_wrong_offset_returns_received(self):
+        data = make_zip(2500)
+        upload = self.init(data).json()
+        self.put(upload, 0, data[:CHUNK_SIZE])
+
+        response = self.put(upload, 0, data[:CHUNK_SIZE])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['received'], CHUNK_SIZE)
+
+        response = self.put(upload, 2 * CHUNK_SIZE, data[2 * CHUNK_SIZE:])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['received'], CHUNK_SIZE)
+
+    def test_init_resumes_same_file(self):
+        data = make_zip(2500)
+        upload = self.init(data).json()
+        self.put(upload, 0, data[:CHUNK_SIZE])
+
+        resumed = self.init(data).json()
+        self.assertEqual(resumed['upload_id'], upload['upload_id'])
+        self.assertEqual(resumed['received'], CHUNK_SIZE)
+
+        # 中身が違えば別のアップロード
+        other = self.init(make_zip(2500)).json()
+        self.assertNotEqual(other['upload_id'], upload['upload_id'])
+
+    def test_chunk_hash_mismatch_is_not_received(self):
+        data = make_zip(2500)
+        upload = self.init(data).json()
+        self.put(upload, 0, data[:CHUNK_SIZE])
+
+        corrupted = b'x' * CHUNK_SIZE
+        response = self.put(upload, CHUNK_SIZE, corrupted, hashlib.sha256(data[CHUNK_SIZE:2 * CHUNK_SIZE]).hexdigest())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['received'], CHUNK_SIZE)
+        self.assertTrue(response.json()['retry'])
+
+        upload_obj = PortfolioUpload.objects.get(pk=upload['upload_id'])
+        self.assertEqual(upload_obj.received, CHUNK_SIZE)
+        self.assertEqual(os.path.getsize(get_temp_path(upload_obj)), CHUNK_SIZE)
+
+        # 送り直せば続きから受け取る
+        self.send(upload, data, CHUNK_SIZE)
+        self.assertEqual(self.client.post(upload['finalize_url']).status_code, 200)
+
+    def test_finalize_checksum_mismatch_discards_upload(self):
+        data = make_zip(2500)
+        # クライアントが申告したチェックサムと届いた中身が違う
+        upload = self.init(data, sha256=checksum(make_zip(2500))).json()
+        self.send(upload, data)
+
+        response = self.client.post(upload['finalize_url'])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PortfolioItem.objects.exists())
+        self.assertFalse(PortfolioUpload.objects.filter(pk=upload['upload_id']).exists())
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'portfolio_uploads')), [])
+
+    def test_finalize_before_all_chunks(self):
+        data = make_zip(2500)
+        upload = self.init(data).json()
+        self.put(upload, 0, data[:CHUNK_SIZE])
+
+        response = self.client.post(upload['finalize_url'])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['received'], CHUNK_SIZE)
+        self.assertFalse(PortfolioItem.objects.exists())
+
+    def test_other_student_cannot_use_upload(self):
+        data = make_zip(2500)
+        upload = self.init(data).json()
+        other = User.objects.create_user(username='other', password='pass')
+        Student.objects.create(user=other, full_name='他の学生', grade=1)
+        self.client.force_login(other)
+
+        self.assertEqual(self.client.get(upload['status_url']).status_code, 403)
+        self.assertEqual(self.put(upload, 0, data[:CHUNK_SIZE]).status_code, 403)
+        self.assertEqual(self.init(data).status_code, 403)
+
+
+@override_settings(PORTFOLIO_UPLOAD={'MAX_FILE_SIZE': 1024 * 1024, 'STUDENT_QUOTA': 1536 * 1024})
+class UploadHandlerTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.force_login(self.student.user)
+        # 詳細ページを開いて csrftoken を受け取る
+        self.client.get(reverse('portfolios:detail', kwargs={'pk': self.portfolio.pk}))
+        self.handlers = []
+
+    def post(self, name, data, csrf=True):
+        """ フォームから送る。戻り値: (レスポンス, 本文のうち読まれなかったバイト数) """
+        def make_handler(*args, **kwargs):
+            handler = PortfolioUploadHandler(*args, **kwargs)
+            self.handlers.append(handler)
+            return handler
+
+        # ブラウザと同じくトークンをファイルより前に送る (受け取りをやめた後ろの部分は読まれない)
+        form = {}
+        if csrf:
+            form['csrfmiddlewaretoken'] = self.client.cookies['csrftoken'].value
+        form['file'] = SimpleUploadedFile(name, data)
+        with mock.patch('portfolios.views.PortfolioUploadHandler', side_effect=make_handler):
+            response = self.client.post(reverse('portfolios:add_item', kwargs={'portfolio_pk': self.portfolio.pk}), form)
+        unread = len(self.handlers[-1].request.META['wsgi.input']) if self.handlers else None
+        return response, unread
+
+    def errors(self):
+        response = self.client.get(reverse('portfolios:detail', kwargs={'pk': self.portfolio.pk}))
+        return [str(message) for message in response.context['messages']]
+
+    def test_valid_file_is_saved(self):
+        data = make_zip(500 * 1024)
+        response, _ = self.post('src.zip', data)
+        self.assertRedirects(response, reverse('portfolios:detail', kwargs={'pk': self.portfolio.pk}))
+        item = PortfolioItem.objects.get()
+        self.assertEqual(item.file_size, len(data))
+        self.assertEqual(self.errors(), [])
+
+    def test_csrf_is_still_checked(self):
+        response, _ = self.post('src.zip', make_zip(1024), csrf=False)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(PortfolioItem.objects.exists())
+
+    def test_bad_magic_bytes_stop_reading(self):
+        data = b'MZ' + b'\x00' * (900 * 1024)
+        response, unread = self.post('src.zip', data)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(PortfolioItem.objects.exists())
+        self.assertEqual(self.errors(), ['ファイルの中身が .zip の形式ではありません。'])
+        # 先頭を見た時点でやめるので、本文の大半は読まない
+        self.assertGreater(unread, 700 * 1024)
+
+    def test_text_extension_must_be_text(self):
+        self.post('main.py', b'\x89PNG\r\n\x1a\n' + b'\x00' * 100)
+        self.assertFalse(PortfolioItem.objects.exists())
+        self.assertEqual(self.errors(), ['.py ファイルはテキストファイルである必要があります。'])
+
+        self.post('main.py', 'print("こんにちは")\n'.encode('cp932'))
+        self.assertEqual(PortfolioItem.objects.count(), 1)
+
+    def test_bad_extension_stops_before_reading_file(self):
+        response, unread = self.post('tool.exe', b'MZ' + b'\x00' * (900 * 1024))
+        self.assertFalse(PortfolioItem.objects.exists())
+        self.assertTrue(self.errors()[0].startswith('未対応のファイル形式です。'))
+        self.assertGreater(unread, 700 * 1024)
+
+    def test_oversized_file_is_rejected_from_content_length(self):
+        response, unread = self.post('src.zip', make_zip(2 * 1024 * 1024))
+        self.assertFalse(PortfolioItem.objects.exists())
+        self.assertEqual(self.errors(), ['ファイルが大きすぎます (上限 1.0 MB)。'])
+        # Content-Length だけで分かるので、ファイルの中身は読まない
+        self.assertGreater(unread, 1800 * 1024)
+
+    def test_quota_is_enforced(self):
+        self.post('first.zip', make_zip(800 * 1024))
+        self.assertEqual(PortfolioItem.objects.count(), 1)
+
+        response, unread = self.post('second.zip', make_zip(900 * 1024))
+        self.assertEqual(PortfolioItem.objects.count(), 1)
+        self.assertEqual(self.errors(), ['アップロードできる容量を超えています (残り 0.7 MB)。'])
+        self.assertGreater(unread, 800 * 1024)
+
+        # 作品を消せば空きができる
+        PortfolioItem.objects.get().delete()
+        self.post('second.zip', make_zip(900 * 1024))
+        self.assertEqual(PortfolioItem.objects.count(), 1)
+
+    def test_size_is_checked_while_receiving(self):
+        # Content-Length が分からない (chunked) 場合は受け取った大きさで判定する
+        handler = PortfolioUploadHandler(RequestFactory().post('/'), self.student.pk)
+        handler.new_file('file', 'src.zip', 'application/zip', None)
+        chunk = make_zip(64 * 1024)
+        for start in range(0, 1024 * 1024, len(chunk)):
+            handler.receive_data_chunk(chunk, start)
+        with self.assertRaises(StopUpload) as cm:
+            handler.receive_data_chunk(chunk, 1024 * 1024)
+        self.assertTrue(cm.exception.connection_reset)
+        self.assertEqual(handler.error, 'ファイルが大きすぎます (上限 1.0 MB)。')
@@ -0,0 +1,89 @@
+"""
+作品ファイルのアップロード (add_portfolio_item) を受け取りながら確認する upload handler
+
+validate_file_extension はファイル名しか見ず、しかも Django がファイルを全部受け取って
+一時ファイルに書いた後にしか動かない。そこでフォームの本文を読んでいる途中で次を確認し、
+だめならその場で受け取りをやめる (StopUpload(connection_reset=True) で残りの本文を読まない)。
+
+- ファイル名の拡張子 (new_file の時点)
+- リクエスト全体の大きさ (Content-Length) が1ファイルの上限・学生の残り容量を明らかに超えていないか
+- 先頭のバイト列が拡張子どおりの形式か (validate_file_signature)
+- 受け取った大きさが上限・残り容量を超えていないか (chunk ごと)
+
+受け取ったデータは次の handler (settings.FILE_UPLOAD_HANDLERS) にそのまま渡すので、
+保存のしかたはこれまでと変わらない。やめた理由は error に入れておき、ビューで表示する。
+"""
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from .uploads import UploadError, check_size, get_remaining_quota
+from .validators import SIGNATURE_LENGTH, validate_file_extension, validate_file_signature
+
+# multipart のファイル以外の部分 (csrf トークンや区切り) の大きさの見込み
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class PortfolioUploadHandler(FileUploadHandler):
+    """ request.upload_handlers の先頭に入れて使う (add_portfolio_item) """
+
+    def __init__(self, request, student_id):
+        super().__init__(request)
+        self.student_id = student_id
+        self.error = None
+        # リクエスト全体の Content-Length (self.content_length は new_file でファイルごとの値に上書きされる)
+        self.request_length = None
+        # 残り容量はリクエストごとに1回だけ調べる
+        self.remaining = None
+        # このリクエストで受け取り終わったファイルの合計
+        self.completed_size = 0
+        self.head = None
+
+    def reject(self, message):
+        self.error = message
+        raise StopUpload(connection_reset=True)
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.request_length = content_length
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        try:
+            validate_file_extension(File(None, name=self.file_name))
+        except ValidationError as e:
+            self.reject(e.messages[0])
+        # 本文全体がこれだけ大きければ、ファイルも上限を超えている (最初のファイルのときだけ分かる)
+        if self.request_length and not self.completed_size:
+            self.check_size(self.request_length - MULTIPART_OVERHEAD)
+        self.head = b''
+
+    def check_size(self, size):
+        """ size: 受け取り中のファイルの大きさ """
+        if self.remaining is None:
+            self.remaining = get_remaining_quota(self.student_id)
+        try:
+            check_size(size, self.remaining - self.completed_size)
+        except UploadError as e:
+            self.reject(e.message)
+
+    def check_signature(self):
+        try:
+            validate_file_signature(self.file_name, self.head)
+        except ValidationError as e:
+            self.reject(e.messages[0])
+        self.head = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.head is not None:
+            self.head += raw_data[:SIGNATURE_LENGTH - len(self.head)]
+            if len(self.head) >= SIGNATURE_LENGTH:
+                self.check_signature()
+        self.check_size(start + len(raw_data))
+        return raw_data
+
+    def file_complete(self, file_size):
+        # SIGNATURE_LENGTH より小さいファイル
+        if self.head is not None:
+            self.check_signature()
+        self.completed_size += file_size
+        return None
@@ -0,0 +1,318 @@
+"""
+ポートフォリオの作品ファイルの分割アップロード (再開可能)
+
+大きな ZIP などを1回の multipart POST で送ると、途中で切れたときに最初からやり直しになり、
+その間ワーカーも1つふさがる。そこで次の手順で少しずつ送れるようにする。
+
+1. init: ファイル名・サイズ・ファイルのチェックサム (chunked_sha256) を送る → upload_id と1回に送る大きさ
+   (同じファイルのアップロードが途中で残っていれば、それを返すので続きから送れる)
+   チェックサムは CHUNK_SIZE ごとの SHA-256 を並べたものの SHA-256。ブラウザは1回分ずつ読んで
+   計算できるので、ファイル全体をメモリに読み込まなくてよい (その値は各 chunk の X-Chunk-SHA256 にも使える)
+2. chunk: offset (= それまでに受け取ったバイト数) を付けて、本文にファイルの一部をそのまま送る
+   (application/octet-stream)。本文はメモリにためずに少しずつ一時ファイルに書く。
+   X-Chunk-SHA256 ヘッダーがあれば、その部分の SHA-256 も照合する
+3. finalize: 一時ファイルから同じチェックサムを計算して照合し、PortfolioItemForm を通して
+   (validate_file_extension などのチェックはそのまま) PortfolioItem を作る
+
+- offset が受け取ったバイト数と違えば 409 を返す。クライアントは返ってきた received から送り直す
+- 通信が途中で切れた場合も、書けた分は受け取ったことにする (次はその続きから送ればよい)
+- 一時ファイルは TEMP_DIR に置き、finalize では (FileSystemStorage なら) コピーせずに移動する
+- 途中で CHUNK_SIZE を変えると、送っている途中のものはチェックサムが合わなくなる (最初からやり直し)
+- EXPIRE_HOURS 時間動きのないものは clean_portfolio_uploads コマンドで消す
+- 1ファイルの上限 (MAX_FILE_SIZE) と学生ごとの容量 (STUDENT_QUOTA) は init で確認し、finalize でも確認し直す。
+  ファイルの先頭が拡張子どおりの形式か (validate_file_signature) は最初の chunk で確認する
+  (フォームからのアップロードは portfolios.upload_handlers で同じ確認をする)
+"""
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db.models import Sum
+from django.utils import timezone
+
+from .forms import PortfolioItemForm
+from .models import PortfolioItem, PortfolioUpload
+from .validators import SIGNATURE_LENGTH, validate_file_extension, validate_file_signature
+
+DEFAULT_UPLOAD_SETTINGS = {
+    # 1回の chunk で受け取る最大のバイト数 (クライアントにもこの大きさで送ってもらう)
+    'CHUNK_SIZE': 8 * 1024 * 1024,
+    # 1ファイルの上限 (バイト)
+    'MAX_FILE_SIZE': 500 * 1024 * 1024,
+    # 学生1人がアップロードできる合計 (バイト)
+    'STUDENT_QUOTA': 2 * 1024 * 1024 * 1024,
+    # この時間動きのない途中のアップロードは消す
+    'EXPIRE_HOURS': 24,
+    # 一時ファイルを置くディレクトリ (None なら MEDIA_ROOT/portfolio_uploads)
+    'TEMP_DIR': None,
+}
+
+# リクエストの本文を読む・ファイルを読む単位
+READ_BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """ クライアントに返すエラー。status は HTTP のステータス """
+
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+
+def get_upload_settings():
+    return {**DEFAULT_UPLOAD_SETTINGS, **getattr(settings, 'PORTFOLIO_UPLOAD', {})}
+
+
+def get_used_bytes(student_id):
+    """ 学生がアップロード済みの作品ファイルの合計 (バイト) """
+    used = PortfolioItem.objects.filter(portfolio__student_id=student_id).aggregate(n=Sum('file_size'))['n']
+    return used or 0
+
+
+def get_remaining_quota(student_id):
+    return max(get_upload_settings()['STUDENT_QUOTA'] - get_used_bytes(student_id), 0)
+
+
+def format_size(size):
+    return f'{size / (1024 * 1024):.1f} MB'
+
+
+def check_size(size, remaining):
+    """ 1ファイルの上限と学生の残り容量 (get_remaining_quota) を確認する。超えていれば UploadError (413) """
+    max_size = get_upload_settings()['MAX_FILE_SIZE']
+    if size > max_size:
+        raise UploadError(f'ファイルが大きすぎます (上限 {format_size(max_size)})。', status=413)
+    if size > remaining:
+        raise UploadError(f'アップロードできる容量を超えています (残り {format_size(remaining)})。', status=413)
+
+
+def get_temp_path(upload):
+    temp_dir = get_upload_settings()['TEMP_DIR'] or os.path.join(settings.MEDIA_ROOT, 'portfolio_uploads')
+    return os.path.join(temp_dir, f'{upload.pk.hex}.part')
+
+
+def chunked_sha256(path, chunk_size=None):
+    """ chunk_size (CHUNK_SIZE) ごとの SHA-256 (バイト列) を並べたものの SHA-256 """
+    if chunk_size is None:
+        chunk_size = get_upload_settings()['CHUNK_SIZE']
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        while True:
+            chunk_digest = hashlib.sha256()
+            size = 0
+            while size < chunk_size:
+                block = fh.read(min(READ_BLOCK_SIZE, chunk_size - size))
+                if not block:
+                    break
+                chunk_digest.update(block)
+                size += len(block)
+            if not size:
+                break
+            digest.update(chunk_digest.digest())
+    return digest.hexdigest()
+
+
+def _clean_filename(filename):
+    # パスの部分は捨てる (Windows のブラウザは C:\\... を付けてくることがある)
+    filename = os.path.basename(str(filename).replace('\\', '/')).strip()
+    if not filename:
+        raise UploadError('ファイル名がありません。')
+    # upload_to を付けた名前が FileField の max_length に収まること
+    field = PortfolioItem._meta.get_field('file')
+    max_length = field.max_length - len(field.upload_to)
+    if len(filename) > max_length:
+        raise UploadError(f'ファイル名は {max_length} 文字以内にしてください。')
+    try:
+        validate_file_extension(File(None, name=filename))
+    except ValidationError as e:
+        raise UploadError(e.messages[0])
+    return filename
+
+
+def start_upload(portfolio, filename, size, sha256):
+    """
+    アップロードを始める (init)。同じファイルの途中のものがあればそれを返す
+    拡張子やサイズはここで確認し、送り始める前に断る
+    """
+    config = get_upload_settings()
+    filename = _clean_filename(filename)
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError('ファイルサイズが正しくありません。')
+    if size <= 0:
+        raise UploadError('空のファイルはアップロードできません。')
+    check_size(size, get_remaining_quota(portfolio.student_id))
+    sha256 = str(sha256 or '').lower()
+    if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+        raise UploadError('sha256 にはファイルのチェックサム (16進数) を指定してください。')
+
+    since = timezone.now() - timedelta(hours=config['EXPIRE_HOURS'])
+    upload = (
+        PortfolioUpload.objects
+        .filter(
+            portfolio=portfolio, filename=filename, size=size, sha256=sha256,
+            status=PortfolioUpload.STATUS_UPLOADING, updated_at__gte=since,
+        )
+        .order_by('-updated_at')
+        .first()
+    )
+    if upload is not None:
+        # 一時ファイルが消えていたら最初から
+        path = get_temp_path(upload)
+        actual = os.path.getsize(path) if os.path.exists(path) else 0
+        if actual < upload.received:
+            upload.received = 0
+            upload.save(update_fields=['received', 'updated_at'])
+        return upload
+
+    upload = PortfolioUpload.objects.create(portfolio=portfolio, filename=filename, size=size, sha256=sha256)
+    path = get_temp_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length, chunk_sha256=None):
+    """
+    stream (リクエスト) から length バイトを読み、一時ファイルの offset の位置に書く
+    戻り値: 受け取ったバイト数の合計
+    """
+    config = get_upload_settings()
+    if upload.status != PortfolioUpload.STATUS_UPLOADING:
+        raise UploadError('このアップロードは完了しています。', status=409, received=upload.received)
+    if offset != upload.received:
+        raise UploadError('offset が受け取ったバイト数と違います。', status=409, received=upload.received)
+    if length <= 0:
+        raise UploadError('データがありません。', received=upload.received)
+    if length > config['CHUNK_SIZE']:
+        raise UploadError(
+            f"1回に送れるのは {config['CHUNK_SIZE']} バイトまでです。", status=413, received=upload.received,
+        )
+    if offset + length > upload.size:
+        raise UploadError('ファイルサイズを超えています。', received=upload.received)
+
+    digest = hashlib.sha256()
+    written = 0
+    head = b''
+    path = get_temp_path(upload)
+    with open(path, 'r+b') as fh:
+        fh.seek(offset)
+        # 前回の途中で切れた分などが後ろに残っていれば捨てる
+        fh.truncate()
+        try:
+            while written < length:
+                block = stream.read(min(READ_BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                fh.write(block)
+                digest.update(block)
+                if offset == 0 and len(head) < SIGNATURE_LENGTH:
+                    head += block[:SIGNATURE_LENGTH - len(head)]
+                written += len(block)
+        except OSError:
+            # 通信が切れた。書けた分だけ受け取ったことにする
+            pass
+        if chunk_sha256 and (written != length or digest.hexdigest() != chunk_sha256.lower()):
+            # 照合できない・一致しない分は捨てる
+            fh.truncate(offset)
+            raise UploadError('データが壊れています。送り直してください。', received=offset, retry=True)
+
+    # 先頭が届いた時点で形式を確認し、違っていれば残りを受け取らずにやめる
+    if offset == 0 and len(head) >= min(SIGNATURE_LENGTH, upload.size):
+        _check_signature(upload, head)
+
+    # 同じ offset への送信が同時に来ても、進めるのは1つだけ
+    updated = PortfolioUpload.objects.filter(
+        pk=upload.pk, received=offset, status=PortfolioUpload.STATUS_UPLOADING,
+    ).update(received=offset + written, updated_at=timezone.now())
+    if not updated:
+        upload.refresh_from_db()
+        raise UploadError('offset が受け取ったバイト数と違います。', status=409, received=upload.received)
+    upload.received = offset + written
+    return upload.received
+
+
+def _check_signature(upload, head):
+    try:
+        validate_file_signature(upload.filename, head)
+    except ValidationError as e:
+        discard_upload(upload)
+        raise UploadError(e.messages[0], status=415)
+
+
+class _AssembledFile(File):
+    # FileSystemStorage は temporary_file_path() があるとコピーせずに移動する
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def discard_upload(upload):
+    path = get_temp_path(upload)
+    if os.path.exists(path):
+        os.remove(path)
+    upload.delete()
+
+
+def finish_upload(upload):
+    """
+    全部届いていればチェックサムを照合して PortfolioItem を作る (finalize)
+    照合やチェックに失敗したら、一時ファイルごと消す (最初からやり直し)
+    """
+    if upload.status == PortfolioUpload.STATUS_COMPLETED:
+        if upload.item is None:
+            raise UploadError('作成した作品は削除されています。', status=410)
+        return upload.item
+    if upload.received != upload.size:
+        raise UploadError('まだ全部届いていません。', status=409, received=upload.received)
+
+    path = get_temp_path(upload)
+    if not os.path.exists(path) or os.path.getsize(path) != upload.size:
+        upload.received = 0
+        upload.save(update_fields=['received', 'updated_at'])
+        raise UploadError('一時ファイルが見つかりません。最初から送り直してください。', status=409, received=0)
+    if chunked_sha256(path) != upload.sha256:
+        discard_upload(upload)
+        raise UploadError('ファイルのチェックサムが一致しません。もう一度アップロードしてください。')
+    with open(path, 'rb') as fh:
+        _check_signature(upload, fh.read(SIGNATURE_LENGTH))
+    try:
+        # 送っている間に他のファイルが増えているかもしれないので確認し直す
+        check_size(upload.size, get_remaining_quota(upload.portfolio.student_id))
+    except UploadError:
+        discard_upload(upload)
+        raise
+
+    with open(path, 'rb') as fh:
+        form = PortfolioItemForm(data={}, files={'file': _AssembledFile(fh, name=upload.filename)})
+        if not form.is_valid():
+            discard_upload(upload)
+            raise UploadError(' '.join(form.errors['file']) if 'file' in form.errors else 'ファイルが正しくありません。')
+        item = form.save(commit=False)
+        item.portfolio = upload.portfolio
+        item.save()
+
+    # 移動されずにコピーされた場合 (FileSystemStorage 以外) は一時ファイルを消す
+    if os.path.exists(path):
+        os.remove(path)
+    upload.status = PortfolioUpload.STATUS_COMPLETED
+    upload.item = item
+    upload.save(update_fields=['status', 'item', 'updated_at'])
+    return item
+
+
+def clean_expired_uploads(hours=None, now=None):
+    """ hours 時間動きのないアップロードと一時ファイルを消す。戻り値: 消した件数 """
+    if hours is None:
+        hours = get_upload_settings()['EXPIRE_HOURS']
+    since = (now or timezone.now()) - timedelta(hours=hours)
+    count = 0
+    for upload in PortfolioUpload.objects.filter(updated_at__lt=since).iterator():
+        discard_upload(upload)
+        count += 1
+    return count
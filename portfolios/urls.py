@@ -19,6 +19,12 @@ urlpatterns = [
     # 作品ファイル追加処理 (例: /portfolios/5/add_item/ )
     path('<int:portfolio_pk>/add_item/', views.add_portfolio_item, name='add_item'),
 
+    # 作品ファイルの分割アップロード (手順は portfolios/uploads.py を参照)
+    path('<int:portfolio_pk>/uploads/', views.upload_init, name='upload_init'),
+    path('uploads/<uuid:upload_id>/', views.upload_status, name='upload_status'),
+    path('uploads/<uuid:upload_id>/chunk/', views.upload_chunk, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/finalize/', views.upload_finalize, name='upload_finalize'),
+
     # 作品ファイル削除 (例: /portfolios/item/12/delete/ )
     path('item/<int:pk>/delete/', views.PortfolioItemDeleteView.as_view(), name='delete_item'),
 
@@ -1,3 +1,4 @@
+import codecs
 import os
 from django.core.exceptions import ValidationError
 
@@ -7,4 +8,43 @@ def validate_file_extension(value):
     valid_extensions = ['.pdf', '.jpg', '.jpeg', '.png', '.zip', '.py', '.html', '.css', '.js']
     
     if not ext.lower() in valid_extensions:
-        raise ValidationError(f'未対応のファイル形式です。以下の形式がアップロード可能です: {", ".join(valid_extensions)}')
\ No newline at end of file
+        raise ValidationError(f'未対応のファイル形式です。以下の形式がアップロード可能です: {", ".join(valid_extensions)}')
+
+
+# 拡張子ごとの、ファイルの先頭にあるはずのバイト列 (マジックナンバー)
+FILE_SIGNATURES = {
+    '.pdf': (b'%PDF-',),
+    '.jpg': (b'\xff\xd8\xff',),
+    '.jpeg': (b'\xff\xd8\xff',),
+    '.png': (b'\x89PNG\r\n\x1a\n',),
+    # 空の ZIP は終端のレコードだけになる
+    '.zip': (b'PK\x03\x04', b'PK\x05\x06'),
+}
+# 中身がテキスト (UTF-8 か Shift_JIS) であるはずの拡張子
+TEXT_EXTENSIONS = ['.py', '.html', '.css', '.js']
+# 先頭の何バイトを見て判定するか
+SIGNATURE_LENGTH = 1024
+
+
+def _looks_like_text(head):
+    if b'\x00' in head:
+        return False
+    # head はファイルの途中で切れているので、最後の文字が欠けていてもよい
+    for encoding in ('utf-8', 'cp932'):
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+            return True
+        except UnicodeDecodeError:
+            pass
+    return False
+
+
+def validate_file_signature(name, head):
+    """ ファイルの先頭 (head) が拡張子どおりの形式か確認する (アップロードの途中でも使う) """
+    ext = os.path.splitext(name)[1].lower()
+    if ext in FILE_SIGNATURES:
+        if not head.startswith(FILE_SIGNATURES[ext]):
+            raise ValidationError(f'ファイルの中身が {ext} の形式ではありません。')
+    elif ext in TEXT_EXTENSIONS:
+        if not _looks_like_text(head):
+            raise ValidationError(f'{ext} ファイルはテキストファイルである必要があります。')
@@ -1,3 +1,5 @@
+import json
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy, reverse
 from django.views.generic import (
@@ -5,13 +7,18 @@ from django.views.generic import (
 )
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseForbidden
+from django.contrib import messages
+from django.http import HttpResponseForbidden, JsonResponse
+from django.views.decorators.http import require_GET, require_POST, require_http_methods
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
-from .models import Portfolio, PortfolioItem
+from .models import Portfolio, PortfolioItem, PortfolioUpload
+from .uploads import UploadError, get_upload_settings, start_upload, write_chunk, finish_upload
+from .upload_handlers import PortfolioUploadHandler
 from .forms import PortfolioForm, PortfolioItemForm, PortfolioCommentForm # 1. フォームをインポート
-# 2. accounts アプリから TeacherOnlyMixin と Student をインポート
+# 2. accounts アプリから TeacherOnlyMixin とロール定数をインポート
 from accounts.views import TeacherOnlyMixin 
-from accounts.models import Student
+from accounts.roles import ROLE_STUDENT
 
 # --- 権限チェック用のMixin (PortfolioItem 用) ---
 class PortfolioItemOwnerOnlyMixin(UserPassesTestMixin):
@@ -20,10 +27,9 @@ class PortfolioItemOwnerOnlyMixin(UserPassesTestMixin):
         item = self.get_object()
         # ログイン中の学生のプロフィールと、
         # その作品が属するポートフォリオの持ち主が一致するか確認
-        try:
-            return item.portfolio.student == self.request.user.student
-        except Student.DoesNotExist:
+        if self.request.role != ROLE_STUDENT:
             return False
+        return item.portfolio.student_id == self.request.profile.pk
 # --- 権限チェック用のMixin ---
 # (自分が作成した学生かどうかをチェックする)
 class StudentOwnerOnlyMixin(UserPassesTestMixin):
@@ -31,10 +37,9 @@ class StudentOwnerOnlyMixin(UserPassesTestMixin):
         # 今開こうとしているポートフォリオを取得
         portfolio = self.get_object()
         # ログイン中の学生のプロフィールと、ポートフォリオの持ち主が一致するか確認
-        try:
-            return portfolio.student == self.request.user.student
-        except Student.DoesNotExist:
+        if self.request.role != ROLE_STUDENT:
             return False
+        return portfolio.student_id == self.request.profile.pk
 
 # 2. ポートフォリオを新規作成するビュー
 class PortfolioCreateView(LoginRequiredMixin, CreateView):
@@ -53,15 +58,13 @@ class PortfolioCreateView(LoginRequiredMixin, CreateView):
     
     def form_valid(self, form):
         # フォームが送信される直前に、誰が作成したかを自動でセットする
-        try:
-            student = self.request.user.student
-            form.instance.student = student
-            return super().form_valid(form)
-        except Student.DoesNotExist:
+        if self.request.role != ROLE_STUDENT:
             # もし学生プロフィールがないユーザー（教員など）が
             # 直接URLを叩いた場合の安全対策
             form.add_error(None, '学生としてログインしていません。')
             return self.form_invalid(form)
+        form.instance.student = self.request.profile
+        return super().form_valid(form)
 
     def get_context_data(self, **kwargs):
         # テンプレートに「作成」というタイトルを渡す
@@ -84,6 +87,12 @@ class PortfolioDetailView(LoginRequiredMixin, StudentOwnerOnlyMixin, DetailView)
         
         # 新規アップロード用の空のフォームをテンプレートに渡す
         context['item_form'] = PortfolioItemForm()
+
+        # 大きなファイルは分割アップロードで送る (テンプレートの JS が使う)
+        context['upload_config'] = {
+            'init_url': reverse('portfolios:upload_init', kwargs={'portfolio_pk': portfolio.pk}),
+            'chunk_size': get_upload_settings()['CHUNK_SIZE'],
+        }
         
         return context
 
@@ -115,27 +124,130 @@ class PortfolioDeleteView(LoginRequiredMixin, StudentOwnerOnlyMixin, DeleteView)
     success_url = reverse_lazy('accounts:my_page')
 
 # 7. ↓ ファイルアップロード処理用のビューを新規追加 ↓
+# ★ 受け取りながら確認する PortfolioUploadHandler を使う。CSRF の確認で request.POST を読むと
+#   upload handler を差し替えられなくなるので、差し替えた後 (_add_portfolio_item) で確認する
+@csrf_exempt
 @login_required
 def add_portfolio_item(request, portfolio_pk):
     portfolio = get_object_or_404(Portfolio, pk=portfolio_pk)
     
     # セキュリティチェック：持ち主か確認
-    try:
-        if portfolio.student != request.user.student:
-            return HttpResponseForbidden("アクセス権がありません。")
-    except Student.DoesNotExist:
+    if request.role != ROLE_STUDENT or portfolio.student_id != request.profile.pk:
         return HttpResponseForbidden("アクセス権がありません。")
 
+    handler = PortfolioUploadHandler(request, portfolio.student_id)
+    request.upload_handlers.insert(0, handler)
+    return _add_portfolio_item(request, portfolio, handler)
+
+
+@csrf_protect
+def _add_portfolio_item(request, portfolio, handler):
     # POSTリクエスト（＝フォームが送信された）の場合のみ処理
     if request.method == 'POST':
         form = PortfolioItemForm(request.POST, request.FILES) # 8. request.FILES が重要！
-        if form.is_valid():
+        if handler.error:
+            # 受け取りの途中でやめた (形式が違う・大きすぎるなど)
+            messages.error(request, handler.error)
+        elif form.is_valid():
             item = form.save(commit=False)
             item.portfolio = portfolio # どのポートフォリオに紐付くか設定
             item.save()
+        else:
+            for error in form.errors.get('file', []):
+                messages.error(request, error)
             
     # 処理が終わったら、元の詳細ページにリダイレクトする
-    return redirect('portfolios:detail', pk=portfolio_pk)
+    return redirect('portfolios:detail', pk=portfolio.pk)
+
+# --- 分割アップロード (JSON)。手順は portfolios/uploads.py を参照 ---
+def _upload_response(upload, **extra):
+    return JsonResponse({
+        'upload_id': str(upload.pk),
+        'filename': upload.filename,
+        'size': upload.size,
+        'received': upload.received,
+        'status': upload.status,
+        'chunk_size': get_upload_settings()['CHUNK_SIZE'],
+        'status_url': reverse('portfolios:upload_status', kwargs={'upload_id': upload.pk}),
+        'chunk_url': reverse('portfolios:upload_chunk', kwargs={'upload_id': upload.pk}),
+        'finalize_url': reverse('portfolios:upload_finalize', kwargs={'upload_id': upload.pk}),
+        **extra,
+    })
+
+
+def _error_response(error):
+    return JsonResponse({'error': error.message, **error.extra}, status=error.status)
+
+
+def _get_own_upload(request, upload_id):
+    """ ログイン中の学生のアップロード (他人のものや無いものは None) """
+    if request.role != ROLE_STUDENT:
+        return None
+    return (
+        PortfolioUpload.objects.select_related('portfolio', 'item')
+        .filter(pk=upload_id, portfolio__student_id=request.profile.pk)
+        .first()
+    )
+
+
+@login_required
+@require_POST
+def upload_init(request, portfolio_pk):
+    portfolio = get_object_or_404(Portfolio, pk=portfolio_pk)
+    if request.role != ROLE_STUDENT or portfolio.student_id != request.profile.pk:
+        return HttpResponseForbidden("アクセス権がありません。")
+
+    try:
+        data = json.loads(request.body)
+        upload = start_upload(portfolio, data.get('filename'), data.get('size'), data.get('sha256'))
+    except (ValueError, AttributeError):
+        return JsonResponse({'error': 'Invalid JSON.'}, status=400)
+    except UploadError as e:
+        return _error_response(e)
+    return _upload_response(upload)
+
+
+@login_required
+@require_GET
+def upload_status(request, upload_id):
+    upload = _get_own_upload(request, upload_id)
+    if upload is None:
+        return HttpResponseForbidden("アクセス権がありません。")
+    return _upload_response(upload)
+
+
+@login_required
+@require_http_methods(['PUT'])
+def upload_chunk(request, upload_id):
+    upload = _get_own_upload(request, upload_id)
+    if upload is None:
+        return HttpResponseForbidden("アクセス権がありません。")
+
+    try:
+        offset = int(request.GET['offset'])
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'offset と Content-Length が必要です。'}, status=400)
+    # ★ request.body は使わない (全体をメモリに読み込んでしまう)。request から少しずつ読む
+    try:
+        received = write_chunk(upload, offset, request, length, request.headers.get('X-Chunk-SHA256'))
+    except UploadError as e:
+        return _error_response(e)
+    return JsonResponse({'received': received, 'size': upload.size})
+
+
+@login_required
+@require_POST
+def upload_finalize(request, upload_id):
+    upload = _get_own_upload(request, upload_id)
+    if upload is None:
+        return HttpResponseForbidden("アクセス権がありません。")
+
+    try:
+        item = finish_upload(upload)
+    except UploadError as e:
+        return _error_response(e)
+    return _upload_response(upload, item_id=item.pk, file_url=item.file.url)
 
 # ↓ ファイル削除用のビューを新規追加 ↓
 class PortfolioItemDeleteView(LoginRequiredMixin, PortfolioItemOwnerOnlyMixin, DeleteView):
@@ -157,13 +269,13 @@ class PortfolioCommentUpdateView(LoginRequiredMixin, TeacherOnlyMixin, UpdateVie
     
     def get_queryset(self):
         # 自分が所属する学校の学生のポートフォリオのみ編集可能にする
-        teacher = self.request.user.teacher
+        teacher = self.request.profile
         # student__school で、Portfolio -> Student -> School と辿る
         return Portfolio.objects.filter(student__school=teacher.school)
 
     def form_valid(self, form):
         # フォームが保存される直前に、誰が編集したかを記録
-        form.instance.commenting_teacher = self.request.user.teacher
+        form.instance.commenting_teacher = self.request.profile
         return super().form_valid(form)
 
     def get_success_url(self):